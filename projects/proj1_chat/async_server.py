@@ -0,0 +1,253 @@
+import argparse
+import asyncio
+import logging
+import socket
+
+import channel_history
+import outbound_queue
+import rate_limit
+import server_logging
+import utils
+from server import (Client, ClientNameExistsError, IRCHandler, encode_message,
+                    logger, message_logger)
+
+
+class AsyncServer(object):
+    # An asyncio version of the chat server. It speaks the same protocol as
+    # Server and leaves all of the IRC work to the same IRCHandler, but each
+    # connection is served by its own task reading with readexactly(), so it
+    # can share an event loop with other asyncio services.
+    def __init__(self, port,
+                 high_water_mark=outbound_queue.DEFAULT_HIGH_WATER_MARK,
+                 history_length=channel_history.DEFAULT_HISTORY_LENGTH,
+                 history_directory=None,
+                 summary_interval=server_logging.DEFAULT_SUMMARY_INTERVAL,
+                 client_rate_limit=None, channel_rate_limit=None,
+                 rate_limit_action=rate_limit.DEFAULT_RATE_LIMIT_ACTION):
+        self.address = 'localhost'
+        self.port = int(port)
+        self.server = None
+        self.high_water_mark = high_water_mark
+
+        self.irc_handler = IRCHandler(history_length, history_directory,
+                                      client_rate_limit=client_rate_limit,
+                                      channel_rate_limit=channel_rate_limit,
+                                      rate_limit_action=rate_limit_action)
+        self.client_name_writer_map = dict()
+        self._send_scheduled = False
+
+        self.summary_logger = server_logging.SummaryLogger(summary_interval)
+        self.num_accepted = 0
+        self.num_disconnected = 0
+        self.num_received_messages = 0
+        self.num_queued_messages = 0
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle_connection,
+                                                 self.address,
+                                                 self.port,
+                                                 backlog=socket.SOMAXCONN)
+
+        # Port 0 lets the OS pick a port, so report the one we really got.
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def run(self):
+        await self.start()
+
+        logger.info('Server started in port %s.', self.port)
+
+        if self.summary_logger.interval > 0:
+            loop = asyncio.get_running_loop()
+            self.summary_logger.is_due(loop.time())
+            loop.call_later(self.summary_logger.interval, self.log_summary)
+
+        async with self.server:
+            await self.server.serve_forever()
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+
+    def log_summary(self):
+        loop = asyncio.get_running_loop()
+        counters = [
+            ('accepted', self.num_accepted),
+            ('disconnected', self.num_disconnected),
+            ('received', self.num_received_messages),
+            ('queued', self.num_queued_messages),
+        ]
+        gauges = [
+            ('connections', len(self.client_name_writer_map)),
+            ('channels', len(self.irc_handler.channels)),
+        ]
+        self.summary_logger.log(loop.time(), counters, gauges)
+
+        loop.call_later(self.summary_logger.interval, self.log_summary)
+
+    async def handle_connection(self, reader, writer):
+        address = writer.get_extra_info('peername')[0]
+        client = None
+        self.num_accepted += 1
+
+        try:
+            name = await self._read_message(reader)
+            try:
+                client = self.create_client(name, address, writer)
+            except ClientNameExistsError:
+                logger.info('Client connected with a name, \'%s\', that is '
+                            'already used by another client. Kicking this '
+                            'client off...', name)
+                writer.write(encode_message('Client name is already taken. '
+                                            + 'Use a different one.'))
+                return
+
+            logger.info('Connection received from %s with a name, \'%s\'.',
+                        address, name)
+
+            while True:
+                message = await self._read_message(reader)
+                if message:
+                    self.num_received_messages += 1
+                    self.irc_handler.process_client_message(message,
+                                                            client.name)
+                    self.schedule_send_messages()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            # The client disconnected, possibly in the middle of a message.
+            pass
+        except rate_limit.ClientFloodingError:
+            logger.warning('Client %s is sending messages too fast. Kicking '
+                           'it off...', client.name)
+        finally:
+            self.num_disconnected += 1
+            if client is not None:
+                self.remove_client(client.name)
+                self.schedule_send_messages()
+
+                logger.info('Connection from %s (%s) disconnected.', address,
+                            client.name)
+
+            writer.close()
+
+    def create_client(self, name, address, writer):
+        if name in self.client_name_writer_map:
+            raise ClientNameExistsError()
+
+        client = Client(name, address)
+
+        self.irc_handler.add_client(client)
+        self.client_name_writer_map[name] = writer
+
+        return client
+
+    def remove_client(self, name):
+        self.irc_handler.remove_client(name)
+
+        del self.client_name_writer_map[name]
+
+    def schedule_send_messages(self):
+        # Messages are sent once per event loop iteration rather than once
+        # per received message, which is what Server.step() does as well.
+        if not self._send_scheduled:
+            self._send_scheduled = True
+            asyncio.get_running_loop().call_soon(self.send_messages)
+
+    def send_messages(self):
+        self._send_scheduled = False
+
+        # Same as Server.send_messages(), except that the bytes go to the
+        # transports of the recipients. Those write as much as they can right
+        # away and buffer the rest, so we never wait on a slow client.
+        log_messages = message_logger.isEnabledFor(logging.DEBUG)
+
+        for server_message in self.irc_handler.server_messages:
+            if log_messages:
+                message_logger.debug('(SERVER) Sending message: %s',
+                                     server_message.message.strip())
+            self.queue_message(server_message.sender_client_name,
+                               server_message)
+
+        self.irc_handler.clear_server_messages()
+
+        for client_name, messages in self.irc_handler.replays:
+            for message in messages:
+                self.queue_message(client_name, message)
+
+        self.irc_handler.clear_replays()
+
+        # Private messages go to their one recipient, who is looked up by
+        # name rather than through any channel.
+        for client_name, message in self.irc_handler.direct_messages:
+            self.queue_message(client_name, message)
+
+        self.irc_handler.clear_direct_messages()
+
+        for channel in self.irc_handler.pending_channels:
+            for message in channel.messages:
+                if log_messages:
+                    message_logger.debug('(CHANNELS) Sending message: %s',
+                                         message.message.strip())
+                for client in channel.clients.values():
+                    if message.sender_client_name != client.name:
+                        self.queue_message(client.name, message)
+
+        self.irc_handler.clear_pending_channels()
+
+    def queue_message(self, client_name, message):
+        writer = self.client_name_writer_map.get(client_name)
+        if writer is None or writer.is_closing():
+            return
+
+        # Clients that have fallen too far behind lose messages instead of
+        # growing their transport buffers forever.
+        if writer.transport.get_write_buffer_size() > self.high_water_mark:
+            return
+
+        writer.write(message.encoded)
+        self.num_queued_messages += 1
+
+    async def _read_message(self, reader):
+        data = await reader.readexactly(utils.MESSAGE_LENGTH)
+
+        return data.decode('utf-8', 'replace').strip()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='CMSC 135 Chat Server '
+                                                 + '(asyncio)')
+    parser.add_argument('port', type=int, help='Port to listen on.')
+    parser.add_argument(
+        '--high-water-mark', dest='high_water_mark', type=int,
+        default=outbound_queue.DEFAULT_HIGH_WATER_MARK,
+        help='Number of bytes that may be buffered for a client before '
+             + 'new messages to it are dropped.')
+    parser.add_argument(
+        '--history-length', dest='history_length', type=int,
+        default=channel_history.DEFAULT_HISTORY_LENGTH,
+        help='Number of recent messages kept for each channel and replayed '
+             + 'to clients that join it.')
+    parser.add_argument(
+        '--history-dir', dest='history_dir',
+        help='Directory where every channel message is logged, one file per '
+             + 'channel.')
+    rate_limit.add_rate_limit_arguments(parser)
+    server_logging.add_logging_arguments(parser)
+    args = parser.parse_args()
+
+    server_logging.configure_logging_from_arguments(args)
+
+    client_rate_limit, channel_rate_limit = \
+        rate_limit.create_rate_limits_from_arguments(args)
+
+    server = AsyncServer(args.port, args.high_water_mark,
+                         args.history_length, args.history_dir,
+                         args.summary_interval, client_rate_limit,
+                         channel_rate_limit, args.rate_limit_action)
+    try:
+        asyncio.run(server.run())
+    except KeyboardInterrupt:
+        pass
+    except Exception:
+        logger.exception('Server message (ERROR):')
+    finally:
+        server.close()
+        server_logging.shutdown_logging()
@@ -0,0 +1,124 @@
+"""
+Measures what recording a capture with server.py --capture costs the
+server, and how big the capture gets.
+
+A load generator (benchmarks.loadgen) runs against the server twice, once
+as it is and once with a capture. Recording a frame only copies it into the
+capture's buffer, which is written out once it fills up, or a second after
+the first record went into it, so the latency and the server's CPU time
+should hardly change. The server is stopped with SIGINT, like a server
+stopped at the terminal, so that it writes out what is left of its capture.
+
+The capture of the second run is then replayed against a new server as
+fast as it takes it (benchmarks.replay), to check that it can be, and that
+every message is delivered.
+
+Run it from the proj1_chat directory:
+
+    $ python -m benchmarks.bench_capture
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import shutil
+import tempfile
+
+import capture
+from benchmarks import loadgen, replay
+from benchmarks.common import (find_free_port, raise_file_limit, start_server,
+                               stop_server)
+
+
+MODES = ('off', 'capture')
+
+
+def bench(mode, args, capture_path):
+    server_args = ['--summary-interval', '0']
+    if mode == 'capture':
+        server_args += ['--capture', capture_path]
+
+    port = find_free_port()
+    server = start_server(port, server_args)
+    load_generator = loadgen.LoadGenerator('localhost', port, args.clients,
+                                           args.channel_size, args.rate,
+                                           args.duration, server.pid)
+    try:
+        load_generator.connect()
+        load_generator.join_channels()
+
+        return load_generator.run()
+    finally:
+        load_generator.close()
+        stop_server(server)
+
+
+def bench_replay(capture_path):
+    events = replay.plan_replay(capture.read_capture(capture_path))
+
+    port = find_free_port()
+    server = start_server(port, ['--summary-interval', '0'])
+    replayer = replay.Replayer('localhost', port, events, float('inf'),
+                               server.pid)
+    try:
+        return replayer.run()
+    finally:
+        replayer.close()
+        stop_server(server)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the cost of capturing what clients send.')
+    parser.add_argument(
+        '--clients', dest='clients', type=int, default=1000,
+        help='Number of clients.')
+    parser.add_argument(
+        '--channel-size', dest='channel_size', type=int, default=10,
+        help='Number of clients in each channel.')
+    parser.add_argument(
+        '--rate', dest='rate', type=float, default=2000,
+        help='Total number of messages sent per second.')
+    parser.add_argument(
+        '--duration', dest='duration', type=float, default=5,
+        help='Number of seconds to send messages for in each run.')
+    args = parser.parse_args()
+
+    raise_file_limit()
+
+    directory = tempfile.mkdtemp(prefix='chat-capture-')
+    capture_path = os.path.join(directory, 'session.capture')
+    try:
+        print('{:<8} {:>10} {:>10} {:>11} {:>10}'.format(
+            'mode', 'p50 (ms)', 'p99 (ms)', 'delivered', 'cpu'))
+        for mode in MODES:
+            report = bench(mode, args, capture_path)
+
+            cpu = '-'
+            if report['server_cpu'] is not None:
+                cpu = '{:.0f}%'.format(report['server_cpu'] * 100)
+            print('{:<8} {:>10.3f} {:>10.3f} {:>10.1f}% {:>10}'.format(
+                mode, report['p50_ms'], report['p99_ms'],
+                100.0 * report['delivered'] / max(report['expected'], 1),
+                cpu))
+
+        num_frames = sum(1 for record in capture.read_capture(capture_path)
+                         if record.kind == capture.CAPTURE_FRAME)
+        capture_size = os.path.getsize(capture_path)
+        print('Capture:  {} frames in {} bytes ({:.1f} per frame)'.format(
+            num_frames, capture_size, capture_size / float(max(num_frames,
+                                                               1))))
+
+        report = bench_replay(capture_path)
+        print('Replay:   {:.1f} s of capture in {:.1f} s, {:.0f} msg/s '
+              'sent, {} of {} delivered, p99 {:.3f} ms'.format(
+                  report['captured_seconds'], report['replayed_seconds'],
+                  report['sent_per_second'], report['delivered'],
+                  report['expected'], report['p99_ms']))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
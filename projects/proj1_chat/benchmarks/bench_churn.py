@@ -0,0 +1,221 @@
+"""
+Measures how well the chat server copes with clients connecting and
+disconnecting at a high rate.
+
+  registry: adds and removes connections from a server-sized pool, one at a
+            random position at a time. Compares the old bookkeeping, a list
+            of sockets plus dicts keyed by id(), with the ConnectionRegistry
+            that the server uses now.
+  server:   starts a server in a subprocess and churns through clients at a
+            target rate. Each client connects, sends its name and a /list
+            command, waits for the reply, and hangs up. Reports the rate
+            that the server kept up with and the connect-to-reply latency.
+
+Closing the clients resets their connections, so that a long run doesn't
+leave thousands of sockets in TIME_WAIT behind.
+
+Run it from the proj1_chat directory:
+
+    $ python -m benchmarks.bench_churn
+"""
+
+from __future__ import print_function
+
+import argparse
+import errno
+import random
+import selectors
+import socket
+import struct
+import time
+
+import server as chat_server
+import utils
+from benchmarks.common import (find_free_port, pad, raise_file_limit,
+                               start_server)
+
+
+class FakeConnection(object):
+    # The registry only needs a file descriptor and a client, so we don't
+    # have to open thousands of real sockets.
+    def __init__(self, fileno):
+        self.fileno = fileno
+        self.client = None
+
+
+def legacy_churn(connections, operations, rng):
+    sockets = list(connections)
+    socket_id_map = dict((id(c), c) for c in connections)
+
+    start = time.perf_counter()
+    for i in range(operations):
+        old = sockets[rng.randrange(len(sockets))]
+        sockets.remove(old)
+        del socket_id_map[id(old)]
+
+        new = FakeConnection(old.fileno)
+        sockets.append(new)
+        socket_id_map[id(new)] = new
+
+    return time.perf_counter() - start
+
+
+def registry_churn(connections, operations, rng):
+    registry = chat_server.ConnectionRegistry()
+    for connection in connections:
+        registry.add(connection)
+    filenos = [c.fileno for c in connections]
+
+    start = time.perf_counter()
+    for i in range(operations):
+        fileno = filenos[rng.randrange(len(filenos))]
+        registry.remove(registry.get(fileno))
+        registry.add(FakeConnection(fileno))
+
+    return time.perf_counter() - start
+
+
+def bench_registry(num_connections, operations, seed):
+    print('{:<10} {:>12} {:>16}'.format('registry', 'connections',
+                                        'add+remove (us)'))
+    for name, churn in (('legacy', legacy_churn),
+                        ('fd-keyed', registry_churn)):
+        connections = [FakeConnection(fd) for fd in range(num_connections)]
+        elapsed = churn(connections, operations, random.Random(seed))
+        print('{:<10} {:>12} {:>16.3f}'.format(
+            name, num_connections, elapsed * 1e6 / operations))
+
+
+class ChurnClient(object):
+    def __init__(self, client_socket, started_at):
+        self.socket = client_socket
+        self.started_at = started_at
+        self.received = 0
+
+
+def open_client(port, name, selector):
+    client_socket = socket.socket()
+    client_socket.setblocking(False)
+    # Reset the connection on close instead of going through TIME_WAIT.
+    client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                             struct.pack('ii', 1, 0))
+
+    error = client_socket.connect_ex(('localhost', port))
+    if error not in (0, errno.EINPROGRESS):
+        client_socket.close()
+        raise socket.error(error, 'Could not connect to the server.')
+
+    client = ChurnClient(client_socket, time.perf_counter())
+    # The name and the command fit in the socket buffer, so they go out as
+    # soon as the connection is up.
+    selector.register(client_socket, selectors.EVENT_WRITE, (client, name))
+
+    return client
+
+
+def step_client(selector, client, name, events, latencies):
+    # Returns whether the client is done.
+    if events & selectors.EVENT_WRITE:
+        error = client.socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if error != 0:
+            raise socket.error(error, 'Could not connect to the server.')
+
+        client.socket.send(pad(name) + pad('/list'))
+        selector.modify(client.socket, selectors.EVENT_READ, (client, name))
+        return False
+
+    data = client.socket.recv(utils.MESSAGE_LENGTH - client.received)
+    if not data:
+        raise RuntimeError('Server closed the connection of {}.'.format(name))
+
+    client.received += len(data)
+    if client.received < utils.MESSAGE_LENGTH:
+        return False
+
+    latencies.append(time.perf_counter() - client.started_at)
+    selector.unregister(client.socket)
+    client.socket.close()
+
+    return True
+
+
+def bench_server(rate, duration, window):
+    port = find_free_port()
+    server = start_server(port)
+    selector = selectors.DefaultSelector()
+    latencies = list()
+    num_opened = 0
+    try:
+        start = time.perf_counter()
+        end = start + duration
+        now = start
+        while now < end or len(selector.get_map()) > 0:
+            if now < end:
+                num_due = int((now - start) * rate) - num_opened
+                num_due = min(num_due, window - len(selector.get_map()))
+                for _ in range(max(num_due, 0)):
+                    open_client(port, 'churn{}'.format(num_opened), selector)
+                    num_opened += 1
+            elif now > end + 10:
+                raise RuntimeError('Timed out waiting for server replies.')
+
+            for key, events in selector.select(0.001):
+                client, name = key.data
+                step_client(selector, client, name, events, latencies)
+
+            now = time.perf_counter()
+
+        elapsed = now - start
+    finally:
+        for key in list(selector.get_map().values()):
+            key.fileobj.close()
+        selector.close()
+
+        server.kill()
+        server.wait()
+
+    latencies.sort()
+    p50 = latencies[len(latencies) // 2]
+    p99 = latencies[min(int(len(latencies) * 0.99), len(latencies) - 1)]
+
+    return len(latencies) / elapsed, p50, p99
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark connection churn in the chat server.')
+    parser.add_argument(
+        '--connections', dest='connections', type=int, default=10000,
+        help='Number of connections in the registry benchmark.')
+    parser.add_argument(
+        '--operations', dest='operations', type=int, default=20000,
+        help='Number of add and remove pairs in the registry benchmark.')
+    parser.add_argument(
+        '--rate', dest='rate', type=float, default=10000,
+        help='Number of clients to connect and disconnect per second.')
+    parser.add_argument(
+        '--duration', dest='duration', type=float, default=5,
+        help='Number of seconds to churn clients for.')
+    parser.add_argument(
+        '--window', dest='window', type=int, default=500,
+        help='Most clients that may be waiting for the server at once.')
+    parser.add_argument(
+        '--seed', dest='seed', type=int, default=135,
+        help='Seed for picking which connections to remove.')
+    args = parser.parse_args()
+
+    raise_file_limit()
+
+    bench_registry(args.connections, args.operations, args.seed)
+    print()
+
+    churn_rate, p50, p99 = bench_server(args.rate, args.duration,
+                                        args.window)
+    print('Target churn:     {:.0f} clients/s'.format(args.rate))
+    print('Achieved churn:   {:.0f} clients/s'.format(churn_rate))
+    print('Latency p50:      {:.3f} ms'.format(p50 * 1e3))
+    print('Latency p99:      {:.3f} ms'.format(p99 * 1e3))
+
+
+if __name__ == '__main__':
+    main()
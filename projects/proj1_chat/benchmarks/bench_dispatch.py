@@ -0,0 +1,213 @@
+"""
+Measures how many client messages per second IRCHandler.process_client_message
+gets through.
+
+The messages are mostly chat text, with a few commands mixed in (5% by
+default): /list, /join, and commands that don't exist. Every few hundred
+messages, the handler's queued messages are cleared, the way the server
+clears them after sending them every tick.
+
+Two paths are compared:
+
+  legacy:   prints every message, strips and splits it into blocks, then
+            validates commands against a list built on every call, like the
+            handler used to.
+  dispatch: the handler's own path. Only the first character is checked,
+            chat text goes straight to the channel, commands are looked up
+            in a table, and nothing is logged unless message logging is on.
+
+Run it from the proj1_chat directory:
+
+    $ python -m benchmarks.bench_dispatch
+"""
+
+from __future__ import print_function
+
+import argparse
+import contextlib
+import os
+import random
+import time
+
+import server as chat_server
+import utils
+
+
+class LegacyIRCHandler(chat_server.IRCHandler):
+    def process_client_message(self, message, name):
+        client = self.connected_clients[name]
+
+        try:
+            client_channel_name = client.channel.name
+        except AttributeError:
+            client_channel_name = None
+
+        print('Received message '
+              + 'from {} (Address: {}, '.format(client.name, client.address)
+              + 'Channel: {}).'.format(client_channel_name))
+
+        message = message.strip()
+        message_blocks = message.split()
+
+        print('   Message: {}'.format(message))
+
+        try:
+            if message[0] == '/':
+                response = self._validate_command_message(message_blocks)
+                if response == '':
+                    self._legacy_process_command(message_blocks, client)
+                else:
+                    server_message = chat_server.Message(client.name,
+                                                         response)
+                    self._server_messages.append(server_message)
+            else:
+                if client.channel is None:
+                    response = utils.SERVER_CLIENT_NOT_IN_CHANNEL
+
+                    server_message = chat_server.Message(client.name,
+                                                         response)
+                    self._server_messages.append(server_message)
+                else:
+                    message = '[{}] {}'.format(client.name, message)
+                    client.channel.add_message(client.name, message)
+        except IndexError:
+            print('Client {} has sent an empty message.'.format(name)
+                  + ' Ignoring it.')
+
+    def _legacy_process_command(self, message_blocks, client):
+        if message_blocks[0] == '/list':
+            self._list_channels(message_blocks, client)
+        elif message_blocks[0] == '/create':
+            self._create_channel(message_blocks, client)
+        elif message_blocks[0] == '/join':
+            self._join_channel(message_blocks, client)
+
+    def _validate_command_message(self, message_blocks):
+        message = ' '.join(message_blocks)
+        command = message_blocks[0]
+
+        response = ''
+        if not self._is_command_valid(command):
+            response = utils.SERVER_INVALID_CONTROL_MESSAGE.format(message)
+            return response
+
+        if not self._is_channel_command_valid_length(message_blocks):
+            if command == '/list':
+                response = '/list should only be used by itself.'
+            elif command == '/create':
+                response = utils.SERVER_CREATE_REQUIRES_ARGUMENT.format(
+                    message)
+            elif command == '/join':
+                response = utils.SERVER_JOIN_REQUIRES_ARGUMENT.format(message)
+
+        return response if response != '' else ''
+
+    def _is_channel_command_valid_length(self, message_blocks):
+        if message_blocks[0] == '/list':
+            return len(message_blocks) == 1
+        else:
+            return len(message_blocks) == 2
+
+    def _is_command_valid(self, command):
+        valid_commands = ['/join', '/create', '/list']
+        return command in valid_commands
+
+
+HANDLERS = [('legacy', LegacyIRCHandler),
+            ('dispatch', chat_server.IRCHandler)]
+
+
+def generate_messages(num_clients, num_channels, num_messages,
+                      command_ratio, seed):
+    rng = random.Random(seed)
+    messages = list()
+    for _ in range(num_messages):
+        name = 'client{}'.format(rng.randrange(num_clients))
+        if rng.random() < command_ratio:
+            message = rng.choice([
+                '/list',
+                '/join room{}'.format(rng.randrange(num_channels)),
+                '/nick someone',
+            ])
+        else:
+            message = 'is anyone around to review my branch before lunch?'
+
+        messages.append((message, name))
+
+    return messages
+
+
+def create_handler(handler_class, num_clients, num_channels):
+    irc_handler = handler_class(history_length=0)
+    for i in range(num_channels):
+        irc_handler.add_channel('room{}'.format(i))
+
+    for i in range(num_clients):
+        client = chat_server.Client('client{}'.format(i), '127.0.0.1')
+        irc_handler.add_client(client)
+        irc_handler.add_client_to_channel(
+            client, 'room{}'.format(i % num_channels))
+
+    return irc_handler
+
+
+def clear(irc_handler):
+    irc_handler.clear_pending_channels()
+    irc_handler.clear_server_messages()
+    irc_handler.clear_replays()
+
+
+def bench(handler_class, messages, num_clients, num_channels,
+          messages_per_tick):
+    irc_handler = create_handler(handler_class, num_clients, num_channels)
+
+    start = time.perf_counter()
+    for i, (message, name) in enumerate(messages):
+        irc_handler.process_client_message(message, name)
+        if i % messages_per_tick == 0:
+            clear(irc_handler)
+
+    return len(messages) / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the processing of client messages.')
+    parser.add_argument(
+        '--clients', dest='clients', type=int, default=1000,
+        help='Number of clients.')
+    parser.add_argument(
+        '--channels', dest='channels', type=int, default=100,
+        help='Number of channels.')
+    parser.add_argument(
+        '--messages', dest='messages', type=int, default=200000,
+        help='Number of messages to process.')
+    parser.add_argument(
+        '--command-ratio', dest='command_ratio', type=float, default=0.05,
+        help='Fraction of the messages that are commands.')
+    parser.add_argument(
+        '--messages-per-tick', dest='messages_per_tick', type=int,
+        default=500,
+        help='Number of messages processed between clearing the queues.')
+    parser.add_argument(
+        '--seed', dest='seed', type=int, default=135,
+        help='Seed for the message generator.')
+    args = parser.parse_args()
+
+    messages = generate_messages(args.clients, args.channels, args.messages,
+                                 args.command_ratio, args.seed)
+
+    print('{:<10} {:>16}'.format('path', 'messages/s'))
+    # The legacy handler prints every message, like the handler used to,
+    # which we don't want on the screen.
+    with open(os.devnull, 'w') as devnull:
+        for name, handler_class in HANDLERS:
+            with contextlib.redirect_stdout(devnull):
+                rate = bench(handler_class, messages, args.clients,
+                             args.channels, args.messages_per_tick)
+
+            print('{:<10} {:>16.0f}'.format(name, rate))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+"""
+Compares the event loop backends of the chat server.
+
+For every backend and connection count, a server is started in a subprocess
+and the given number of clients connect to it. None of the clients join a
+channel, so every message that a client sends is answered by exactly one
+server message. This lets us measure the cost of a server wakeup without
+channel fan-out getting in the way.
+
+  idle:   all clients are connected but only one of them talks to the
+          server. Reports the mean round trip time of a single message.
+  active: every client sends a message each round. Reports the number of
+          messages that the server answers per second.
+
+Run it from the proj1_chat directory:
+
+    $ python -m benchmarks.bench_event_loops
+"""
+
+from __future__ import print_function
+
+import argparse
+import selectors
+import socket
+import time
+
+import event_loops
+import utils
+from benchmarks.common import (connect_clients, find_free_port, pad,
+                               raise_file_limit, receive_replies,
+                               start_server)
+
+
+def bench_idle(clients, round_trips):
+    selector = selectors.DefaultSelector()
+    talker = clients[0]
+    selector.register(talker, selectors.EVENT_READ)
+
+    message = pad('ping')
+    start = time.time()
+    for _ in range(round_trips):
+        talker.sendall(message)
+        receive_replies(selector, {talker: utils.MESSAGE_LENGTH}, 10)
+    elapsed = time.time() - start
+
+    selector.close()
+
+    return elapsed / round_trips
+
+
+def bench_active(clients, rounds):
+    selector = selectors.DefaultSelector()
+    for client_socket in clients:
+        selector.register(client_socket, selectors.EVENT_READ)
+
+    message = pad('ping')
+    expected_bytes = dict((s, utils.MESSAGE_LENGTH) for s in clients)
+    start = time.time()
+    for _ in range(rounds):
+        for client_socket in clients:
+            client_socket.sendall(message)
+        receive_replies(selector, expected_bytes, 60)
+    elapsed = time.time() - start
+
+    selector.close()
+
+    return (len(clients) * rounds) / elapsed
+
+
+def run_case(backend, num_clients, round_trips, rounds):
+    port = find_free_port()
+    server = start_server(port, ['--event-loop', backend])
+    clients = list()
+    try:
+        clients = connect_clients(port, num_clients)
+        idle_rtt = bench_idle(clients, round_trips)
+        active_rate = bench_active(clients, rounds)
+
+        return idle_rtt, active_rate
+    finally:
+        for client_socket in clients:
+            client_socket.close()
+
+        server.kill()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the chat server event loop backends.')
+    parser.add_argument(
+        '--clients', dest='clients', type=int, nargs='+',
+        default=[100, 1000, 10000],
+        help='Connection counts to benchmark.')
+    parser.add_argument(
+        '--backends', dest='backends', nargs='+',
+        choices=sorted(event_loops.EVENT_LOOPS.keys()),
+        default=sorted(event_loops.EVENT_LOOPS.keys()),
+        help='Event loop backends to benchmark.')
+    parser.add_argument(
+        '--round-trips', dest='round_trips', type=int, default=500,
+        help='Number of round trips made by the talker in the idle case.')
+    parser.add_argument(
+        '--rounds', dest='rounds', type=int, default=5,
+        help='Number of rounds where every client sends a message.')
+    args = parser.parse_args()
+
+    raise_file_limit()
+
+    print('{:<10} {:>8} {:>16} {:>18}'.format(
+        'backend', 'clients', 'idle RTT (us)', 'active (msg/s)'))
+    for num_clients in args.clients:
+        for backend in args.backends:
+            try:
+                idle_rtt, active_rate = run_case(backend, num_clients,
+                                                 args.round_trips,
+                                                 args.rounds)
+            except (RuntimeError, socket.error) as e:
+                print('{:<10} {:>8} {:>16} {:>18}  ({})'.format(
+                    backend, num_clients, 'failed', 'failed', e))
+                continue
+
+            print('{:<10} {:>8} {:>16.1f} {:>18.0f}'.format(
+                backend, num_clients, idle_rtt * 1e6, active_rate))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+"""
+Measures the cost of fanning channel messages out to their recipients as the
+channel grows.
+
+Every tick, a few messages are added to a channel and sent to every member.
+Two paths are compared:
+
+  legacy:      pads and encodes each message once per recipient and calls
+               send() for every (recipient, message) pair, like the server
+               used to.
+  encode-once: the server's own path. Each message is encoded once and its
+               bytes are shared by all recipients, which get their messages
+               in one sendmsg() call.
+
+The clients are socketpairs, so the sends are real system calls.
+
+Run it from the proj1_chat directory:
+
+    $ python -m benchmarks.bench_fanout
+"""
+
+from __future__ import print_function
+
+import argparse
+import socket
+import time
+
+import event_loops
+import server as chat_server
+
+
+def create_channel(num_clients):
+    # Builds a server whose only channel has the given number of members,
+    # without starting it.
+    server = chat_server.Server(0, event_loops.SelectorsEventLoop())
+    server.irc_handler.add_channel('bench')
+
+    peers = list()
+    for i in range(num_clients):
+        server_side, client_side = socket.socketpair()
+        server_side.setblocking(False)
+        client_side.setblocking(False)
+
+        connection = chat_server.Connection(
+            server_side, 'localhost',
+            chat_server.outbound_queue.OutboundQueue()
+        )
+        server.event_loop.register(server_side, event_loops.EVENT_READ)
+        server.connections.add(connection)
+        server.create_client(connection, 'client{}'.format(i))
+        server.irc_handler.add_client_to_channel(connection.client, 'bench')
+
+        peers.append(client_side)
+
+    return server, peers
+
+
+def drain(peers):
+    for peer in peers:
+        try:
+            while peer.recv(65536):
+                pass
+        except BlockingIOError:
+            pass
+
+
+def add_messages(channel, messages_per_tick):
+    for i in range(messages_per_tick):
+        channel.add_message('client0', '[client0] message {}'.format(i))
+
+
+def legacy_fan_out(server, channel):
+    for client in channel.clients.values():
+        for message in channel.messages:
+            if message.sender_client_name != client.name:
+                connection = server.connections.get_by_name(client.name)
+                connection.socket.send(
+                    chat_server.pad_message(message.message).encode('utf-8')
+                )
+
+    channel.clear_messages()
+
+
+def encode_once_fan_out(server, channel):
+    server.send_messages()
+    server.flush_queued_connections()
+
+
+def bench(fan_out, num_clients, messages_per_tick, ticks):
+    server, peers = create_channel(num_clients)
+    channel = server.irc_handler.channels['bench']
+
+    elapsed = 0
+    for _ in range(ticks):
+        add_messages(channel, messages_per_tick)
+
+        start = time.perf_counter()
+        fan_out(server, channel)
+        elapsed += time.perf_counter() - start
+
+        drain(peers)
+
+    for connection in server.connections:
+        connection.socket.close()
+    for peer in peers:
+        peer.close()
+    server.event_loop.close()
+
+    return elapsed / ticks
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark channel message fan-out.')
+    parser.add_argument(
+        '--channel-sizes', dest='channel_sizes', type=int, nargs='+',
+        default=[10, 100, 500, 1000],
+        help='Number of clients in the channel.')
+    parser.add_argument(
+        '--messages-per-tick', dest='messages_per_tick', type=int, default=5,
+        help='Number of messages sent to the channel every tick.')
+    parser.add_argument(
+        '--ticks', dest='ticks', type=int, default=50,
+        help='Number of ticks to average over.')
+    args = parser.parse_args()
+
+    fan_outs = [('legacy', legacy_fan_out),
+                ('encode-once', encode_once_fan_out)]
+
+    print('{:<12} {:>8} {:>14} {:>20}'.format(
+        'path', 'clients', 'tick (us)', 'per recipient (us)'))
+    for num_clients in args.channel_sizes:
+        for name, fan_out in fan_outs:
+            tick_time = bench(fan_out, num_clients, args.messages_per_tick,
+                              args.ticks)
+
+            print('{:<12} {:>8} {:>14.1f} {:>20.2f}'.format(
+                name, num_clients, tick_time * 1e6,
+                tick_time * 1e6 / num_clients))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+"""
+Compares the fixed 200-byte framing with the length-prefixed one on chat-like
+traffic.
+
+Messages are made of common words, and most of them are short, with a long
+tail of longer ones, like what people type in a chat. Every message goes
+through each framing, and the resulting stream is cut into chunks of random
+sizes, like what recv() hands back, before it is parsed again.
+
+Reports the bytes on the wire per message and the time it takes to parse a
+message out of the stream.
+
+Run it from the proj1_chat directory:
+
+    $ python -m benchmarks.bench_framing
+"""
+
+from __future__ import print_function
+
+import argparse
+import random
+import time
+
+import framing
+import utils
+
+
+WORDS = ('the', 'a', 'to', 'and', 'is', 'it', 'you', 'i', 'that', 'lol',
+         'ok', 'what', 'for', 'on', 'this', 'meeting', 'tomorrow', 'server',
+         'deploy', 'thanks', 'yeah', 'can', 'someone', 'review', 'my',
+         'branch', 'please', 'hello', 'everyone', 'lunch', 'build', 'broke')
+
+
+def generate_messages(num_messages, seed):
+    # Message lengths, in words, are exponentially distributed: lots
+    # of one-liners, and every now and then a paragraph.
+    rng = random.Random(seed)
+    messages = list()
+    for _ in range(num_messages):
+        num_words = min(int(rng.expovariate(1 / 8.0)) + 1, 40)
+        message = ' '.join(rng.choice(WORDS) for _ in range(num_words))
+        messages.append(message[:utils.MESSAGE_LENGTH])
+
+    return messages
+
+
+def split_stream(stream, seed, max_chunk_size=4096):
+    rng = random.Random(seed)
+    chunks = list()
+    offset = 0
+    while offset < len(stream):
+        chunk_size = rng.randint(1, max_chunk_size)
+        chunks.append(stream[offset:offset + chunk_size])
+        offset += chunk_size
+
+    return chunks
+
+
+def bench_parse(message_framing, chunks, repeats):
+    best = float('inf')
+    for _ in range(repeats):
+        frame_buffer = message_framing.create_buffer()
+        start = time.perf_counter()
+        for chunk in chunks:
+            for frame in frame_buffer.feed(chunk):
+                message_framing.decode(frame)
+        best = min(best, time.perf_counter() - start)
+
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the chat message framings.')
+    parser.add_argument(
+        '--messages', dest='messages', type=int, default=100000,
+        help='Number of messages to encode and parse.')
+    parser.add_argument(
+        '--repeats', dest='repeats', type=int, default=5,
+        help='Number of times to parse the stream. The best time is kept.')
+    parser.add_argument(
+        '--seed', dest='seed', type=int, default=135,
+        help='Seed for the message generator.')
+    args = parser.parse_args()
+
+    messages = generate_messages(args.messages, args.seed)
+    mean_length = sum(len(m) for m in messages) / float(len(messages))
+    print('{} messages, {:.1f} characters long on average.'.format(
+        len(messages), mean_length))
+
+    print('{:<16} {:>14} {:>18}'.format(
+        'framing', 'bytes/message', 'parse (us/message)'))
+    results = dict()
+    for message_framing in (framing.FIXED_LENGTH, framing.LENGTH_PREFIXED):
+        stream = b''.join(message_framing.encode(m) for m in messages)
+        chunks = split_stream(stream, args.seed)
+        parse_time = bench_parse(message_framing, chunks, args.repeats)
+
+        results[message_framing.name] = (len(stream), parse_time)
+        print('{:<16} {:>14.1f} {:>18.3f}'.format(
+            message_framing.name, len(stream) / float(len(messages)),
+            parse_time * 1e6 / len(messages)))
+
+    fixed_bytes, fixed_time = results[framing.FIXED_LENGTH.name]
+    prefixed_bytes, prefixed_time = results[framing.LENGTH_PREFIXED.name]
+    print('Length-prefixed framing sends {:.1f}% fewer bytes '.format(
+        100 * (1 - prefixed_bytes / float(fixed_bytes)))
+        + 'and parses {:.2f}x as fast.'.format(fixed_time / prefixed_time))
+
+
+if __name__ == '__main__':
+    main()
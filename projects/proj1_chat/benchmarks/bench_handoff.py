@@ -0,0 +1,132 @@
+"""
+Measures how long clients wait while a new server process takes over from a
+running one, with server.py --handoff.
+
+A load generator (benchmarks.loadgen) connects thousands of clients to the
+server, puts them in channels, and has them send messages at a steady rate.
+Halfway through, a new server is started with the same handoff path. It
+takes over the listening socket, every client socket, and a snapshot of the
+channels, and the old server exits. The load generator fails if any client
+is disconnected, so the numbers are only printed if none were.
+
+  pause:     the longest that any message took to arrive, which is about as
+             long as nobody was being served.
+  old / new: the time that each server spent on its half of the handoff,
+             from their logs.
+  snapshot:  the size of the snapshot of the connections and channels.
+
+Run it from the proj1_chat directory:
+
+    $ python -m benchmarks.bench_handoff
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+
+from benchmarks import loadgen
+from benchmarks.common import (SERVER_SCRIPT, find_free_port,
+                               raise_file_limit, start_server)
+
+
+HANDED_OFF = re.compile(r'Handed (\d+) connections and (\d+) channels off in '
+                        r'([\d.]+) ms, with a snapshot of (\d+) bytes')
+TOOK_OVER = re.compile(r'Took over \d+ connections and \d+ channels in '
+                       r'([\d.]+) ms')
+
+
+def search_log(log_file, pattern):
+    log_file.flush()
+    with open(log_file.name) as lines:
+        match = pattern.search(lines.read())
+    if match is None:
+        raise RuntimeError('No handoff in {}.'.format(log_file.name))
+
+    return match.groups()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the pause while a new server takes over.')
+    parser.add_argument(
+        '--clients', dest='clients', type=int, default=10000,
+        help='Number of clients.')
+    parser.add_argument(
+        '--channel-size', dest='channel_size', type=int, default=10,
+        help='Number of clients in each channel.')
+    parser.add_argument(
+        '--rate', dest='rate', type=float, default=1000,
+        help='Total number of messages sent per second.')
+    parser.add_argument(
+        '--duration', dest='duration', type=float, default=6,
+        help='Number of seconds to send messages for. The new server is '
+             + 'started halfway through.')
+    args = parser.parse_args()
+
+    raise_file_limit()
+
+    port = find_free_port()
+    directory = tempfile.mkdtemp(prefix='chat-handoff-')
+    handoff_path = os.path.join(directory, 'handoff.sock')
+    server_args = ['--handoff', handoff_path, '--summary-interval', '0']
+    old_log = open(os.path.join(directory, 'old.log'), 'w')
+    new_log = open(os.path.join(directory, 'new.log'), 'w')
+
+    old_server = start_server(port, server_args, stdout=old_log)
+    new_servers = list()
+
+    def start_new_server():
+        new_servers.append(subprocess.Popen(
+            [sys.executable, SERVER_SCRIPT, str(port)] + server_args,
+            stdout=new_log, stderr=subprocess.DEVNULL,
+            preexec_fn=raise_file_limit))
+
+    load_generator = loadgen.LoadGenerator('localhost', port, args.clients,
+                                           args.channel_size, args.rate,
+                                           args.duration)
+    timer = threading.Timer(args.duration / 2, start_new_server)
+    try:
+        load_generator.connect()
+        load_generator.join_channels()
+
+        timer.start()
+        report = load_generator.run()
+        pause = max(load_generator.latencies) / 1e6
+        old_server.wait(5)
+    finally:
+        timer.cancel()
+        load_generator.close()
+        for server in [old_server] + new_servers:
+            if server.poll() is None:
+                server.kill()
+            server.wait()
+
+    connections, channels, old_ms, snapshot_bytes = search_log(old_log,
+                                                               HANDED_OFF)
+    new_ms, = search_log(new_log, TOOK_OVER)
+    old_log.close()
+    new_log.close()
+    shutil.rmtree(directory)
+
+    print('Handed off:   {} connections, {} channels'.format(connections,
+                                                             channels))
+    print('Delivered:    {} of {}'.format(report['delivered'],
+                                          report['expected']))
+    print('Latency p50:  {:.3f} ms'.format(report['p50_ms']))
+    print('Latency p99:  {:.3f} ms'.format(report['p99_ms']))
+    print('Pause:        {:.1f} ms'.format(pause))
+    print('Old server:   {} ms'.format(old_ms))
+    print('New server:   {} ms'.format(new_ms))
+    print('Snapshot:     {} bytes ({:.1f} per connection)'.format(
+        snapshot_bytes, int(snapshot_bytes) / float(connections)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+"""
+Measures the memory used by the server's clients and queued channel messages.
+
+Clients are created the way the server creates them, from names decoded out
+of their frames, and spread over channels. Then messages are queued in the
+channels and encoded for the wire, as if the server were about to send them.
+Their sender names are decoded from relay records, the way a worker of the
+multicore server gets the messages of the other workers. tracemalloc reports
+what all of that takes, per client and per queued message.
+
+Three models are compared:
+
+  dict:           subclasses of the server's classes that get a __dict__
+                  for every instance back, like the model used to.
+  slotted:        the server's own __slots__ classes.
+  slotted+intern: the same, with the server's --intern-names option.
+
+Run it from the proj1_chat directory:
+
+    $ python -m benchmarks.bench_memory
+"""
+
+from __future__ import print_function
+
+import argparse
+import gc
+import tracemalloc
+
+import framing
+import server as chat_server
+
+
+class DictClient(chat_server.Client):
+    pass
+
+
+class DictChannel(chat_server.Channel):
+    pass
+
+
+class DictMessage(chat_server.Message):
+    # The old model kept every encoding in a dict of its own.
+    def encode(self, message_framing):
+        self._encodings = {message_framing.name:
+                           message_framing.encode(self.message)}
+
+        return self._encodings[message_framing.name]
+
+
+MODELS = {
+    'dict': (DictClient, DictChannel, DictMessage, False),
+    'slotted': (chat_server.Client, chat_server.Channel, chat_server.Message,
+                False),
+    'slotted+intern': (chat_server.Client, chat_server.Channel,
+                       chat_server.Message, True),
+}
+
+
+def decoded_name(prefix, i):
+    # Names read off the wire are new strings every time.
+    return framing.FIXED_LENGTH.decode(
+        framing.FIXED_LENGTH.encode('{}{}'.format(prefix, i)))
+
+
+def build_clients(model, num_clients, channel_size):
+    client_class, channel_class, _, intern_names = MODELS[model]
+    irc_handler = chat_server.IRCHandler(intern_names=intern_names)
+
+    channels = list()
+    for i in range(0, num_clients, channel_size):
+        name = irc_handler.intern_name(decoded_name('channel', i))
+        channel = channel_class(name)
+        irc_handler.channels[name] = channel
+        channels.append(channel)
+
+    for i in range(num_clients):
+        name = irc_handler.intern_name(decoded_name('client', i))
+        client = client_class(name, '127.0.0.1')
+        irc_handler.add_client(client)
+        irc_handler.add_client_to_channel(client,
+                                          channels[i // channel_size].name)
+
+    return irc_handler
+
+
+def queue_messages(model, irc_handler, num_messages):
+    message_class = MODELS[model][2]
+    clients = list(irc_handler.connected_clients.values())
+
+    for i in range(num_messages):
+        client = clients[i % len(clients)]
+        sender_client_name = irc_handler.intern_name(
+            decoded_name('client', i % len(clients)))
+        message = message_class(
+            sender_client_name,
+            '[{}] message number {}'.format(sender_client_name, i))
+        message.encode(framing.FIXED_LENGTH)
+        client.channel.messages.append(message)
+
+
+def measure(build):
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+
+    result = build()
+
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    return result, after - before
+
+
+def bench(model, num_clients, channel_size, num_messages):
+    irc_handler, client_bytes = measure(
+        lambda: build_clients(model, num_clients, channel_size))
+    _, message_bytes = measure(
+        lambda: queue_messages(model, irc_handler, num_messages))
+
+    return (client_bytes / float(num_clients),
+            message_bytes / float(num_messages))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the memory used by clients and messages.')
+    parser.add_argument(
+        '--clients', dest='clients', type=int, default=20000,
+        help='Number of clients.')
+    parser.add_argument(
+        '--channel-size', dest='channel_size', type=int, default=10,
+        help='Number of clients in each channel.')
+    parser.add_argument(
+        '--messages', dest='messages', type=int, default=100000,
+        help='Number of queued messages.')
+    args = parser.parse_args()
+
+    print('{:<16} {:>18} {:>20}'.format('model', 'bytes per client',
+                                        'bytes per message'))
+    for model in ('dict', 'slotted', 'slotted+intern'):
+        client_bytes, message_bytes = bench(model, args.clients,
+                                            args.channel_size, args.messages)
+        print('{:<16} {:>18.1f} {:>20.1f}'.format(model, client_bytes,
+                                                  message_bytes))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+"""
+Measures how the throughput of the multicore chat server scales with the
+number of workers.
+
+Uses the same channel load as bench_servers: clients are split into channels
+of a fixed size and every client sends one message per round. Clients land
+on workers at random, so most channels span several workers and their
+messages go through the relay links.
+
+Run it from the proj1_chat directory:
+
+    $ python -m benchmarks.bench_multicore
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import socket
+
+from benchmarks.bench_servers import bench_rounds, join_channels
+from benchmarks.common import (SERVER_SCRIPT, connect_clients,
+                               find_free_port, raise_file_limit, start_server)
+
+
+MULTICORE_SERVER_SCRIPT = os.path.join(os.path.dirname(SERVER_SCRIPT),
+                                       'multicore_server.py')
+
+
+def run_case(num_workers, num_clients, channel_size, rounds):
+    port = find_free_port()
+    server = start_server(port, ['--workers', str(num_workers)],
+                          MULTICORE_SERVER_SCRIPT)
+    clients = list()
+    try:
+        clients = connect_clients(port, num_clients)
+        channels = join_channels(clients, channel_size)
+
+        return bench_rounds(channels, rounds)
+    finally:
+        for client_socket in clients:
+            client_socket.close()
+
+        # The server shuts its workers down on SIGINT.
+        server.send_signal(2)
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the multicore chat server.')
+    parser.add_argument(
+        '--workers', dest='workers', type=int, nargs='+',
+        default=sorted(set([1, 2, 4, os.cpu_count()])),
+        help='Worker counts to benchmark.')
+    parser.add_argument(
+        '--clients', dest='clients', type=int, default=1000,
+        help='Number of clients.')
+    parser.add_argument(
+        '--channel-size', dest='channel_size', type=int, default=10,
+        help='Number of clients in each channel.')
+    parser.add_argument(
+        '--rounds', dest='rounds', type=int, default=10,
+        help='Number of rounds where every client sends a message.')
+    args = parser.parse_args()
+
+    raise_file_limit()
+
+    print('{} CPUs available.'.format(os.cpu_count()))
+    print('{:>8} {:>18} {:>14}'.format(
+        'workers', 'delivered (msg/s)', 'round (ms)'))
+    for num_workers in args.workers:
+        try:
+            rate, round_time = run_case(num_workers, args.clients,
+                                        args.channel_size, args.rounds)
+        except (RuntimeError, socket.error) as e:
+            print('{:>8} {:>18} {:>14}  ({})'.format(
+                num_workers, 'failed', 'failed', e))
+            continue
+
+        print('{:>8} {:>18.0f} {:>14.2f}'.format(
+            num_workers, rate, round_time * 1e3))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+"""
+Measures how much one client flooding the server hurts the latency of
+everyone else, with and without rate limits.
+
+A load generator (benchmarks.loadgen) runs well-behaved clients that send to
+their channels at a steady rate, and measures how long their messages take to
+arrive. Alongside them, in a process of its own, an abusive client joins the
+first channel and sends messages as fast as the server takes them. Three
+runs are compared:
+
+  baseline: the well-behaved clients on their own.
+  flood:    with the abusive client, and no rate limits. Every message that
+            it sends is fanned out to its channel, so the server spends most
+            of its time on it.
+  limited:  with the abusive client, and a per-client rate limit that drops
+            whatever goes over it. The flood still has to be read, but it
+            goes no further than the token bucket.
+
+Run it from the proj1_chat directory:
+
+    $ python -m benchmarks.bench_rate_limit
+"""
+
+from __future__ import print_function
+
+import argparse
+import multiprocessing
+import socket
+import threading
+
+from benchmarks import loadgen
+from benchmarks.common import find_free_port, pad, start_server
+
+
+MODES = ('baseline', 'flood', 'limited')
+
+ABUSER_NAME = 'abuser'
+
+# Number of messages that the abusive client sends in each sendall().
+FLOOD_BATCH_SIZE = 100
+
+
+def flood(port, channel, stop_event):
+    # Joins channel and floods it until stop_event is set. Whatever the
+    # server sends back is read and thrown away, so that the client isn't
+    # kicked off for being a slow consumer instead.
+    client_socket = socket.create_connection(('localhost', port))
+    client_socket.sendall(pad(ABUSER_NAME) + pad('/join {}'.format(channel)))
+
+    def drain():
+        try:
+            while client_socket.recv(65536):
+                pass
+        except socket.error:
+            pass
+
+    reader = threading.Thread(target=drain)
+    reader.daemon = True
+    reader.start()
+
+    batch = b''.join(pad('spam {}'.format(i))
+                     for i in range(FLOOD_BATCH_SIZE))
+    try:
+        while not stop_event.is_set():
+            client_socket.sendall(batch)
+    except socket.error:
+        pass
+    finally:
+        client_socket.close()
+
+
+def bench(mode, args):
+    server_args = ['--history-length', '0']
+    if mode == 'limited':
+        server_args += ['--client-rate', str(args.client_rate),
+                        '--rate-limit-action', 'drop']
+
+    port = find_free_port()
+    server = start_server(port, server_args)
+    load_generator = loadgen.LoadGenerator('localhost', port, args.clients,
+                                           args.channel_size, args.rate,
+                                           args.duration, server.pid)
+    stop_event = multiprocessing.Event()
+    abuser = None
+    try:
+        load_generator.connect()
+        load_generator.join_channels()
+
+        if mode != 'baseline':
+            abuser = multiprocessing.Process(target=flood,
+                                             args=(port, 'loadgen0',
+                                                   stop_event))
+            abuser.start()
+
+        return load_generator.run()
+    finally:
+        stop_event.set()
+        if abuser is not None:
+            abuser.join(5)
+            if abuser.is_alive():
+                abuser.terminate()
+
+        load_generator.close()
+        server.kill()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the latency of well-behaved clients next to '
+                    + 'one that floods the server.')
+    parser.add_argument(
+        '--clients', dest='clients', type=int, default=100,
+        help='Number of well-behaved clients.')
+    parser.add_argument(
+        '--channel-size', dest='channel_size', type=int, default=10,
+        help='Number of clients in each channel.')
+    parser.add_argument(
+        '--rate', dest='rate', type=float, default=500,
+        help='Total number of messages sent per second by the well-behaved '
+             + 'clients.')
+    parser.add_argument(
+        '--duration', dest='duration', type=float, default=5,
+        help='Number of seconds to send messages for in each run.')
+    parser.add_argument(
+        '--client-rate', dest='client_rate', type=float, default=20,
+        help='Messages per second that each client may send in the limited '
+             + 'run.')
+    args = parser.parse_args()
+
+    if args.rate / args.clients > args.client_rate:
+        parser.error('the well-behaved clients would go over --client-rate')
+
+    print('{:<9} {:>10} {:>10} {:>11} {:>10}'.format(
+        'mode', 'p50 (ms)', 'p99 (ms)', 'delivered', 'cpu'))
+    for mode in MODES:
+        report = bench(mode, args)
+
+        cpu = '-'
+        if report['server_cpu'] is not None:
+            cpu = '{:.0f}%'.format(report['server_cpu'] * 100)
+        print('{:<9} {:>10.3f} {:>10.3f} {:>10.1f}% {:>10}'.format(
+            mode, report['p50_ms'], report['p99_ms'],
+            100.0 * report['delivered'] / max(report['expected'], 1), cpu))
+
+
+if __name__ == '__main__':
+    main()
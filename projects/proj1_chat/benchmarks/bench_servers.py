@@ -0,0 +1,156 @@
+"""
+Compares the select-based chat server against the asyncio one.
+
+Clients are split into channels of a fixed size. Every round, each client
+sends one message to its channel and waits for the messages of everyone else
+in it. Reports the number of messages delivered per second and the mean time
+of a round.
+
+  select:    server.py with the legacy select.select() event loop.
+  selectors: server.py with the default selectors event loop.
+  asyncio:   async_server.py.
+
+Run it from the proj1_chat directory:
+
+    $ python -m benchmarks.bench_servers
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import selectors
+import socket
+import time
+
+import utils
+from benchmarks.common import (SERVER_SCRIPT, connect_clients,
+                               find_free_port, pad, raise_file_limit,
+                               receive_replies, start_server)
+
+
+ASYNC_SERVER_SCRIPT = os.path.join(os.path.dirname(SERVER_SCRIPT),
+                                   'async_server.py')
+
+SERVERS = {
+    'select': (SERVER_SCRIPT, ['--event-loop', 'select']),
+    'selectors': (SERVER_SCRIPT, ['--event-loop', 'selectors']),
+    'asyncio': (ASYNC_SERVER_SCRIPT, []),
+}
+
+
+def drain(clients, quiet_time=0.3):
+    # Reads everything the server sends until it goes quiet for a while.
+    selector = selectors.DefaultSelector()
+    for client_socket in clients:
+        selector.register(client_socket, selectors.EVENT_READ)
+
+    while True:
+        ready = selector.select(quiet_time)
+        if not ready:
+            break
+
+        for key, _ in ready:
+            if not key.fileobj.recv(65536):
+                raise RuntimeError('Server closed a connection.')
+
+    selector.close()
+
+
+def join_channels(clients, channel_size):
+    channels = [clients[i:i + channel_size]
+                for i in range(0, len(clients), channel_size)]
+    for i, members in enumerate(channels):
+        members[0].sendall(pad('/create channel{}'.format(i)))
+    drain(clients)
+
+    for i, members in enumerate(channels):
+        for client_socket in members:
+            client_socket.sendall(pad('/join channel{}'.format(i)))
+    drain(clients)
+
+    return channels
+
+
+def bench_rounds(channels, rounds):
+    selector = selectors.DefaultSelector()
+    expected_bytes = dict()
+    for members in channels:
+        for client_socket in members:
+            selector.register(client_socket, selectors.EVENT_READ)
+            expected_bytes[client_socket] = \
+                (len(members) - 1) * utils.MESSAGE_LENGTH
+    expected_bytes = dict((s, n) for s, n in expected_bytes.items() if n > 0)
+
+    message = pad('Hello!')
+    start = time.time()
+    for _ in range(rounds):
+        for members in channels:
+            for client_socket in members:
+                client_socket.sendall(message)
+        receive_replies(selector, expected_bytes, 120)
+    elapsed = time.time() - start
+
+    selector.close()
+
+    num_delivered = sum(expected_bytes.values()) // utils.MESSAGE_LENGTH
+    return (num_delivered * rounds) / elapsed, elapsed / rounds
+
+
+def run_case(server_name, num_clients, channel_size, rounds):
+    script, args = SERVERS[server_name]
+    port = find_free_port()
+    server = start_server(port, args, script)
+    clients = list()
+    try:
+        clients = connect_clients(port, num_clients)
+        channels = join_channels(clients, channel_size)
+
+        return bench_rounds(channels, rounds)
+    finally:
+        for client_socket in clients:
+            client_socket.close()
+
+        server.kill()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the select-based and asyncio chat servers.')
+    parser.add_argument(
+        '--clients', dest='clients', type=int, nargs='+',
+        default=[100, 1000],
+        help='Client counts to benchmark.')
+    parser.add_argument(
+        '--channel-size', dest='channel_size', type=int, default=10,
+        help='Number of clients in each channel.')
+    parser.add_argument(
+        '--servers', dest='servers', nargs='+',
+        choices=sorted(SERVERS.keys()), default=sorted(SERVERS.keys()),
+        help='Servers to benchmark.')
+    parser.add_argument(
+        '--rounds', dest='rounds', type=int, default=10,
+        help='Number of rounds where every client sends a message.')
+    args = parser.parse_args()
+
+    raise_file_limit()
+
+    print('{:<10} {:>8} {:>18} {:>14}'.format(
+        'server', 'clients', 'delivered (msg/s)', 'round (ms)'))
+    for num_clients in args.clients:
+        for server_name in args.servers:
+            try:
+                rate, round_time = run_case(server_name, num_clients,
+                                            args.channel_size, args.rounds)
+            except (RuntimeError, socket.error) as e:
+                print('{:<10} {:>8} {:>18} {:>14}  ({})'.format(
+                    server_name, num_clients, 'failed', 'failed', e))
+                continue
+
+            print('{:<10} {:>8} {:>18.0f} {:>14.2f}'.format(
+                server_name, num_clients, rate, round_time * 1e3))
+
+
+if __name__ == '__main__':
+    main()
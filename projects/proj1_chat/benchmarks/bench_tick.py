@@ -0,0 +1,161 @@
+"""
+Measures what Server.send_messages() costs per tick when most channels are
+idle.
+
+The server has many channels, but every tick only a few of them get a
+message. Each active channel has a couple of members, which are socketpairs
+so that the sends are real system calls. Two paths are compared:
+
+  legacy:  goes through every channel there is after every wakeup, like the
+           server used to, whether or not it has anything to send.
+  pending: the server's own path. Channels add themselves to a set of
+           pending channels when they get a message, and only those are
+           gone through.
+
+Run it from the proj1_chat directory:
+
+    $ python -m benchmarks.bench_tick
+"""
+
+from __future__ import print_function
+
+import argparse
+import random
+import socket
+import time
+
+import event_loops
+import server as chat_server
+
+
+class LegacyServer(chat_server.Server):
+    def send_messages(self):
+        for server_message in self.irc_handler.server_messages:
+            self.queue_message(server_message.sender_client_name,
+                               server_message)
+
+        self.irc_handler.clear_server_messages()
+
+        for channel in self.irc_handler.channels.values():
+            for message in channel.messages:
+                for client in channel.clients.values():
+                    if message.sender_client_name != client.name:
+                        self.queue_message(client.name, message)
+
+            channel.clear_messages()
+
+        for connection in self._slow_connections:
+            self.disconnect(connection)
+
+        self._slow_connections.clear()
+
+
+SERVERS = [('legacy', LegacyServer), ('pending', chat_server.Server)]
+
+
+def create_server(server_class, num_channels, num_active_channels,
+                  members_per_channel):
+    # Builds a server with num_channels channels, without starting it. Only
+    # the first num_active_channels get members, since the others never get
+    # a message anyway.
+    server = server_class(0, event_loops.SelectorsEventLoop(),
+                          history_length=0)
+    for i in range(num_channels):
+        server.irc_handler.add_channel('room{}'.format(i))
+
+    peers = list()
+    for i in range(num_active_channels * members_per_channel):
+        server_side, client_side = socket.socketpair()
+        server_side.setblocking(False)
+        client_side.setblocking(False)
+
+        connection = chat_server.Connection(
+            server_side, 'localhost',
+            chat_server.outbound_queue.OutboundQueue()
+        )
+        server.connections.add(connection)
+        server.create_client(connection, 'client{}'.format(i))
+        server.irc_handler.add_client_to_channel(
+            connection.client, 'room{}'.format(i // members_per_channel))
+
+        peers.append(client_side)
+
+    return server, peers
+
+
+def drain(peers):
+    for peer in peers:
+        try:
+            while peer.recv(65536):
+                pass
+        except BlockingIOError:
+            pass
+
+
+def bench(server_class, num_channels, num_active_channels,
+          members_per_channel, messages_per_tick, ticks, seed):
+    server, peers = create_server(server_class, num_channels,
+                                  num_active_channels, members_per_channel)
+    rng = random.Random(seed)
+
+    elapsed = 0
+    for _ in range(ticks):
+        for _ in range(messages_per_tick):
+            i = rng.randrange(num_active_channels)
+            channel = server.irc_handler.channels['room{}'.format(i)]
+            channel.add_message('client{}'.format(i * members_per_channel),
+                                'the build is green again')
+
+        start = time.perf_counter()
+        server.send_messages()
+        server.flush_queued_connections()
+        elapsed += time.perf_counter() - start
+
+        drain(peers)
+
+    for connection in server.connections:
+        connection.socket.close()
+    for peer in peers:
+        peer.close()
+    server.event_loop.close()
+
+    return elapsed / ticks
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the cost of a tick with mostly idle channels.')
+    parser.add_argument(
+        '--channels', dest='channels', type=int, nargs='+',
+        default=[100, 1000, 10000],
+        help='Number of channels.')
+    parser.add_argument(
+        '--active-channels', dest='active_channels', type=int, default=10,
+        help='Number of channels that get messages.')
+    parser.add_argument(
+        '--members', dest='members', type=int, default=2,
+        help='Number of clients in each active channel.')
+    parser.add_argument(
+        '--messages-per-tick', dest='messages_per_tick', type=int, default=2,
+        help='Number of messages sent to the active channels every tick.')
+    parser.add_argument(
+        '--ticks', dest='ticks', type=int, default=1000,
+        help='Number of ticks to average over.')
+    parser.add_argument(
+        '--seed', dest='seed', type=int, default=135,
+        help='Seed for picking the channels that get messages.')
+    args = parser.parse_args()
+
+    print('{:<8} {:>10} {:>12}'.format('path', 'channels', 'tick (us)'))
+    for num_channels in args.channels:
+        for name, server_class in SERVERS:
+            tick_time = bench(server_class, num_channels,
+                              args.active_channels, args.members,
+                              args.messages_per_tick, args.ticks, args.seed)
+
+            print('{:<8} {:>10} {:>12.1f}'.format(name, num_channels,
+                                                  tick_time * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+"""
+Measures what keeping track of idle deadlines costs per tick, for many
+connections.
+
+Every tick, a few of the connections get data, and any connection that has
+had none for the idle timeout is reaped. Time is simulated, so that minutes
+of ticks run in seconds. Two paths are compared:
+
+  scan:  goes through every connection after every tick and checks how long
+         it has been quiet.
+  wheel: the server's own path. Every connection has a timer in a
+         timer_wheel.TimerWheel, which is only looked at when its deadline
+         comes. Getting data only stamps the connection, and a timer that
+         comes due for a connection that got data since it was set is set
+         again for the new deadline.
+
+Run it from the proj1_chat directory:
+
+    $ python -m benchmarks.bench_timers
+"""
+
+from __future__ import print_function
+
+import argparse
+import random
+import time
+
+import timer_wheel
+
+
+class _Connection(object):
+    __slots__ = ('last_active', 'reaped')
+
+    def __init__(self):
+        self.last_active = 0
+        self.reaped = False
+
+
+class ScanTracker(object):
+    def __init__(self, connections, idle_timeout):
+        self.connections = connections
+        self.idle_timeout = idle_timeout
+        self.num_reaped = 0
+
+    def tick(self, now):
+        for connection in self.connections:
+            if (not connection.reaped
+                    and connection.last_active + self.idle_timeout <= now):
+                connection.reaped = True
+                self.num_reaped += 1
+
+
+class WheelTracker(object):
+    def __init__(self, connections, idle_timeout):
+        self.idle_timeout = idle_timeout
+        self.num_reaped = 0
+        self.now = 0
+        self.timers = timer_wheel.TimerWheel(now=0)
+        for connection in connections:
+            self._schedule(connection)
+
+    def tick(self, now):
+        self.now = now
+        self.timers.advance(now)
+
+    def _schedule(self, connection):
+        self.timers.schedule(connection.last_active + self.idle_timeout,
+                             lambda: self._check(connection))
+
+    def _check(self, connection):
+        if connection.last_active + self.idle_timeout > self.now:
+            self._schedule(connection)
+            return
+
+        connection.reaped = True
+        self.num_reaped += 1
+
+
+TRACKERS = [('scan', ScanTracker), ('wheel', WheelTracker)]
+
+
+def bench(tracker_class, num_connections, active_per_tick, idle_timeout,
+          tick_duration, num_ticks, seed):
+    # Returns the mean time of a tick, in seconds, and the number of
+    # connections that were reaped.
+    rng = random.Random(seed)
+    connections = [_Connection() for _ in range(num_connections)]
+    tracker = tracker_class(connections, idle_timeout)
+
+    elapsed = 0
+    now = 0
+    for _ in range(num_ticks):
+        now += tick_duration
+        for _ in range(active_per_tick):
+            connection = connections[rng.randrange(num_connections)]
+            if not connection.reaped:
+                connection.last_active = now
+
+        start = time.perf_counter()
+        tracker.tick(now)
+        elapsed += time.perf_counter() - start
+
+    return elapsed / num_ticks, tracker.num_reaped
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the cost of idle deadlines per tick.')
+    parser.add_argument(
+        '--connections', dest='connections', type=int, nargs='+',
+        default=[1000, 10000, 100000],
+        help='Number of connections.')
+    parser.add_argument(
+        '--active-per-tick', dest='active_per_tick', type=int, default=500,
+        help='Number of connections that get data every tick.')
+    parser.add_argument(
+        '--idle-timeout', dest='idle_timeout', type=float, default=60,
+        help='Simulated seconds after which a quiet connection is reaped.')
+    parser.add_argument(
+        '--tick', dest='tick', type=float, default=0.1,
+        help='Simulated seconds between ticks.')
+    parser.add_argument(
+        '--ticks', dest='ticks', type=int, default=1200,
+        help='Number of ticks to average over.')
+    parser.add_argument(
+        '--seed', dest='seed', type=int, default=135,
+        help='Seed for picking the connections that get data.')
+    args = parser.parse_args()
+
+    print('{:<6} {:>12} {:>12} {:>8}'.format('path', 'connections',
+                                             'tick (us)', 'reaped'))
+    for num_connections in args.connections:
+        for name, tracker_class in TRACKERS:
+            tick_time, num_reaped = bench(
+                tracker_class, num_connections, args.active_per_tick,
+                args.idle_timeout, args.tick, args.ticks, args.seed)
+
+            print('{:<6} {:>12} {:>12.1f} {:>8}'.format(
+                name, num_connections, tick_time * 1e6, num_reaped))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+"""
+Measures how fast clients can set up connections to the chat server, in the
+clear and over TLS, with and without resuming an earlier session.
+
+Each connection connects, sends its name and /list, and waits for the answer,
+so a connection only counts once the server is ready to chat over it. The
+server is server.py with a TLS listener whose certificate comes from a
+throwaway test CA. Three ways of connecting are compared:
+
+  plain:   TCP only, on the server's plain port.
+  full:    a full TLS handshake for every connection.
+  resumed: every connection resumes the session of the one before it with
+           a session ticket, which skips the certificate and most of the key
+           exchange.
+
+Run it from the proj1_chat directory:
+
+    $ python -m benchmarks.bench_tls
+"""
+
+from __future__ import print_function
+
+import argparse
+import shutil
+import socket
+import ssl
+import time
+
+import tls
+from benchmarks.common import find_free_port, pad, start_server
+
+
+MODES = ('plain', 'full', 'resumed')
+
+TLS_VERSIONS = {
+    '1.2': ssl.TLSVersion.TLSv1_2,
+    '1.3': ssl.TLSVersion.TLSv1_3,
+}
+
+
+def connect(port, context, session, name):
+    # Returns the session of the connection, or None for a plain one, and
+    # whether it resumed session.
+    client_socket = socket.create_connection(('localhost', port))
+    client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    if context is not None:
+        client_socket = context.wrap_socket(client_socket,
+                                            server_hostname='localhost',
+                                            session=session)
+
+    client_socket.sendall(pad(name) + pad('/list'))
+
+    # Session tickets arrive before the answer, so reading it also gets us a
+    # session to resume.
+    remaining = len(pad(''))
+    while remaining > 0:
+        data = client_socket.recv(remaining)
+        if not data:
+            raise RuntimeError('Server closed the connection.')
+        remaining -= len(data)
+
+    new_session = None
+    reused = False
+    if context is not None:
+        new_session = client_socket.session
+        reused = client_socket.session_reused
+    client_socket.close()
+
+    return new_session, reused
+
+
+def bench(mode, port, tls_port, context, num_connections):
+    # Returns the connection times in seconds, and the number of
+    # connections that resumed a session.
+    if mode == 'plain':
+        context = None
+    else:
+        port = tls_port
+
+    times = list()
+    num_resumed = 0
+    session = None
+    for i in range(num_connections):
+        start = time.perf_counter()
+        new_session, reused = connect(port, context, session,
+                                      'bench{}{}'.format(mode, i))
+        times.append(time.perf_counter() - start)
+
+        num_resumed += reused
+        if mode == 'resumed':
+            session = new_session
+
+    return times, num_resumed
+
+
+def percentile(sorted_values, fraction):
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * fraction))
+
+    return sorted_values[index]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark connection setup with and without TLS session '
+                    + 'resumption.')
+    parser.add_argument(
+        '--connections', dest='connections', type=int, default=1000,
+        help='Number of connections to set up for each mode.')
+    parser.add_argument(
+        '--tls-version', dest='tls_version', choices=sorted(TLS_VERSIONS),
+        default='1.3', help='TLS version that the clients use.')
+    parser.add_argument(
+        '--openssl', dest='openssl', default='openssl',
+        help='openssl command used to make the test certificates.')
+    args = parser.parse_args()
+
+    certificates = tls.create_test_certificates(openssl=args.openssl)
+    context = tls.create_client_context(certificates.ca_file)
+    context.minimum_version = TLS_VERSIONS[args.tls_version]
+    context.maximum_version = TLS_VERSIONS[args.tls_version]
+
+    port = find_free_port()
+    tls_port = find_free_port()
+    server = start_server(port, ['--tls-port', str(tls_port),
+                                 '--tls-cert', certificates.cert_file,
+                                 '--tls-key', certificates.key_file,
+                                 '--history-length', '0'])
+    try:
+        print('{:<8} {:>14} {:>10} {:>10} {:>8}'.format(
+            'mode', 'connections/s', 'p50 (ms)', 'p99 (ms)', 'resumed'))
+        for mode in MODES:
+            times, num_resumed = bench(mode, port, tls_port, context,
+                                       args.connections)
+            times.sort()
+
+            print('{:<8} {:>14.0f} {:>10.3f} {:>10.3f} {:>8}'.format(
+                mode, len(times) / sum(times),
+                percentile(times, 0.5) * 1000,
+                percentile(times, 0.99) * 1000,
+                num_resumed))
+    finally:
+        server.terminate()
+        server.wait()
+        shutil.rmtree(certificates.directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""Helpers shared by the chat server benchmarks."""
+
+from __future__ import print_function
+
+import os
+import resource
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+import utils
+
+
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'server.py')
+
+
+def pad(message):
+    return message.ljust(utils.MESSAGE_LENGTH).encode('utf-8')
+
+
+def find_free_port():
+    s = socket.socket()
+    s.bind(('localhost', 0))
+    port = s.getsockname()[1]
+    s.close()
+
+    return port
+
+
+def raise_file_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    return hard
+
+
+def start_server(port, args=(), script=SERVER_SCRIPT,
+                 stdout=subprocess.DEVNULL):
+    # Starts the server in a subprocess and waits until it accepts
+    # connections. The server logs every message, so its output is dropped,
+    # unless a file to write it to is given as stdout.
+    server = subprocess.Popen(
+        [sys.executable, script, str(port)] + list(args),
+        stdout=stdout,
+        stderr=subprocess.DEVNULL,
+        preexec_fn=raise_file_limit
+    )
+
+    # Wait for the server to start listening.
+    deadline = time.time() + 5
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('localhost', port)).close()
+            return server
+        except socket.error:
+            time.sleep(0.05)
+
+    server.kill()
+    raise RuntimeError('Server did not start listening on port {}.'.format(
+        port))
+
+
+def stop_server(server, timeout=5):
+    # Stops a server from start_server() with SIGINT, like a server stopped
+    # at the terminal, so that it closes what it has open, like its capture,
+    # on the way out. It is only killed if it does not stop in time.
+    server.send_signal(signal.SIGINT)
+    try:
+        server.wait(timeout)
+    except subprocess.TimeoutExpired:
+        server.kill()
+        server.wait()
+
+
+def connect_clients(port, num_clients, prefix='bench'):
+    clients = list()
+    for i in range(num_clients):
+        client_socket = socket.create_connection(('localhost', port))
+        client_socket.sendall(pad('{}{}'.format(prefix, i)))
+        clients.append(client_socket)
+
+    return clients
+
+
+def receive_replies(selector, expected_bytes, timeout):
+    # Wait until every socket in the selector has received its expected
+    # number of bytes.
+    remaining = dict(expected_bytes)
+    deadline = time.time() + timeout
+    while remaining:
+        if time.time() > deadline:
+            raise RuntimeError('Timed out waiting for server replies.')
+
+        for key, _ in selector.select(deadline - time.time()):
+            s = key.fileobj
+            data = s.recv(remaining[s])
+            if not data:
+                raise RuntimeError('Server closed a connection.')
+
+            remaining[s] -= len(data)
+            if remaining[s] == 0:
+                del remaining[s]
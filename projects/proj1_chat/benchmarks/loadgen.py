@@ -0,0 +1,386 @@
+"""
+Load generator for the chat server.
+
+Runs many headless chat clients (chat_client.ChatClient) on one event loop
+in a single process. The clients are split into channels, and then send messages
+to their channels at a fixed total rate. Every message carries the time it
+was sent, so the time it takes to reach each of the other members of the
+channel can be measured.
+
+Reports the end-to-end delivery latency (p50, p99, and p99.9), the number of
+messages sent and delivered per second, and the CPU time used by the server
+when its process ID is known (Linux only). The CPU time of the processes
+that the server started, like the workers of multicore_server.py, is
+counted too.
+
+Point it at a running server:
+
+    $ python -m benchmarks.loadgen --port 12345 --server-pid 4242
+
+Or let it start one:
+
+    $ python -m benchmarks.loadgen --spawn server.py --server-args="--event-loop select"
+
+The exit status is 1 when fewer messages are delivered than should have
+been (see --min-delivery-ratio), and, with --max-p99-ms or
+--min-delivered-rate, when the results are worse, so it can be used as a
+regression gate.
+"""
+
+from __future__ import print_function
+
+import argparse
+import collections
+import json
+import math
+import os
+import shlex
+import sys
+import time
+
+import chat_client
+from benchmarks.common import (find_free_port, raise_file_limit, start_server,
+                               stop_server)
+
+
+# Every load generator message starts with this, followed by the time it was
+# sent in nanoseconds.
+MESSAGE_TAG = 'lg'
+
+# Fraction of the expected messages that have to be delivered for a run to
+# pass.
+DEFAULT_MIN_DELIVERY_RATIO = 1.0
+
+
+class LoadClient(chat_client.ChatClient):
+    def __init__(self, *args, **kwargs):
+        chat_client.ChatClient.__init__(self, *args, **kwargs)
+        self.channel_size = 0
+
+
+class LoadGenerator(object):
+    def __init__(self, host, port, num_clients, channel_size, rate,
+                 duration, server_pid=None):
+        self.host = host
+        self.port = port
+        self.num_clients = num_clients
+        self.channel_size = channel_size
+        self.rate = rate
+        self.duration = duration
+        self.server_pid = server_pid
+
+        self.loop = chat_client.ClientLoop()
+        self.clients = list()
+        self.latencies = list()
+        self.num_sent = 0
+        self.num_expected = 0
+
+    def connect(self):
+        for i in range(self.num_clients):
+            client = LoadClient('loadgen{}'.format(i), self.host, self.port,
+                                self.loop, on_messages=self.receive,
+                                on_disconnect=self.lost_connection)
+            client.connect()
+            self.clients.append(client)
+
+            # Finish the connections that are up every now and then, rather
+            # than leaving thousands of them for later.
+            if i % 100 == 99:
+                self.pump(0)
+
+        self.pump_until_quiet()
+
+    def join_channels(self):
+        channels = [self.clients[i:i + self.channel_size]
+                    for i in range(0, len(self.clients), self.channel_size)]
+        for i, members in enumerate(channels):
+            self.send(members[0], '/create loadgen{}'.format(i))
+        self.pump_until_quiet()
+
+        for i, members in enumerate(channels):
+            for client in members:
+                client.channel_size = len(members)
+                self.send(client, '/join loadgen{}'.format(i))
+        self.pump_until_quiet()
+
+    def run(self):
+        cpu_start = read_cpu_time(self.server_pid)
+        start = time.perf_counter()
+        end = start + self.duration
+
+        # Clients take turns sending, so the load is spread evenly across
+        # the channels.
+        next_sender = 0
+        now = start
+        while now < end:
+            num_due = int((now - start) * self.rate) - self.num_sent
+            for _ in range(num_due):
+                client = self.clients[next_sender]
+                self.send(client, '{} {}'.format(MESSAGE_TAG,
+                                                 time.perf_counter_ns()))
+                self.num_sent += 1
+                self.num_expected += client.channel_size - 1
+                next_sender = (next_sender + 1) % len(self.clients)
+
+            self.pump(0.001)
+            now = time.perf_counter()
+
+        # Give the server some time to deliver what is still in flight.
+        drain_deadline = time.perf_counter() + max(2.0, self.duration / 2)
+        while (len(self.latencies) < self.num_expected
+               and time.perf_counter() < drain_deadline):
+            self.pump(0.01)
+
+        elapsed = time.perf_counter() - start
+        cpu_end = read_cpu_time(self.server_pid)
+
+        server_cpu = None
+        if cpu_start is not None and cpu_end is not None:
+            server_cpu = (cpu_end - cpu_start) / elapsed
+
+        return self.report(elapsed, server_cpu)
+
+    def send(self, client, message):
+        client.send_message(message)
+
+    def pump(self, timeout):
+        # Sends what is queued and handles whatever arrived. Returns whether
+        # anything happened.
+        return self.loop.poll(timeout) > 0
+
+    def pump_until_quiet(self, quiet_time=0.3):
+        last_activity = time.perf_counter()
+        while time.perf_counter() - last_activity < quiet_time:
+            if self.pump(0.01):
+                last_activity = time.perf_counter()
+
+    def receive(self, client, messages):
+        now = time.perf_counter_ns()
+        for message in messages:
+            # Channel messages look like "[sender] lg <time sent>".
+            fields = message.split()
+            if len(fields) == 3 and fields[1] == MESSAGE_TAG:
+                self.latencies.append(now - int(fields[2]))
+
+    def lost_connection(self, client):
+        raise RuntimeError('Server closed the connection of '
+                           + '{}.'.format(client.name))
+
+    def report(self, elapsed, server_cpu):
+        latencies = sorted(self.latencies)
+
+        return {
+            'clients': self.num_clients,
+            'channel_size': self.channel_size,
+            'elapsed_seconds': elapsed,
+            'sent': self.num_sent,
+            'delivered': len(latencies),
+            'expected': self.num_expected,
+            'sent_per_second': self.num_sent / elapsed,
+            'delivered_per_second': len(latencies) / elapsed,
+            'p50_ms': percentile(latencies, 0.5) / 1e6,
+            'p99_ms': percentile(latencies, 0.99) / 1e6,
+            'p999_ms': percentile(latencies, 0.999) / 1e6,
+            'server_cpu': server_cpu,
+        }
+
+    def close(self):
+        self.loop.close()
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return float('nan')
+
+    index = min(int(fraction * len(sorted_values)), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+def read_cpu_time(pid):
+    # Returns the user and system CPU time, in seconds, used so far by the
+    # given process and every process under it, like the workers of
+    # multicore_server.py, or None if we can't tell.
+    if pid is None:
+        return None
+
+    stats = read_process_stats()
+    if pid not in stats:
+        return None
+
+    children = collections.defaultdict(list)
+    for child_pid, (parent_pid, _) in stats.items():
+        children[parent_pid].append(child_pid)
+
+    clock_ticks = 0
+    pending = [pid]
+    while pending:
+        process_pid = pending.pop()
+        clock_ticks += stats[process_pid][1]
+        pending.extend(children[process_pid])
+
+    return clock_ticks / float(os.sysconf('SC_CLK_TCK'))
+
+
+def read_process_stats():
+    # Returns the parent process ID, and the CPU time in clock ticks, of
+    # every process, by process ID. The CPU time counts the children that
+    # a process has already waited for, but not the ones still running.
+    try:
+        names = os.listdir('/proc')
+    except OSError:
+        return dict()
+
+    stats = dict()
+    for name in names:
+        if not name.isdigit():
+            continue
+
+        try:
+            with open('/proc/{}/stat'.format(name)) as stat_file:
+                stat = stat_file.read()
+        except IOError:
+            # The process is already gone.
+            continue
+
+        # The process name may contain spaces, so we only split what comes
+        # after it. ppid is the 4th field, and utime, stime, cutime, and
+        # cstime are the 14th to the 17th.
+        fields = stat[stat.rindex(')') + 2:].split()
+        stats[int(name)] = (int(fields[1]),
+                            sum(int(field) for field in fields[11:15]))
+
+    return stats
+
+
+def check_report(report, max_p99_ms=None, min_delivered_rate=None,
+                 min_delivery_ratio=DEFAULT_MIN_DELIVERY_RATIO):
+    # Returns the reasons that the report fails the gates, if any. A run
+    # that delivered nothing has no latencies, and NaN is never over a
+    # limit, so that has to be caught on its own.
+    failures = list()
+    if report['expected'] > 0:
+        delivery_ratio = report['delivered'] / float(report['expected'])
+        if delivery_ratio < min_delivery_ratio:
+            failures.append('only {} of {} messages were delivered.'.format(
+                report['delivered'], report['expected']))
+
+    if max_p99_ms is not None:
+        if math.isnan(report['p99_ms']):
+            failures.append('no messages were delivered, so there is no p99 '
+                            + 'latency.')
+        elif report['p99_ms'] > max_p99_ms:
+            failures.append('p99 latency is over {} ms.'.format(max_p99_ms))
+
+    if (min_delivered_rate is not None
+            and report['delivered_per_second'] < min_delivered_rate):
+        failures.append('fewer than {} messages were '.format(
+            min_delivered_rate) + 'delivered per second.')
+
+    return failures
+
+
+def print_report(report):
+    print('Clients:          {} in channels of {}'.format(
+        report['clients'], report['channel_size']))
+    print('Sent:             {} ({:.0f} msg/s)'.format(
+        report['sent'], report['sent_per_second']))
+    print('Delivered:        {} of {} ({:.0f} msg/s)'.format(
+        report['delivered'], report['expected'],
+        report['delivered_per_second']))
+    print('Latency p50:      {:.3f} ms'.format(report['p50_ms']))
+    print('Latency p99:      {:.3f} ms'.format(report['p99_ms']))
+    print('Latency p99.9:    {:.3f} ms'.format(report['p999_ms']))
+    if report['server_cpu'] is not None:
+        print('Server CPU:       {:.1f}%'.format(report['server_cpu'] * 100))
+    else:
+        print('Server CPU:       unknown')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Generate load against the chat server.')
+    parser.add_argument(
+        '--host', dest='host', default='localhost',
+        help='Address of the server.')
+    parser.add_argument(
+        '--port', dest='port', type=int,
+        help='Port of the server. Required unless --spawn is used.')
+    parser.add_argument(
+        '--server-pid', dest='server_pid', type=int,
+        help='Process ID of the server, used to measure its CPU time.')
+    parser.add_argument(
+        '--spawn', dest='spawn',
+        help='Server script to start on a free port before generating load.')
+    parser.add_argument(
+        '--server-args', dest='server_args', default='',
+        help='Extra arguments for the script given to --spawn.')
+    parser.add_argument(
+        '--clients', dest='clients', type=int, default=1000,
+        help='Number of clients.')
+    parser.add_argument(
+        '--channel-size', dest='channel_size', type=int, default=10,
+        help='Number of clients in each channel.')
+    parser.add_argument(
+        '--rate', dest='rate', type=float, default=1000,
+        help='Total number of messages sent per second.')
+    parser.add_argument(
+        '--duration', dest='duration', type=float, default=10,
+        help='Number of seconds to send messages for.')
+    parser.add_argument(
+        '--json', dest='json', action='store_true',
+        help='Print the results as JSON.')
+    parser.add_argument(
+        '--max-p99-ms', dest='max_p99_ms', type=float,
+        help='Fail if the p99 latency is higher than this.')
+    parser.add_argument(
+        '--min-delivered-rate', dest='min_delivered_rate', type=float,
+        help='Fail if fewer messages than this are delivered per second.')
+    parser.add_argument(
+        '--min-delivery-ratio', dest='min_delivery_ratio', type=float,
+        default=DEFAULT_MIN_DELIVERY_RATIO,
+        help='Fail if less than this fraction of the messages that should '
+             + 'have been delivered were. Defaults to all of them.')
+    args = parser.parse_args()
+
+    if args.port is None and args.spawn is None:
+        parser.error('either --port or --spawn is required')
+
+    raise_file_limit()
+
+    server = None
+    port = args.port
+    server_pid = args.server_pid
+    if args.spawn is not None:
+        port = find_free_port()
+        server = start_server(port, shlex.split(args.server_args),
+                              os.path.abspath(args.spawn))
+        server_pid = server.pid
+
+    load_generator = LoadGenerator(args.host, port, args.clients,
+                                   args.channel_size, args.rate,
+                                   args.duration, server_pid)
+    try:
+        load_generator.connect()
+        load_generator.join_channels()
+        report = load_generator.run()
+    finally:
+        load_generator.close()
+
+        if server is not None:
+            stop_server(server)
+
+    if args.json:
+        print(json.dumps(report, indent=2, sort_keys=True))
+    else:
+        print_report(report)
+
+    failures = check_report(report, args.max_p99_ms, args.min_delivered_rate,
+                            args.min_delivery_ratio)
+    for failure in failures:
+        print('FAIL: {}'.format(failure), file=sys.stderr)
+
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
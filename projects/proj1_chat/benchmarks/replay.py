@@ -0,0 +1,562 @@
+"""
+Replays a session recorded with server.py --capture against a chat server.
+
+Every connection in the capture becomes a headless chat client
+(chat_client.ChatClient) with the name that it sent, and the framing that it
+asked for. The clients connect, send what was captured, and disconnect at
+the times that they did in the capture, divided by --speed. At max speed,
+everything is sent as fast as the server takes it. What each client sends
+stays in order. What different clients send may not, since it goes over
+different connections, so before and after a /create, /join, or /leave, and
+before a client disconnects, the clients that sent anything since the last
+such point send themselves a private message, and nothing else is sent
+until those come back. By then the server is done with what they sent
+before, so a /join never gets ahead of the /create of its channel, and chat
+messages go to the clients that they went to in the capture. These private
+messages are not counted.
+
+Clients run on one event loop, and their messages can only be told apart by
+their text, so a chat message is taken to arrive when another client gets
+it in a channel, and counts from the last time that its sender sent that
+text. Messages that a client gets from a channel's history, which were sent
+before it joined, are not counted. How many should be delivered is worked
+out beforehand by playing the capture through the server's own IRCHandler.
+
+Reports how long the replay took next to the capture, the frames sent, the
+messages delivered out of the ones that should have been and per second,
+the delivery latency (p50, p99, and p99.9), the clients that the server
+kicked off, and the CPU time used by the server when its process ID is known
+(Linux only).
+
+Point it at a running server:
+
+    $ python -m benchmarks.replay session.capture --port 12345 --speed 10
+
+Or let it start one:
+
+    $ python -m benchmarks.replay session.capture --spawn server.py --speed max
+
+The exit status is 1 when fewer messages were delivered than should have
+been (see --min-delivery-ratio), and, with --max-p99-ms or
+--min-delivered-rate, when the results are worse, so it can be used as a
+regression gate.
+"""
+
+from __future__ import print_function
+
+import argparse
+import collections
+import json
+import os
+import shlex
+import socket
+import sys
+import time
+
+import capture
+import chat_client
+import framing
+import server as chat_server
+from benchmarks.common import (find_free_port, raise_file_limit, start_server,
+                               stop_server)
+from benchmarks.loadgen import (DEFAULT_MIN_DELIVERY_RATIO, check_report,
+                                percentile, read_cpu_time)
+
+
+# Most events sent between two polls of the clients, so that a replay at
+# max speed still reads what the server sends back.
+MAX_EVENTS_PER_POLL = 1000
+
+# Commands that change the channels, after which the replay waits for the
+# server to be done with them.
+BARRIER_COMMANDS = ('/create', '/join', '/leave')
+
+# Seconds to wait for a client's private message to itself to come back
+# before going on without it.
+BARRIER_TIMEOUT = 5
+
+# A connection's part in a replay: when it connects, sends a message, or
+# disconnects. session is the Session of the connection. num_expected is the
+# number of channel messages that the event should get delivered, and
+# channel_name is the name of the channel that the client's chat text goes to
+# once the event is handled, if any.
+ReplayEvent = collections.namedtuple(
+    'ReplayEvent',
+    ['time', 'kind', 'session', 'message', 'num_expected', 'channel_name'])
+
+
+class Session(object):
+    # A connection in the capture. It is only replayed once its name is
+    # known, and with the framing that it asked for, if any.
+    def __init__(self, address):
+        self.address = address
+        self.name = None
+        self.framing_name = framing.FIXED_LENGTH.name
+        self.num_frames = 0
+        self.client = None
+        # The session's client in the IRCHandler of the plan, unless its name
+        # was taken.
+        self.handled_client = None
+
+
+def plan_replay(records):
+    # Turns the records of a capture into ReplayEvents, in order. A client
+    # sends its name, and its framing request, as soon as it connects, so
+    # it is connected once its name arrives in the capture. Connections
+    # without a name, and ones that the server took over from another, are
+    # left out.
+    #
+    # The messages are also handled by an IRCHandler, in the order that the
+    # server got them in the capture, to tell how many channel messages each
+    # one should get delivered.
+    irc_handler = chat_server.IRCHandler(history_length=0)
+    sessions = dict()
+    events = list()
+    for record in records:
+        if record.kind == capture.CAPTURE_CONNECT:
+            sessions[record.connection_id] = Session(
+                record.data.decode('utf-8', 'replace'))
+            continue
+
+        if record.kind == capture.CAPTURE_DISCONNECT:
+            session = sessions.pop(record.connection_id, None)
+            if session is not None and session.name is not None:
+                if session.handled_client is not None:
+                    irc_handler.remove_client(session.name)
+                    count_deliveries(irc_handler)
+
+                events.append(ReplayEvent(record.time,
+                                          capture.CAPTURE_DISCONNECT,
+                                          session, None, 0, None))
+            continue
+
+        session = sessions.get(record.connection_id)
+        if session is None:
+            continue
+
+        message = record.data.decode('utf-8', 'replace')
+        session.num_frames += 1
+        if session.name is None:
+            session.name = message.strip()
+            if not irc_handler.client_exists(session.name):
+                session.handled_client = chat_server.Client(session.name,
+                                                            session.address)
+                irc_handler.add_client(session.handled_client)
+
+            events.append(ReplayEvent(record.time, capture.CAPTURE_CONNECT,
+                                      session, None, 0, None))
+            continue
+
+        if session.num_frames == 2:
+            blocks = message.split()
+            if (len(blocks) == 2 and blocks[0] == framing.NEGOTIATION_COMMAND
+                    and blocks[1] in framing.FRAMINGS):
+                session.framing_name = blocks[1]
+                continue
+
+        num_expected = 0
+        channel_name = None
+        if session.handled_client is not None:
+            irc_handler.process_client_message(message, session.name)
+            num_expected = count_deliveries(irc_handler)
+            if session.handled_client.channel is not None:
+                channel_name = session.handled_client.channel.name
+
+        events.append(ReplayEvent(record.time, capture.CAPTURE_FRAME, session,
+                                  message, num_expected, channel_name))
+
+    return events
+
+
+def count_deliveries(irc_handler):
+    # Returns the number of chat messages that the IRCHandler has for
+    # clients in its channels, and drops everything that it has to send.
+    num_deliveries = 0
+    for channel in irc_handler.pending_channels:
+        for message in channel.messages:
+            if not message.is_notice:
+                # Senders don't get their own messages.
+                num_deliveries += len(channel.clients) - 1
+
+    irc_handler.clear_server_messages()
+    irc_handler.clear_replays()
+    irc_handler.clear_direct_messages()
+    irc_handler.clear_pending_channels()
+
+    return num_deliveries
+
+
+class ReplayClient(chat_client.ChatClient):
+    def __init__(self, *args, **kwargs):
+        chat_client.ChatClient.__init__(self, *args, **kwargs)
+        # When the client last joined each channel, in nanoseconds, by the
+        # name of the channel. Whatever it gets from a channel that was sent
+        # before then came from the channel's history.
+        self.joined_at = dict()
+        self.closing = False
+
+
+class Replayer(object):
+    def __init__(self, host, port, events, speed, server_pid=None):
+        self.host = host
+        self.port = port
+        self.events = events
+        self.speed = speed
+        self.server_pid = server_pid
+
+        self.loop = chat_client.ClientLoop()
+        self.clients = list()
+        # Clients that disconnected in the capture, but still have messages
+        # to send.
+        self.closing = list()
+        self.latencies = list()
+        # When each sender last sent each text, in nanoseconds, and the name
+        # of the channel that it went to.
+        self.send_times = dict()
+        self.num_sent = 0
+        self.num_expected = 0
+        self.num_dropped = 0
+
+        # Clients that sent something since the last barrier, and the
+        # private message that each client of the current barrier is still
+        # waiting for.
+        self.unsynced_clients = set()
+        self.barrier = dict()
+        self.num_barriers = 0
+        self.num_barrier_timeouts = 0
+        # Seconds spent waiting on barriers. The schedule of the capture is
+        # held back by as much, so that what is sent after a barrier keeps
+        # its pace, and it doesn't count towards the replay's duration.
+        self.barrier_seconds = 0
+
+    def run(self):
+        cpu_start = read_cpu_time(self.server_pid)
+        start = time.perf_counter()
+
+        next_event = 0
+        while next_event < len(self.events):
+            now = time.perf_counter()
+            num_sent = 0
+            while (next_event < len(self.events)
+                   and num_sent < MAX_EVENTS_PER_POLL
+                   and (self.events[next_event].time / self.speed
+                        <= now - start - self.barrier_seconds)):
+                self.replay(self.events[next_event])
+                next_event += 1
+                num_sent += 1
+
+            timeout = 0
+            if next_event < len(self.events) and num_sent < MAX_EVENTS_PER_POLL:
+                timeout = max(0, start + self.barrier_seconds
+                              + self.events[next_event].time / self.speed
+                              - time.perf_counter())
+            self.pump(timeout)
+
+        sent_elapsed = time.perf_counter() - start
+
+        # Give the server some time to deliver what is still in flight.
+        self.pump_until_quiet()
+        elapsed = time.perf_counter() - start
+        cpu_end = read_cpu_time(self.server_pid)
+
+        # The server has next to nothing to do while the replay waits on a
+        # barrier, so that time is left out of everything.
+        sent_elapsed -= self.barrier_seconds
+        elapsed -= self.barrier_seconds
+
+        server_cpu = None
+        if cpu_start is not None and cpu_end is not None:
+            server_cpu = (cpu_end - cpu_start) / elapsed
+
+        return self.report(sent_elapsed, elapsed, server_cpu)
+
+    def replay(self, event):
+        session = event.session
+        if event.kind == capture.CAPTURE_CONNECT:
+            client = ReplayClient(session.name, self.host, self.port,
+                                  self.loop, session.framing_name,
+                                  on_messages=self.receive,
+                                  on_disconnect=self.lost_connection)
+            try:
+                client.connect()
+            except socket.error:
+                self.num_dropped += 1
+                return
+
+            session.client = client
+            self.clients.append(client)
+            return
+
+        client = session.client
+        if client is None or client.closed:
+            return
+
+        if event.kind == capture.CAPTURE_DISCONNECT:
+            # Everything sent so far should reach the client before it goes,
+            # as it did in the capture.
+            self.unsynced_clients.add(client)
+            self.wait_for_barrier(self.unsynced_clients)
+
+            # Whatever the client sent last may not have gone out yet.
+            client.closing = True
+            self.closing.append(client)
+            return
+
+        text = event.message.strip()
+        blocks = text.split(None, 1)
+        changes_channels = bool(blocks) and blocks[0] in BARRIER_COMMANDS
+        if changes_channels:
+            # Messages sent before the command should be handled before it,
+            # and the ones sent after it, after it.
+            self.wait_for_barrier(self.unsynced_clients)
+
+        now = time.perf_counter_ns()
+        if text.startswith('/join') or text.startswith('/create'):
+            client.joined_at[event.channel_name] = now
+        elif text and not text.startswith('/'):
+            self.send_times[(client.name, text)] = (now, event.channel_name)
+
+        client.send_message(event.message)
+        self.num_sent += 1
+        self.num_expected += event.num_expected
+        self.unsynced_clients.add(client)
+
+        if changes_channels:
+            self.wait_for_barrier([client])
+
+    def wait_for_barrier(self, clients):
+        # The server handles what a client sends in order, so once a
+        # client's private message to itself comes back, the server is done
+        # with everything that the client sent before it, and the client has
+        # got what the server sent it until then.
+        self.num_barriers += 1
+        text = 'replay barrier {}'.format(self.num_barriers)
+        for client in clients:
+            if client.closed:
+                continue
+
+            self.barrier[client] = '[{}] (private) {}'.format(client.name,
+                                                              text)
+            client.send_message('/msg {} {}'.format(client.name, text))
+
+        self.unsynced_clients.clear()
+
+        barrier_start = time.perf_counter()
+        deadline = barrier_start + BARRIER_TIMEOUT
+        while self.barrier:
+            if time.perf_counter() > deadline:
+                self.num_barrier_timeouts += 1
+                self.barrier.clear()
+                break
+
+            self.pump(0.01)
+
+        self.barrier_seconds += time.perf_counter() - barrier_start
+
+    def pump(self, timeout):
+        # Sends what is queued and handles whatever arrived. Returns whether
+        # anything happened.
+        active = self.loop.poll(timeout) > 0
+
+        if self.closing:
+            closing = list()
+            for client in self.closing:
+                if client.connected and client.outbound_queue.is_empty():
+                    client.close()
+                elif not client.closed:
+                    closing.append(client)
+            self.closing = closing
+
+        return active
+
+    def pump_until_quiet(self, quiet_time=0.5):
+        last_activity = time.perf_counter()
+        while time.perf_counter() - last_activity < quiet_time:
+            if self.pump(0.01):
+                last_activity = time.perf_counter()
+
+    def receive(self, client, messages):
+        now = time.perf_counter_ns()
+        for message in messages:
+            if self.barrier.get(client) == message:
+                del self.barrier[client]
+                continue
+
+            # Channel messages look like "[sender] text".
+            if not message.startswith('['):
+                continue
+
+            end = message.find('] ')
+            if end < 0:
+                continue
+
+            sent = self.send_times.get((message[1:end],
+                                        message[end + 2:].strip()))
+            if sent is None:
+                continue
+
+            sent_at, channel_name = sent
+            if sent_at >= client.joined_at.get(channel_name, 0):
+                self.latencies.append(now - sent_at)
+
+    def lost_connection(self, client):
+        # A capture can have clients that the server kicked off, like ones
+        # with a name that was taken, so this is counted rather than fatal.
+        if not client.closing:
+            self.num_dropped += 1
+
+        self.barrier.pop(client, None)
+
+    def report(self, sent_elapsed, elapsed, server_cpu):
+        latencies = sorted(self.latencies)
+        captured_seconds = self.events[-1].time if self.events else 0
+
+        return {
+            'clients': len(self.clients),
+            'speed': self.speed,
+            'captured_seconds': captured_seconds,
+            'replayed_seconds': sent_elapsed,
+            'elapsed_seconds': elapsed,
+            'sent': self.num_sent,
+            'sent_per_second': self.num_sent / max(sent_elapsed, 1e-9),
+            'delivered': len(latencies),
+            'expected': self.num_expected,
+            'delivered_per_second': len(latencies) / elapsed,
+            'dropped_clients': self.num_dropped,
+            'barriers': self.num_barriers,
+            'barrier_timeouts': self.num_barrier_timeouts,
+            'barrier_seconds': self.barrier_seconds,
+            'p50_ms': percentile(latencies, 0.5) / 1e6,
+            'p99_ms': percentile(latencies, 0.99) / 1e6,
+            'p999_ms': percentile(latencies, 0.999) / 1e6,
+            'server_cpu': server_cpu,
+        }
+
+    def close(self):
+        self.loop.close()
+
+
+def parse_speed(value):
+    # A multiple of the captured speed, or max for as fast as possible.
+    if value == 'max':
+        return float('inf')
+
+    try:
+        speed = float(value)
+    except ValueError:
+        speed = 0
+    if speed <= 0:
+        raise argparse.ArgumentTypeError(
+            'speed must be a positive number or max, not {}'.format(value))
+
+    return speed
+
+
+def print_report(report):
+    speed = 'max'
+    if report['speed'] != float('inf'):
+        speed = '{:g}x'.format(report['speed'])
+
+    print('Clients:          {} ({} kicked off)'.format(
+        report['clients'], report['dropped_clients']))
+    print('Replayed:         {:.3f} s of capture in {:.3f} s ({})'.format(
+        report['captured_seconds'], report['replayed_seconds'], speed))
+    print('Sent:             {} ({:.0f} msg/s)'.format(
+        report['sent'], report['sent_per_second']))
+    print('Delivered:        {} of {} ({:.0f} msg/s)'.format(
+        report['delivered'], report['expected'],
+        report['delivered_per_second']))
+    print('Barriers:         {} ({} timed out), {:.3f} s waiting on them'
+          .format(report['barriers'], report['barrier_timeouts'],
+                  report['barrier_seconds']))
+    print('Latency p50:      {:.3f} ms'.format(report['p50_ms']))
+    print('Latency p99:      {:.3f} ms'.format(report['p99_ms']))
+    print('Latency p99.9:    {:.3f} ms'.format(report['p999_ms']))
+    if report['server_cpu'] is not None:
+        print('Server CPU:       {:.1f}%'.format(report['server_cpu'] * 100))
+    else:
+        print('Server CPU:       unknown')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Replay a captured session against the chat server.')
+    parser.add_argument('capture', help='Capture from server.py --capture.')
+    parser.add_argument(
+        '--host', dest='host', default='localhost',
+        help='Address of the server.')
+    parser.add_argument(
+        '--port', dest='port', type=int,
+        help='Port of the server. Required unless --spawn is used.')
+    parser.add_argument(
+        '--server-pid', dest='server_pid', type=int,
+        help='Process ID of the server, used to measure its CPU time.')
+    parser.add_argument(
+        '--spawn', dest='spawn',
+        help='Server script to start on a free port before replaying.')
+    parser.add_argument(
+        '--server-args', dest='server_args', default='',
+        help='Extra arguments for the script given to --spawn.')
+    parser.add_argument(
+        '--speed', dest='speed', type=parse_speed, default=1,
+        help='How many times faster than in the capture to replay it, like '
+             + '1 or 10, or max to replay it as fast as possible.')
+    parser.add_argument(
+        '--json', dest='json', action='store_true',
+        help='Print the results as JSON.')
+    parser.add_argument(
+        '--max-p99-ms', dest='max_p99_ms', type=float,
+        help='Fail if the p99 latency is higher than this.')
+    parser.add_argument(
+        '--min-delivered-rate', dest='min_delivered_rate', type=float,
+        help='Fail if fewer messages than this are delivered per second.')
+    parser.add_argument(
+        '--min-delivery-ratio', dest='min_delivery_ratio', type=float,
+        default=DEFAULT_MIN_DELIVERY_RATIO,
+        help='Fail if less than this fraction of the messages that should '
+             + 'have been delivered were. Defaults to all of them.')
+    args = parser.parse_args()
+
+    if args.port is None and args.spawn is None:
+        parser.error('either --port or --spawn is required')
+
+    events = plan_replay(capture.read_capture(args.capture))
+
+    raise_file_limit()
+
+    server = None
+    port = args.port
+    server_pid = args.server_pid
+    if args.spawn is not None:
+        port = find_free_port()
+        server = start_server(port, shlex.split(args.server_args),
+                              os.path.abspath(args.spawn))
+        server_pid = server.pid
+
+    replayer = Replayer(args.host, port, events, args.speed, server_pid)
+    try:
+        report = replayer.run()
+    finally:
+        replayer.close()
+
+        if server is not None:
+            stop_server(server)
+
+    if args.json:
+        # JSON has no infinity.
+        if report['speed'] == float('inf'):
+            report['speed'] = 'max'
+        print(json.dumps(report, indent=2, sort_keys=True))
+    else:
+        print_report(report)
+
+    failures = check_report(report, args.max_p99_ms,
+                            args.min_delivered_rate, args.min_delivery_ratio)
+    for failure in failures:
+        print('FAIL: {}'.format(failure), file=sys.stderr)
+
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
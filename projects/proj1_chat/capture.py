@@ -0,0 +1,160 @@
+import collections
+import struct
+import time
+
+
+# Bytes of a capture that are kept in memory before they are written out. A
+# record is only copied into the buffer on the hot path, and the file is
+# written once for every this many bytes of them.
+DEFAULT_CAPTURE_BUFFER_SIZE = 1024 * 1024
+
+# Seconds that a record may sit in the buffer before it is written out, so
+# that a server that is killed, or that gets few messages, loses at most
+# this much of its capture.
+DEFAULT_CAPTURE_FLUSH_INTERVAL = 1.0
+
+CAPTURE_MAGIC = b'CHC1'
+
+# Kinds of records in a capture.
+#   connect:    a connection came in. Its data is the address it came from.
+#   frame:      a frame arrived on a connection, as the server cut it. Its
+#               data is the frame, without the padding of the fixed framing.
+#   disconnect: the connection is gone, and its ID may be used again.
+CAPTURE_CONNECT = 1
+CAPTURE_FRAME = 2
+CAPTURE_DISCONNECT = 3
+
+# A capture starts with its magic and the wall clock time at which it was
+# started, so that it can be matched with the server's logs.
+_HEADER = struct.Struct('!4sd')
+
+# Every record is its kind, the ID of its connection, the microseconds since
+# the record before it, and the length of its data, which follows.
+_RECORD = struct.Struct('!BIIH')
+
+_MAX_DELAY = 2 ** 32 - 1
+
+# What read_capture() gives back for each record. time is in seconds since
+# the capture was started.
+CaptureRecord = collections.namedtuple(
+    'CaptureRecord', ['kind', 'connection_id', 'time', 'data'])
+
+
+class CaptureWriter(object):
+    # Records what arrives on a server's connections, in the order that the
+    # server handled it, to a file at path. Connections are known by an ID,
+    # like the file descriptor of their socket, which the server may use
+    # again once the connection is gone. Times are given by the caller, which
+    # already has the time of its tick. Records are written out when the
+    # buffer fills up, or flush_interval seconds after the first of them
+    # went into it, whichever comes first.
+    def __init__(self, path, buffer_size=DEFAULT_CAPTURE_BUFFER_SIZE,
+                 flush_interval=DEFAULT_CAPTURE_FLUSH_INTERVAL, now=None):
+        if now is None:
+            now = time.monotonic()
+
+        self._path = path
+        self._file = open(path, 'wb', buffering=buffer_size)
+        self._file.write(_HEADER.pack(CAPTURE_MAGIC, time.time()))
+        self._file.flush()
+        self._last_time = now
+
+        self._flush_interval = flush_interval
+        self._flush_deadline = None
+
+    @property
+    def path(self):
+        return self._path
+
+    def record_connect(self, connection_id, address, now):
+        self._write(CAPTURE_CONNECT, connection_id, now,
+                    address.encode('utf-8'))
+
+    def record_frame(self, connection_id, frame, now):
+        # Trailing spaces are the padding of the fixed framing, which the
+        # server strips, along with any other whitespace, when it decodes the
+        # frame. Only the whitespace at the end of a length-prefixed message
+        # is lost, which is much cheaper than telling the two apart.
+        self._write(CAPTURE_FRAME, connection_id, now, frame.rstrip())
+
+    def record_disconnect(self, connection_id, now):
+        self._write(CAPTURE_DISCONNECT, connection_id, now, b'')
+
+    def _write(self, kind, connection_id, now, data):
+        # Times only go forward, since they are the times of the server's
+        # ticks, so only how long it has been since the last record is kept.
+        # Whatever is left over from rounding to microseconds is carried
+        # over to the next record. A gap of more than an hour or so is cut
+        # short.
+        delay = int((now - self._last_time) * 1e6)
+        if delay <= 0:
+            delay = 0
+        elif delay > _MAX_DELAY:
+            delay = _MAX_DELAY
+            self._last_time = now
+        else:
+            self._last_time += delay / 1e6
+
+        self._file.write(_RECORD.pack(kind, connection_id, delay,
+                                      len(data)))
+        self._file.write(data)
+
+        if self._flush_deadline is None:
+            self._flush_deadline = now + self._flush_interval
+
+    def next_flush_time(self):
+        # When flush_if_due() has something to write out, or None if every
+        # record has been written out already.
+        return self._flush_deadline
+
+    def flush_if_due(self, now):
+        if self._flush_deadline is None or now < self._flush_deadline:
+            return
+
+        self.flush()
+
+    def flush(self):
+        self._file.flush()
+        self._flush_deadline = None
+
+    def close(self):
+        if self._file.closed:
+            return
+
+        self._file.close()
+        self._flush_deadline = None
+
+
+def read_capture(path):
+    # Yields the CaptureRecords of the capture at path, in order.
+    with open(path, 'rb') as capture_file:
+        header = capture_file.read(_HEADER.size)
+        if len(header) < _HEADER.size:
+            raise CaptureError('{} is too short to be a capture.'.format(path))
+
+        magic, _ = _HEADER.unpack(header)
+        if magic != CAPTURE_MAGIC:
+            raise CaptureError('{} is not a chat server capture.'.format(path))
+
+        elapsed = 0
+        while True:
+            fields = capture_file.read(_RECORD.size)
+            if not fields:
+                return
+            if len(fields) < _RECORD.size:
+                raise CaptureError('{} ends in the middle of a '
+                                   'record.'.format(path))
+
+            kind, connection_id, delay, length = _RECORD.unpack(fields)
+            data = capture_file.read(length)
+            if len(data) < length:
+                raise CaptureError('{} ends in the middle of a '
+                                   'record.'.format(path))
+
+            elapsed += delay
+            yield CaptureRecord(kind, connection_id, elapsed / 1e6, data)
+
+
+class CaptureError(Exception):
+    def __init__(self, msg):
+        Exception.__init__(self, msg)
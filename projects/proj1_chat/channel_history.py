@@ -0,0 +1,105 @@
+import collections
+import itertools
+import json
+import os
+import time
+
+from urllib.parse import quote
+
+
+# Number of recent messages kept in memory for each channel, and replayed to
+# clients that join it.
+DEFAULT_HISTORY_LENGTH = 50
+
+
+class ChannelHistory(object):
+    # The most recent messages of a channel, in a ring buffer that never
+    # grows past max_length, no matter how long the channel lives. If a log
+    # path is given, every message is also appended to that file.
+    def __init__(self, max_length=DEFAULT_HISTORY_LENGTH, log_path=None):
+        self._messages = collections.deque(maxlen=max_length)
+        self._log_path = log_path
+
+    def __len__(self):
+        return len(self._messages)
+
+    def __iter__(self):
+        return iter(self._messages)
+
+    @property
+    def max_length(self):
+        return self._messages.maxlen
+
+    @property
+    def log_path(self):
+        return self._log_path
+
+    def extend(self, messages, log=True):
+        # Messages that are already in some other worker's log are added
+        # with log=False so that they aren't written twice.
+        if len(messages) == 0:
+            return
+
+        self._messages.extend(messages)
+
+        if log and self._log_path is not None:
+            self._append_to_log(messages)
+
+    def recent(self, count=None):
+        # Returns the last count messages, oldest first. Only references to
+        # the messages are copied, so the recipients share their encoded
+        # bytes with everyone who got them before.
+        if count is None or count > len(self._messages):
+            count = len(self._messages)
+
+        return list(itertools.islice(self._messages,
+                                     len(self._messages) - count, None))
+
+    def _append_to_log(self, messages):
+        now = time.time()
+        records = list()
+        for message in messages:
+            records.append(json.dumps({
+                'time': now,
+                'sender': message.sender_client_name,
+                'message': message.message
+            }) + '\n')
+
+        # The file is opened in append mode and the records of a tick go out
+        # in a single write, so workers sharing a log don't interleave their
+        # records. It is closed right away so that thousands of channels
+        # don't hold thousands of files open.
+        with open(self._log_path, 'ab', buffering=0) as log_file:
+            log_file.write(''.join(records).encode('utf-8'))
+
+    def load(self, message_factory):
+        # Fills the buffer with the last messages in the log, if there is
+        # one. message_factory turns a sender and a message into a message
+        # object.
+        if self._log_path is None:
+            return
+
+        try:
+            log_file = open(self._log_path, 'rb')
+        except IOError:
+            return
+
+        # Reading the file line by line into the ring buffer keeps only the
+        # last max_length records in memory, however long the log is.
+        with log_file:
+            for line in log_file:
+                try:
+                    record = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    # Most likely a record cut short by a crash.
+                    continue
+
+                self._messages.append(message_factory(record['sender'],
+                                                      record['message']))
+
+
+def channel_log_path(directory, channel_name):
+    # Channel names come from clients, so they are escaped before being used
+    # as file names.
+    return os.path.join(directory, '{}.log'.format(quote(channel_name,
+                                                         safe='')))
@@ -0,0 +1,467 @@
+import asyncio
+import collections
+import errno
+import os
+import socket
+import ssl
+import time
+
+import event_loops
+import framing
+import outbound_queue
+import timer_wheel
+
+
+# Most bytes read from the server in a single recv() call. A burst of
+# messages is read in as few calls as possible.
+RECV_BUFFER_SIZE = 64 * 1024
+
+# Most recv() calls made for a client on a single wakeup, so that one busy
+# client can't keep the others, or the terminal, waiting.
+MAX_RECVS_PER_WAKEUP = 16
+
+
+class _ClientProtocol(object):
+    # What every client has to know about the protocol: sending its name,
+    # asking for a framing, and cutting what the server sends into messages.
+    # The server answers the framing request in the old framing, and
+    # anything after the answer is in the framing it answered with.
+    def __init__(self, name, address, port,
+                 framing_name=framing.FIXED_LENGTH.name):
+        self.name = name
+        self.address = address
+        self.port = int(port)
+        self.framing = framing.FIXED_LENGTH
+        self.frame_buffer = self.framing.create_buffer()
+        self.requested_framing = framing.FRAMINGS[framing_name]
+        self.negotiating = False
+
+    def _greeting(self):
+        # The messages that a client sends before anything else.
+        messages = [self.name]
+        if self.requested_framing is not self.framing:
+            messages.append('{} {}'.format(framing.NEGOTIATION_COMMAND,
+                                           self.requested_framing.name))
+            self.negotiating = True
+
+        return [self.framing.encode(message) for message in messages]
+
+    def _feed(self, data):
+        # Returns the messages completed by the data. Partial messages are
+        # kept until the rest of them arrives.
+        frames = self.frame_buffer.feed(data)
+
+        if self.negotiating and frames:
+            self.negotiating = False
+
+            # Servers that don't know the command answer with an error, and
+            # we stay with the fixed framing.
+            response = self.framing.decode(frames[0])
+            frames = frames[1:]
+            if response == framing.NEGOTIATION_ACCEPTED.format(
+                    self.requested_framing.name):
+                leftover = b''.join(frames) + self.frame_buffer.take_pending()
+                self.framing = self.requested_framing
+                self.frame_buffer = self.framing.create_buffer()
+                frames = self.frame_buffer.feed(leftover)
+
+            self._negotiated()
+
+        return [self.framing.decode(frame) for frame in frames]
+
+    def _negotiated(self):
+        pass
+
+
+class ChatClient(_ClientProtocol):
+    # A chat client without a terminal, for bots and load generators. It
+    # never blocks. A ClientLoop tells it when its socket is ready, and what
+    # it receives is handed to callbacks:
+    #
+    #   on_connect(client)            once the connection is up.
+    #   on_messages(client, messages) with the list of messages that
+    #                                 arrived on one wakeup.
+    #   on_disconnect(client)         once the connection is gone, or if it
+    #                                 never came up.
+    #
+    # Many clients can share a ClientLoop, so one process can play thousands
+    # of users.
+    #
+    # With a tls_context, the client talks to the server's TLS port, and
+    # on_connect is only called once the handshake is done. Passing the
+    # tls_session of an earlier client resumes its session, which skips most
+    # of the handshake's work.
+    #
+    # With a heartbeat_interval, the client sends an empty message whenever
+    # it has sent nothing else for that many seconds, so that a server with
+    # an idle timeout doesn't take a client that only listens for a dead one.
+    # Servers ignore empty messages.
+    def __init__(self, name, address, port, loop,
+                 framing_name=framing.FIXED_LENGTH.name, on_connect=None,
+                 on_messages=None, on_disconnect=None, tls_context=None,
+                 tls_session=None, heartbeat_interval=0):
+        _ClientProtocol.__init__(self, name, address, port, framing_name)
+        self.loop = loop
+        self.on_connect = on_connect
+        self.on_messages = on_messages
+        self.on_disconnect = on_disconnect
+        self.tls_context = tls_context
+        # The session to resume, and then the one of this connection. Session
+        # tickets arrive after the handshake, so it is only worth keeping
+        # once the client has read something.
+        self.tls_session = tls_session
+        self.socket = None
+        self.connected = False
+        self.closed = False
+        # Nothing waits for the server, so messages are queued until the
+        # socket takes them.
+        self.outbound_queue = outbound_queue.OutboundQueue(
+            high_water_mark=float('inf'))
+        # Messages sent while the framing is being negotiated, which can
+        # only be encoded once we know the answer.
+        self._held_messages = list()
+        self._fileno = None
+        self._events = 0
+        self.heartbeat_interval = heartbeat_interval
+        self._heartbeat_timer = None
+        self._last_sent = 0
+
+    @property
+    def fileno(self):
+        return self._fileno
+
+    def connect(self, client_socket=None):
+        # Starts connecting and returns right away. Raises socket.error if
+        # the connection fails before it gets going; later failures end up
+        # in on_disconnect. A socket that is already connected to the
+        # server, like one end of a socketpair, may be given instead.
+        if client_socket is not None:
+            self.socket = self._wrap(client_socket)
+        else:
+            self.socket = self._wrap(socket.socket())
+
+            error = self.socket.connect_ex((self.address, self.port))
+            if error not in (0, errno.EINPROGRESS):
+                self.socket.close()
+                raise socket.error(error, os.strerror(error))
+
+        for data in self._greeting():
+            self.outbound_queue.push(data)
+
+        self._fileno = self.socket.fileno()
+        # The socket becomes writable once it is connected.
+        self._events = event_loops.EVENT_READ | event_loops.EVENT_WRITE
+        self.loop.add(self, self._events)
+
+    def send_message(self, message):
+        if self.negotiating:
+            self._held_messages.append(message)
+            return
+
+        self.outbound_queue.push(self.framing.encode(message))
+        self._last_sent = self.loop.clock()
+        if self.connected:
+            self._flush()
+
+    @property
+    def session_reused(self):
+        # Whether the TLS handshake resumed tls_session.
+        return self.tls_context is not None and self.socket.session_reused
+
+    def handle_event(self, events):
+        if not self.connected:
+            if not self._finish_connecting():
+                return
+
+            self.connected = True
+            if self.heartbeat_interval > 0:
+                self._last_sent = self.loop.clock()
+                self._schedule_heartbeat()
+            if self.on_connect is not None:
+                self.on_connect(self)
+            # The greeting has been waiting in the queue. A TLS handshake
+            # ends on the socket being readable, so it may not say writable.
+            events |= event_loops.EVENT_WRITE
+
+        if events & event_loops.EVENT_WRITE and not self.closed:
+            self._flush()
+        if events & event_loops.EVENT_READ and not self.closed:
+            self._receive()
+
+    def close(self):
+        if self.closed:
+            return
+
+        self.closed = True
+        self.connected = False
+        if self._heartbeat_timer is not None:
+            self.loop.timers.cancel(self._heartbeat_timer)
+            self._heartbeat_timer = None
+        if self.tls_context is not None and self.socket.session is not None:
+            self.tls_session = self.socket.session
+        self.loop.remove(self)
+        self.socket.close()
+
+    def _wrap(self, client_socket):
+        client_socket.setblocking(False)
+        if self.tls_context is None:
+            return client_socket
+
+        return self.tls_context.wrap_socket(client_socket,
+                                            server_hostname=self.address,
+                                            do_handshake_on_connect=False,
+                                            session=self.tls_session)
+
+    def _finish_connecting(self):
+        # Returns whether the connection is up. Over TLS, that is once the
+        # handshake is done, which takes a few wakeups.
+        error = self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if error != 0:
+            self._disconnect()
+            return False
+
+        if self.tls_context is None:
+            return True
+
+        try:
+            self.socket.do_handshake()
+        except ssl.SSLWantReadError:
+            self._watch(event_loops.EVENT_READ)
+            return False
+        except ssl.SSLWantWriteError:
+            self._watch(event_loops.EVENT_READ | event_loops.EVENT_WRITE)
+            return False
+        except (ssl.SSLError, socket.error):
+            self._disconnect()
+            return False
+
+        return True
+
+    def _schedule_heartbeat(self):
+        self._heartbeat_timer = self.loop.timers.schedule(
+            self._last_sent + self.heartbeat_interval, self._send_heartbeat)
+
+    def _send_heartbeat(self):
+        # Like the server's idle timers, this is only set once per interval,
+        # and anything sent in the meantime puts the heartbeat off.
+        if self.loop.clock() >= self._last_sent + self.heartbeat_interval:
+            self.send_message('')
+        self._schedule_heartbeat()
+
+    def _negotiated(self):
+        held_messages = self._held_messages
+        self._held_messages = list()
+        for message in held_messages:
+            self.send_message(message)
+
+    def _flush(self):
+        try:
+            flushed = self.outbound_queue.flush(self.socket)
+        except socket.error:
+            # The server is gone, which we find out when reading.
+            flushed = True
+
+        # We only ask to hear about the socket being writable while there
+        # is something to write.
+        events = event_loops.EVENT_READ
+        if not flushed:
+            events |= event_loops.EVENT_WRITE
+        self._watch(events)
+
+    def _watch(self, events):
+        if events != self._events:
+            self._events = events
+            self.loop.event_loop.modify(self.socket, events)
+
+    def _receive(self):
+        messages = list()
+        disconnected = False
+        for _ in range(MAX_RECVS_PER_WAKEUP):
+            try:
+                data = self.socket.recv(RECV_BUFFER_SIZE)
+            except (BlockingIOError, InterruptedError, ssl.SSLWantReadError,
+                    ssl.SSLWantWriteError):
+                break
+            except socket.error:
+                data = b''
+
+            if not data:
+                disconnected = True
+                break
+
+            messages.extend(self._feed(data))
+
+            if len(data) < RECV_BUFFER_SIZE and not self._has_pending_data():
+                # The socket is drained.
+                break
+
+        if messages and self.on_messages is not None:
+            self.on_messages(self, messages)
+        if disconnected:
+            self._disconnect()
+
+    def _has_pending_data(self):
+        # Whether TLS has data that it already took off the socket.
+        return self.tls_context is not None and self.socket.pending() > 0
+
+    def _disconnect(self):
+        self.close()
+
+        if self.on_disconnect is not None:
+            self.on_disconnect(self)
+
+
+class ClientLoop(object):
+    # Runs any number of ChatClients on one event loop. Other files, like
+    # standard input, may be registered with event_loop as well, as long as
+    # their events are handled by whoever polls it. The clients' heartbeats
+    # are timers in the loop's timer wheel, which poll() runs, and they go
+    # by clock.
+    def __init__(self, event_loop=None, clock=time.monotonic):
+        if event_loop is None:
+            event_loop = event_loops.create_event_loop()
+
+        self.event_loop = event_loop
+        self.clock = clock
+        self.timers = timer_wheel.TimerWheel(clock=clock)
+        self._clients = dict()
+
+    def __len__(self):
+        return len(self._clients)
+
+    def __iter__(self):
+        return iter(list(self._clients.values()))
+
+    def add(self, client, events):
+        self._clients[client.fileno] = client
+        self.event_loop.register(client.socket, events)
+
+    def remove(self, client):
+        del self._clients[client.fileno]
+        self.event_loop.unregister(client.socket)
+
+    def handle_event(self, s, events):
+        # Returns whether the socket belonged to one of the clients.
+        client = self._clients.get(s.fileno())
+        if client is None:
+            return False
+
+        client.handle_event(events)
+        return True
+
+    def poll(self, timeout=None):
+        # Handles whatever is ready, and runs the timers that are due.
+        # Returns the number of sockets that were ready.
+        timeout = self.cap_timeout(timeout)
+
+        ready = self.event_loop.poll(timeout)
+        for s, events in ready:
+            self.handle_event(s, events)
+
+        self.timers.advance()
+
+        return len(ready)
+
+    def cap_timeout(self, timeout):
+        # Returns how long the loop may wait, at most timeout seconds, without
+        # being late for the next timer.
+        deadline = self.timers.next_deadline()
+        if deadline is None:
+            return timeout
+
+        time_to_deadline = max(0, deadline - self.clock())
+        if timeout is None or time_to_deadline < timeout:
+            return time_to_deadline
+
+        return timeout
+
+    def run(self):
+        # Runs until every client has disconnected.
+        while self._clients:
+            self.poll()
+
+    def close(self):
+        for client in self:
+            client.close()
+
+        self.event_loop.close()
+
+
+class AsyncChatClient(_ClientProtocol):
+    # The same client for asyncio code. Received messages are read by
+    # iterating over the client:
+    #
+    #     async with AsyncChatClient('bot', 'localhost', 12345) as client:
+    #         client.send_message('/join tas')
+    #         async for message in client:
+    #             ...
+    #
+    # Any number of them can run on one asyncio event loop. With a
+    # tls_context, it connects to the server's TLS port.
+    def __init__(self, name, address, port,
+                 framing_name=framing.FIXED_LENGTH.name, tls_context=None):
+        _ClientProtocol.__init__(self, name, address, port, framing_name)
+        self.tls_context = tls_context
+        self._reader = None
+        self._writer = None
+        self._messages = collections.deque()
+
+    async def connect(self):
+        self._reader, self._writer = await asyncio.open_connection(
+            self.address, self.port, ssl=self.tls_context)
+
+        for data in self._greeting():
+            self._writer.write(data)
+        await self._writer.drain()
+
+        # Messages can't be encoded until we know the framing, so we wait
+        # for the answer here.
+        while self.negotiating:
+            if not await self._read():
+                break
+
+    def send_message(self, message):
+        # Writes as much as the transport takes right away and buffers the
+        # rest. Await drain() to wait for the buffer to empty.
+        self._writer.write(self.framing.encode(message))
+
+    async def drain(self):
+        await self._writer.drain()
+
+    async def close(self):
+        self._writer.close()
+        try:
+            await self._writer.wait_closed()
+        except ConnectionError:
+            pass
+
+    async def __aenter__(self):
+        await self.connect()
+
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while not self._messages:
+            if not await self._read():
+                raise StopAsyncIteration
+
+        return self._messages.popleft()
+
+    async def _read(self):
+        # Returns False once the server has disconnected.
+        try:
+            data = await self._reader.read(RECV_BUFFER_SIZE)
+        except ConnectionError:
+            data = b''
+
+        if not data:
+            return False
+
+        self._messages.extend(self._feed(data))
+        return True
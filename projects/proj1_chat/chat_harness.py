@@ -0,0 +1,458 @@
+import logging
+import socket
+import threading
+import time
+
+import chat_client
+import event_loops
+import framing
+import multicore_server
+import server as chat_server
+import server_logging
+import tls
+
+
+# Without a handler of its own, whatever the server warns about, like a client
+# being kicked off for flooding, would go to stderr through logging's last
+# resort handler. Scenarios check what happened themselves, and anyone who
+# wants the logs as well can still configure logging.
+logging.getLogger(server_logging.LOGGER_NAME).addHandler(logging.NullHandler())
+
+# The send buffer of the server's end of a client that stops reading. The
+# kernel keeps a few messages in it, and the rest wait in the server's queue.
+SLOW_CLIENT_SEND_BUFFER = 4096
+
+# Seconds that a harness waits for something to happen before it gives up.
+# Nothing is ever slept away: the harness only blocks while no socket is
+# ready, so a passing scenario never comes close to this.
+DEFAULT_TIMEOUT = 5.0
+
+
+class ManualClock(object):
+    # A clock that only moves when it is told to, so that scenarios with
+    # timeouts and heartbeats don't have to wait for them.
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+class HarnessServer(chat_server.Server):
+    # A Server that shares its event loop with the clients of the harness,
+    # and hands their sockets' events to them. The clients' timers run on
+    # every tick too.
+    def __init__(self, client_loop, *args, **kwargs):
+        chat_server.Server.__init__(self, *args, **kwargs)
+        self.client_loop = client_loop
+        # Handoffs that the server went through, whether or not the new
+        # server took over.
+        self.num_handoffs = 0
+
+    def step(self, timeout=None):
+        ready = chat_server.Server.step(self,
+                                        self.client_loop.cap_timeout(timeout))
+        self.client_loop.timers.advance()
+
+        return ready
+
+    def handle_event(self, s, events):
+        if not self.client_loop.handle_event(s, events):
+            chat_server.Server.handle_event(self, s, events)
+
+    def hand_off(self, handoff_socket):
+        chat_server.Server.hand_off(self, handoff_socket)
+        self.num_handoffs += 1
+
+    def retire(self):
+        # Lets go of the sockets that a new server took over. Its copies of
+        # them are in the same event loop, which would otherwise still tell
+        # this server about them.
+        for connection in self.connections:
+            self.event_loop.unregister(connection.socket)
+            connection.socket.close()
+
+        self.event_loop.unregister(self.server_socket)
+        self.server_socket.close()
+        self.server_socket = None
+
+
+class WorkerEventLoop(object):
+    # A worker's share of the harness's event loop. The harness polls for
+    # every worker at once, and hands the events of each worker's sockets to
+    # it, which gets them from poll() on its next tick.
+    def __init__(self, event_loop, owners):
+        self.event_loop = event_loop
+        # The WorkerEventLoop of every socket of the workers, by file
+        # descriptor, shared by all of them.
+        self._owners = owners
+        self.ready = list()
+
+    def register(self, sock, events):
+        self.event_loop.register(sock, events)
+        self._owners[sock.fileno()] = self
+
+    def modify(self, sock, events):
+        self.event_loop.modify(sock, events)
+
+    def unregister(self, sock):
+        self._owners.pop(sock.fileno(), None)
+        self.event_loop.unregister(sock)
+
+    def poll(self, timeout=None):
+        ready = self.ready
+        self.ready = list()
+
+        return ready
+
+    def close(self):
+        # The event loop is the harness's to close.
+        self.ready = list()
+
+
+class HarnessClient(chat_client.ChatClient):
+    # A ChatClient that keeps everything it receives. With send_name=False,
+    # it connects without sending its name, so that a scenario can send it
+    # in pieces.
+    def __init__(self, *args, **kwargs):
+        self.send_name = kwargs.pop('send_name', True)
+        chat_client.ChatClient.__init__(self, *args, **kwargs)
+        self.received = list()
+        # Index of the first message that expect() hasn't looked at yet.
+        self.next_message = 0
+
+    def _greeting(self):
+        if not self.send_name:
+            return list()
+
+        return chat_client.ChatClient._greeting(self)
+
+
+class ChatHarness(object):
+    # Runs a Server and any number of clients in one process, on a single
+    # event loop, one tick at a time. Scenarios wait on what the clients
+    # receive instead of on the clock, so they take as long as the server
+    # does and no longer. Every harness has its own event loop and server
+    # port, so any number of them can run side by side.
+    #
+    # With tls_certificates, from tls.create_test_certificates(), clients
+    # may also connect with TLS.
+    #
+    # With a ManualClock, the server's and the clients' timers only go off
+    # when advance_clock() moves it past them.
+    #
+    # With more than one worker, the server is a set of the WorkerServers of
+    # multicore_server.py, linked like a MulticoreServer links them, but all
+    # in this process. Clients pick the worker that they connect to, and
+    # server is the first worker.
+    def __init__(self, port=0, timeout=DEFAULT_TIMEOUT, tls_certificates=None,
+                 clock=None, workers=1, **server_kwargs):
+        self.timeout = timeout
+        self.event_loop = event_loops.create_event_loop()
+        self.clock = clock
+        if clock is not None:
+            server_kwargs['clock'] = clock
+            self.client_loop = chat_client.ClientLoop(self.event_loop, clock)
+        else:
+            self.client_loop = chat_client.ClientLoop(self.event_loop)
+
+        self.tls_client_context = None
+        if tls_certificates is not None:
+            server_kwargs['tls_port'] = 0
+            server_kwargs['tls_context'] = tls.create_server_context(
+                tls_certificates.cert_file, tls_certificates.key_file)
+            self.tls_client_context = tls.create_client_context(
+                tls_certificates.ca_file)
+
+        server_kwargs.setdefault('summary_interval', 0)
+        self.server_kwargs = server_kwargs
+        self.workers = list()
+        self._worker_sockets = dict()
+        if workers > 1:
+            links = [list() for _ in range(workers)]
+            for i in range(workers):
+                for j in range(i + 1, workers):
+                    end_i, end_j = socket.socketpair(socket.AF_UNIX,
+                                                     socket.SOCK_STREAM)
+                    links[i].append(end_i)
+                    links[j].append(end_j)
+
+            for worker_links in links:
+                self.workers.append(multicore_server.WorkerServer(
+                    port, worker_links,
+                    event_loop=WorkerEventLoop(self.event_loop,
+                                               self._worker_sockets),
+                    **server_kwargs))
+            self.server = self.workers[0]
+        else:
+            self.server = HarnessServer(self.client_loop, port,
+                                        self.event_loop, **server_kwargs)
+        self.clients = dict()
+        # The server, or the worker, that each client is connected to.
+        self._client_servers = dict()
+        # Clients that stopped reading.
+        self._stopped_clients = set()
+
+    def start(self):
+        for server in self.workers or [self.server]:
+            server.start()
+
+    def close(self):
+        for name in list(self._stopped_clients):
+            self.resume_reading(name)
+        for client in self.client_loop:
+            client.close()
+
+        # Server.close() leaves the connections of the clients open, which
+        # hundreds of harnesses in one process can't afford.
+        for server in self.workers or [self.server]:
+            for connection in server.connections:
+                connection.socket.close()
+
+        for worker in self.workers:
+            for connection in worker.relay_connections.values():
+                connection.socket.close()
+            if worker.server_socket is not None:
+                worker.close()
+
+        if self.workers or self.server.server_socket is None:
+            self.event_loop.close()
+        else:
+            self.server.close()
+
+    def __enter__(self):
+        self.start()
+
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def step(self, timeout=0):
+        # Runs one tick of the server and the clients. Returns the number of
+        # sockets that were ready.
+        if not self.workers:
+            return self.server.step(timeout)
+
+        # Every worker gets a tick, in which it handles its share of what
+        # was ready, so none of them waits past the timers of another.
+        for worker in self.workers:
+            deadline = worker.timers.next_deadline()
+            if deadline is not None:
+                time_to_deadline = max(0, deadline - worker.clock())
+                if timeout is None or time_to_deadline < timeout:
+                    timeout = time_to_deadline
+
+        ready = self.event_loop.poll(self.client_loop.cap_timeout(timeout))
+        for s, events in ready:
+            if self.client_loop.handle_event(s, events):
+                continue
+
+            owner = self._worker_sockets.get(s.fileno())
+            if owner is not None:
+                owner.ready.append((s, events))
+
+        for worker in self.workers:
+            worker.step(0)
+        self.client_loop.timers.advance()
+
+        return len(ready)
+
+    def run_until(self, condition, description='the condition to hold'):
+        deadline = time.monotonic() + self.timeout
+        while not condition():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise HarnessTimeoutError(description, self.timeout)
+
+            # Blocks only while nothing is ready.
+            self.step(remaining)
+
+    def run_until_idle(self):
+        # Runs ticks until no socket is ready, which means that everything
+        # sent so far has been handled.
+        while self.step(0) > 0:
+            pass
+
+    def advance_clock(self, seconds):
+        # Moves the ManualClock forward a tick of the timer wheel at a time,
+        # and lets the server and the clients handle whatever that set off
+        # before the next one.
+        end = self.clock.now + seconds
+        while self.clock.now < end:
+            self.clock.advance(min(self.server.timers.resolution,
+                                   end - self.clock.now))
+            self.step(0)
+            self.run_until_idle()
+
+    def hand_off(self):
+        # Starts a new server at the handoff path of the current one, which
+        # takes over its clients and becomes the harness's server. The new
+        # server blocks until the current one has sent it everything, which
+        # the current one only does on a tick of its own, so the new one
+        # starts in a thread. If it doesn't take over, whatever kept it from
+        # it is raised, and the current server carries on.
+        old_server = self.server
+        new_server = HarnessServer(self.client_loop, old_server.port,
+                                   self.event_loop, **self.server_kwargs)
+        errors = list()
+
+        def take_over():
+            try:
+                new_server.start()
+            except Exception as error:
+                errors.append(error)
+
+        num_handoffs = old_server.num_handoffs
+        thread = threading.Thread(target=take_over)
+        thread.start()
+        try:
+            self.run_until(lambda: old_server.num_handoffs > num_handoffs,
+                           'the server to hand off')
+        finally:
+            thread.join(self.timeout)
+
+        if errors:
+            raise errors[0]
+        if not old_server.handed_off:
+            raise HarnessHandoffError()
+
+        old_server.retire()
+        self.server = new_server
+        for name, server in self._client_servers.items():
+            if server is old_server:
+                self._client_servers[name] = new_server
+
+        return new_server
+
+    def connect(self, name, framing_name=framing.FIXED_LENGTH.name,
+                send_name=True, use_tls=False, tls_session=None,
+                heartbeat_interval=0, worker=0):
+        # With use_tls, the client connects to the TLS listener, resuming
+        # tls_session if one is given. With workers, it connects to the one
+        # at index worker.
+        server = self.server
+        if self.workers:
+            server = self.workers[worker]
+        self._client_servers[name] = server
+
+        tls_context = self.tls_client_context if use_tls else None
+        client = HarnessClient(name, server.address, server.port,
+                               self.client_loop, framing_name,
+                               on_messages=self._receive,
+                               send_name=send_name,
+                               tls_context=tls_context,
+                               tls_session=tls_session,
+                               heartbeat_interval=heartbeat_interval)
+        self.clients[name] = client
+
+        # The client talks to the server over a socketpair rather than TCP.
+        # What one end sends is readable at the other by the time send()
+        # returns, which the loopback interface doesn't promise, so a tick
+        # with nothing ready really means that nothing is in flight.
+        client_socket, server_socket = socket.socketpair()
+        if use_tls:
+            server.tls_listener.add_socket(server_socket, 'localhost')
+        else:
+            server.add_connection(server_socket, 'localhost')
+        client.connect(client_socket)
+
+        if send_name:
+            self.wait_for_client(name)
+        else:
+            self.run_until(lambda: client.connected,
+                           '{} to connect'.format(name))
+
+        return client
+
+    def wait_for_client(self, name):
+        server = self._client_servers[name]
+        self.run_until(
+            lambda: name in server.irc_handler.connected_clients,
+            'the server to know {}'.format(name))
+        # The framing negotiation, if any, has to be over too.
+        self.run_until(lambda: not self.clients[name].negotiating,
+                       '{} to negotiate its framing'.format(name))
+
+    def disconnect(self, name):
+        self.clients.pop(name).close()
+        server = self._client_servers.pop(name)
+        self.run_until(
+            lambda: name not in server.irc_handler.connected_clients,
+            'the server to drop {}'.format(name))
+
+    def stop_reading(self, name):
+        # The client no longer reads what the server sends it, like one that
+        # can't keep up, until resume_reading(). It must not have anything
+        # left to send.
+        client = self.clients[name]
+        server = self._client_servers[name]
+        connection = server.connections.get_by_name(name)
+        connection.socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF,
+                                     SLOW_CLIENT_SEND_BUFFER)
+        self.client_loop.remove(client)
+        self._stopped_clients.add(name)
+
+    def resume_reading(self, name):
+        self._stopped_clients.remove(name)
+        self.client_loop.add(self.clients[name], event_loops.EVENT_READ)
+
+    def send(self, name, message):
+        self.clients[name].send_message(message)
+
+    def send_in_pieces(self, name, data, cuts):
+        # Sends the bytes of data cut at the given offsets, letting the
+        # server handle each piece before the next one is sent.
+        client = self.clients[name]
+        start = 0
+        for end in list(cuts) + [len(data)]:
+            if end > start:
+                client.socket.sendall(data[start:end])
+                self.run_until_idle()
+            start = end
+
+    def expect(self, name, *messages):
+        # Waits until the client has received as many messages as given
+        # since the last expect(), and checks that they are those messages.
+        client = self.clients[name]
+        end = client.next_message + len(messages)
+        self.run_until(lambda: len(client.received) >= end,
+                       '{} to receive {!r}'.format(name, list(messages)))
+
+        received = client.received[client.next_message:end]
+        client.next_message = end
+        if received != list(messages):
+            raise UnexpectedMessagesError(name, received, list(messages))
+
+    def expect_nothing(self, name):
+        # Checks that the client hasn't received anything that expect()
+        # hasn't looked at, once everything in flight has been handled.
+        self.run_until_idle()
+
+        client = self.clients[name]
+        extra = client.received[client.next_message:]
+        if extra:
+            raise UnexpectedMessagesError(name, extra, list())
+
+    def _receive(self, client, messages):
+        client.received.extend(messages)
+
+
+class HarnessTimeoutError(Exception):
+    def __init__(self, description, timeout):
+        Exception.__init__(self, 'Gave up waiting for {} '.format(description)
+                                 + 'after {} seconds.'.format(timeout))
+
+
+class HarnessHandoffError(Exception):
+    def __init__(self):
+        Exception.__init__(self, 'The new server did not take over.')
+
+
+class UnexpectedMessagesError(Exception):
+    def __init__(self, name, received, expected):
+        Exception.__init__(self, '{} received {!r}; expected {!r}.'.format(
+            name, received, expected))
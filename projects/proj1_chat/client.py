@@ -1,105 +1,145 @@
 from __future__ import print_function
 
-import select
+import argparse
+import os
 import socket
 import sys
 import termios
 
+import chat_client
+import event_loops
+import framing
+import tls
 import utils
 
 
 class BasicClient(object):
-
-    def __init__(self, name, address, port):
+    # The terminal side of the client. Talking to the server is left to a
+    # ChatClient, and this only reads what the user types and draws what
+    # arrives.
+    def __init__(self, name, address, port,
+                 framing_name=framing.FIXED_LENGTH.name, tls_context=None,
+                 heartbeat_interval=0):
         self.name = name
         self.address = address
         self.port = int(port)
-        self.socket = socket.socket()
-
-    def connect(self):
-        self.socket.connect((self.address, self.port))
-        self.send_message(self.name)
-
-    def send_message(self, message):
-        message = self._pad_message(message)
-        self.socket.send(self._pad_message(message))
+        # Only the socket and stdin are watched, so select() does just fine,
+        # and unlike epoll it takes a stdin that is redirected from a file.
+        self.loop = chat_client.ClientLoop(event_loops.SelectEventLoop())
+        self.chat_client = chat_client.ChatClient(
+            name, address, port, self.loop, framing_name,
+            on_connect=self._handle_connect,
+            on_messages=self._render,
+            on_disconnect=self._handle_disconnect,
+            tls_context=tls_context,
+            heartbeat_interval=heartbeat_interval
+        )
+        self.has_connected = False
+        # What the user typed after the last complete line.
+        self.input_buffer = bytearray()
 
     def run(self):
         try:
-            self.connect()
+            self.chat_client.connect()
         except socket.error:
-            print(utils.CLIENT_CANNOT_CONNECT.format(self.address, self.port))
-            sys.exit(1)
+            self._exit_unable_to_connect()
 
-        inputs = [self.socket, sys.stdin]
         while True:
-            print(utils.CLIENT_MESSAGE_PREFIX, end='')
-            sys.stdout.flush()
-
-            readable, _, _ = select.select(inputs, [], [])
-            for s in readable:
+            for s, events in self.loop.event_loop.poll(
+                    self.loop.cap_timeout(None)):
                 if s is sys.stdin:
-                    message = sys.stdin.readline().strip()
-                    self.send_message(message)
+                    self._read_input()
                 else:
-                    # We received a message from the server.
-                    data = self._recv_all()
-
-                    if data:
-                        self._clear_current_line()
-                        print('\r{}'.format(data.strip()))
-                    else:
-                        # Disconnected from the server. Most likely the server
-                        # went down.
-                        message = utils.CLIENT_SERVER_DISCONNECTED.format(
-                            self.address, port
-                        )
-                        self._clear_current_line()
-                        print('\r{}.'.format(message))
-
-                        self.socket.close()
-                        sys.exit(0)
-
-    def _recv_all(self):
-        self.socket.setblocking(False)
-
-        data = ''
-        ttl = 12  # Use a TTL to prevent any infinitely expecting data.
-        while (len(data) < utils.MESSAGE_LENGTH) and (ttl > 0):
-            try:
-                data_chunk = self.socket.recv(utils.MESSAGE_LENGTH)
-            except socket.error:
-                # No more data to be read.
+                    self.loop.handle_event(s, events)
+
+            self.loop.timers.advance()
+
+    def _handle_connect(self, client):
+        self.has_connected = True
+        self.loop.event_loop.register(sys.stdin, event_loops.EVENT_READ)
+        self._write_prompt()
+
+    def _handle_disconnect(self, client):
+        if not self.has_connected:
+            self._exit_unable_to_connect()
+
+        # Most likely the server went down.
+        message = utils.CLIENT_SERVER_DISCONNECTED.format(self.address,
+                                                          self.port)
+        self._render(client, [message + '.'], prompt=False)
+        sys.exit(0)
+
+    def _exit_unable_to_connect(self):
+        print(utils.CLIENT_CANNOT_CONNECT.format(self.address, self.port))
+        sys.exit(1)
+
+    def _read_input(self):
+        # stdin is read with os.read() rather than readline(), which could
+        # leave lines in a buffer that the event loop doesn't know about.
+        data = os.read(sys.stdin.fileno(), 4096)
+        if not data:
+            # Nothing more will be typed, but we still show what we get.
+            self.loop.event_loop.unregister(sys.stdin)
+            return
+
+        self.input_buffer += data
+        while True:
+            end = self.input_buffer.find(b'\n')
+            if end == -1:
                 break
 
-            data += data_chunk
-            ttl -= 1
-
-        data = data.strip()
-
-        self.socket.setblocking(True)
+            line = self.input_buffer[:end].decode('utf-8', 'replace')
+            del self.input_buffer[:end + 1]
 
-        return data
+            self.chat_client.send_message(line.strip())
+            self._write_prompt()
 
-    def _clear_current_line(self):
-        print(utils.CLIENT_WIPE_ME, end='')
+    def _render(self, client, messages, prompt=True):
+        # A burst of messages is drawn with a single write, wiping the
+        # prompt only once before it and drawing it again after it.
+        lines = [utils.CLIENT_WIPE_ME]
+        for message in messages:
+            lines.append('\r{}\n'.format(message.strip()))
+        if prompt:
+            lines.append(utils.CLIENT_MESSAGE_PREFIX)
 
-    def _pad_message(self, message):
-        # We pad the message by 200 since we only expect messages itself to be
-        # 200 characters long.
-        num_space_pads = min(200 - len(message), 200)
-        message = '{}{}'.format(message, ' ' * num_space_pads)
+        sys.stdout.write(''.join(lines))
+        sys.stdout.flush()
 
-        return message
+    def _write_prompt(self):
+        sys.stdout.write(utils.CLIENT_MESSAGE_PREFIX)
+        sys.stdout.flush()
 
 
 if __name__ == '__main__':
-    args = sys.argv
-    if len(args) != 4:
-        print('Please supply a name, server address, and port.')
-        sys.exit()
-
-    server_address = args[2]
-    port = args[3]
-    client = BasicClient(args[1], server_address, port)
+    parser = argparse.ArgumentParser(description='CMSC 135 Chat Client')
+    parser.add_argument('name', help='Name to use in the chat.')
+    parser.add_argument('address', help='Address of the server.')
+    parser.add_argument('port', type=int, help='Port of the server.')
+    parser.add_argument(
+        '--framing', dest='framing', choices=sorted(framing.FRAMINGS.keys()),
+        default=framing.FIXED_LENGTH.name,
+        help='Framing to ask the server for. Falls back to fixed if the '
+             + 'server does not support it.')
+    parser.add_argument(
+        '--tls', dest='tls', action='store_true',
+        help='Connect to the server\'s TLS port.')
+    parser.add_argument(
+        '--tls-ca', dest='tls_ca',
+        help='PEM file of the CA to trust for the server\'s certificate, '
+             + 'instead of the system\'s CAs. Implies --tls.')
+    parser.add_argument(
+        '--heartbeat-interval', dest='heartbeat_interval', type=float,
+        default=0,
+        help='Seconds without sending anything after which the client sends '
+             + 'a heartbeat, for servers that kick idle clients off. Off by '
+             + 'default.')
+    args = parser.parse_args()
+
+    tls_context = None
+    if args.tls or args.tls_ca is not None:
+        tls_context = tls.create_client_context(args.tls_ca)
+
+    client = BasicClient(args.name, args.address, args.port, args.framing,
+                         tls_context, args.heartbeat_interval)
     client.run()
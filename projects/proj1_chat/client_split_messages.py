@@ -16,6 +16,8 @@ with split messages.  This client randomly determines how to split up
 a message, but you may want to hard-code the way messages are divided to
 ensure that you've tested all relevant cases.
 """
+from __future__ import print_function
+
 import utils
 
 import random
@@ -41,9 +43,9 @@ class ChatClientSplitMessages:
       last_char_to_send = random.randrange(chars_sent, utils.MESSAGE_LENGTH + 1)
       message_to_send = padded_message[chars_sent:last_char_to_send]
       if len(message_to_send) > 0:
-        print "Sending {} characters: {}".format(
-          last_char_to_send - chars_sent, message_to_send)
-        client_socket.sendall(message_to_send)
+        print("Sending {} characters: {}".format(
+          last_char_to_send - chars_sent, message_to_send))
+        client_socket.sendall(message_to_send.encode("utf-8"))
         chars_sent = last_char_to_send
 
   def run(self):
@@ -51,14 +53,14 @@ class ChatClientSplitMessages:
     try:
       client_socket.connect((self.server_host, self.server_port))
     except:
-      print utils.CLIENT_CANNOT_CONNECT.format(self.server_host, self.server_port)
+      print(utils.CLIENT_CANNOT_CONNECT.format(self.server_host, self.server_port))
       return
 
     my_name = pad_message("SplitMessagesChatClient")
     # Send the server our name.
     #self.send_split_message(client_socket, my_name)
-    client_socket.sendall(my_name[:5])
-    client_socket.sendall(my_name[5:])
+    client_socket.sendall(my_name[:5].encode("utf-8"))
+    client_socket.sendall(my_name[5:].encode("utf-8"))
 
     # Join a "split_messages" channel. This code assumes that the channel
     # already exists.
@@ -74,7 +76,7 @@ class ChatClientSplitMessages:
 
 if __name__ == "__main__":
   if (len(sys.argv)) < 3:
-    print "Usage: python client_split_messages.py server_hostname server_port"
+    print("Usage: python client_split_messages.py server_hostname server_port")
     sys.exit(1)
 
   chat_client = ChatClientSplitMessages(sys.argv[1], int(sys.argv[2]))
@@ -0,0 +1,98 @@
+import select
+import selectors
+
+
+# We reuse the event masks of the selectors module so that both backends
+# speak the same language.
+EVENT_READ = selectors.EVENT_READ
+EVENT_WRITE = selectors.EVENT_WRITE
+
+
+class SelectEventLoop(object):
+    # The original backend of the server. Every poll hands all of the
+    # registered sockets to select.select(), which makes each wakeup O(n) and
+    # limits us to sockets whose file descriptors are below FD_SETSIZE (1024).
+    def __init__(self):
+        self._readers = dict()
+        self._writers = dict()
+
+    def register(self, sock, events):
+        if events & EVENT_READ:
+            self._readers[sock.fileno()] = sock
+        if events & EVENT_WRITE:
+            self._writers[sock.fileno()] = sock
+
+    def modify(self, sock, events):
+        self.unregister(sock)
+        self.register(sock, events)
+
+    def unregister(self, sock):
+        self._readers.pop(sock.fileno(), None)
+        self._writers.pop(sock.fileno(), None)
+
+    def poll(self, timeout=None):
+        readable, writable, _ = select.select(list(self._readers.values()),
+                                              list(self._writers.values()),
+                                              [],
+                                              timeout)
+
+        events = dict()
+        for s in readable:
+            events[s] = EVENT_READ
+        for s in writable:
+            events[s] = events.get(s, 0) | EVENT_WRITE
+
+        return list(events.items())
+
+    def close(self):
+        self._readers.clear()
+        self._writers.clear()
+
+
+class SelectorsEventLoop(object):
+    # Backend built on selectors.DefaultSelector (epoll on Linux, kqueue on
+    # BSDs). Sockets are registered with the kernel once when they join and
+    # unregistered when they leave, so each wakeup only costs as much as the
+    # number of sockets that are actually ready.
+    def __init__(self, selector=None):
+        if selector is None:
+            selector = selectors.DefaultSelector()
+
+        self._selector = selector
+
+    def register(self, sock, events):
+        self._selector.register(sock, events)
+
+    def modify(self, sock, events):
+        self._selector.modify(sock, events)
+
+    def unregister(self, sock):
+        self._selector.unregister(sock)
+
+    def poll(self, timeout=None):
+        return [
+            (key.fileobj, events)
+            for key, events in self._selector.select(timeout)
+        ]
+
+    def close(self):
+        self._selector.close()
+
+
+EVENT_LOOPS = {
+    'select': SelectEventLoop,
+    'selectors': SelectorsEventLoop,
+}
+
+DEFAULT_EVENT_LOOP = 'selectors'
+
+
+def create_event_loop(name=DEFAULT_EVENT_LOOP):
+    try:
+        event_loop_class = EVENT_LOOPS[name]
+    except KeyError:
+        raise ValueError('Unknown event loop backend \'{}\'. '.format(name)
+                         + 'Choose from: {}.'.format(
+                             ', '.join(sorted(EVENT_LOOPS.keys()))))
+
+    return event_loop_class()
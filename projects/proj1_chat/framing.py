@@ -0,0 +1,167 @@
+import struct
+
+import utils
+
+
+# A client asks for another framing by sending this command, followed by the
+# name of the framing, as its first message after its name. The server
+# answers in the old framing with NEGOTIATION_ACCEPTED if it switched, and
+# with anything else if it didn't, so clients fall back to the fixed framing
+# on servers that don't know the command.
+NEGOTIATION_COMMAND = '/framing'
+NEGOTIATION_ACCEPTED = 'Framing switched to {0}.'
+NEGOTIATION_UNKNOWN = 'Unknown framing {0}. Still using fixed.'
+
+
+class FrameBuffer(object):
+    # Collects the bytes of a connection across event loop ticks and cuts
+    # them into fixed-length frames. A client may send a message in several
+    # pieces, or several messages in one piece, so we can't assume that one
+    # recv() gives us exactly one message.
+    def __init__(self, frame_length=utils.MESSAGE_LENGTH):
+        self._frame_length = frame_length
+        self._buffer = bytearray()
+
+    @property
+    def pending_bytes(self):
+        return len(self._buffer)
+
+    def peek_pending(self):
+        return bytes(self._buffer)
+
+    def take_pending(self):
+        pending = bytes(self._buffer)
+        del self._buffer[:]
+
+        return pending
+
+    def feed(self, data):
+        # Returns the frames completed by the data, if any. Leftover bytes are
+        # kept until the rest of their frame arrives.
+        self._buffer.extend(data)
+
+        frames = list()
+        consumed = 0
+        with memoryview(self._buffer) as view:
+            while len(view) - consumed >= self._frame_length:
+                frame_end = consumed + self._frame_length
+                frames.append(view[consumed:frame_end].tobytes())
+                consumed = frame_end
+
+        # Drop the consumed frames all at once instead of one by one.
+        if consumed > 0:
+            del self._buffer[:consumed]
+
+        return frames
+
+
+class LengthPrefixedFrameBuffer(object):
+    # Like FrameBuffer, but for frames of any size. Each frame starts with a
+    # header holding the length of the payload that follows it.
+    def __init__(self, header=struct.Struct('!I')):
+        self._header = header
+        self._buffer = bytearray()
+
+    @property
+    def pending_bytes(self):
+        return len(self._buffer)
+
+    def peek_pending(self):
+        return bytes(self._buffer)
+
+    def take_pending(self):
+        pending = bytes(self._buffer)
+        del self._buffer[:]
+
+        return pending
+
+    def frame(self, payload):
+        return self._header.pack(len(payload)) + payload
+
+    def feed(self, data):
+        # Returns the payloads of the frames completed by the data, if any.
+        self._buffer.extend(data)
+
+        frames = list()
+        consumed = 0
+        header_size = self._header.size
+        with memoryview(self._buffer) as view:
+            while len(view) - consumed >= header_size:
+                payload_length, = self._header.unpack_from(view, consumed)
+                payload_start = consumed + header_size
+                payload_end = payload_start + payload_length
+                if payload_end > len(view):
+                    break
+
+                frames.append(view[payload_start:payload_end].tobytes())
+                consumed = payload_end
+
+        if consumed > 0:
+            del self._buffer[:consumed]
+
+        return frames
+
+
+class FixedLengthFraming(object):
+    # The original framing. Every message is padded with spaces to exactly
+    # MESSAGE_LENGTH bytes, and longer messages are cut off.
+    name = 'fixed'
+
+    def create_buffer(self):
+        return FrameBuffer(utils.MESSAGE_LENGTH)
+
+    def encode(self, message):
+        # We pad the bytes rather than the characters, since a character may
+        # take more than one byte.
+        data = message.encode('utf-8')[:utils.MESSAGE_LENGTH]
+
+        return data.ljust(utils.MESSAGE_LENGTH)
+
+    def decode(self, frame):
+        return frame.decode('utf-8', 'replace').strip()
+
+
+class LengthPrefixedFraming(object):
+    # Every message is sent as a 2-byte big-endian length followed by that
+    # many bytes, with no padding. Messages can be up to 65535 bytes long.
+    name = 'length-prefixed'
+    header = struct.Struct('!H')
+    max_length = 2 ** 16 - 1
+
+    def create_buffer(self):
+        return LengthPrefixedFrameBuffer(self.header)
+
+    def encode(self, message):
+        data = message.encode('utf-8')[:self.max_length]
+
+        return self.header.pack(len(data)) + data
+
+    def decode(self, frame):
+        return frame.decode('utf-8', 'replace')
+
+
+FIXED_LENGTH = FixedLengthFraming()
+LENGTH_PREFIXED = LengthPrefixedFraming()
+
+FRAMINGS = {
+    FIXED_LENGTH.name: FIXED_LENGTH,
+    LENGTH_PREFIXED.name: LENGTH_PREFIXED,
+}
+
+# The most bytes of UTF-8 that a message can take in any framing, and so in
+# anything else that the server keeps or passes on.
+MAX_MESSAGE_LENGTH = LENGTH_PREFIXED.max_length
+
+
+def truncate_message(message, max_length=MAX_MESSAGE_LENGTH):
+    # Cuts the message down to at most max_length bytes of UTF-8, without
+    # splitting a character. A character takes at most 4 bytes, so most
+    # messages are known to fit without being encoded.
+    if len(message) * 4 <= max_length:
+        return message
+
+    data = message.encode('utf-8')
+    if len(data) <= max_length:
+        return message
+
+    return data[:max_length].decode('utf-8', 'ignore')
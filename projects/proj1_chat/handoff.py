@@ -0,0 +1,371 @@
+import collections
+import logging
+import os
+import socket
+import struct
+
+import event_loops
+import server_logging
+
+
+logger = logging.getLogger(server_logging.LOGGER_NAME)
+
+
+# Seconds that either server waits on the other during a handoff before it
+# gives up on it.
+DEFAULT_HANDOFF_TIMEOUT = 30.0
+
+# The most file descriptors that Linux passes in a single SCM_RIGHTS message.
+MAX_FDS_PER_MESSAGE = 253
+
+# The snapshot is sent in messages of at most this many bytes, which stays
+# well under the send buffer of a Unix socket.
+SNAPSHOT_CHUNK_SIZE = 64 * 1024
+
+# Kinds of messages sent over a handoff connection. The old server sends
+# the sockets and the snapshot, and then the end, which holds their counts.
+# The new server answers with an acknowledgement once it has taken over.
+HANDOFF_SOCKETS = b'F'
+HANDOFF_SNAPSHOT = b'S'
+HANDOFF_END = b'E'
+HANDOFF_ACK = b'K'
+
+SNAPSHOT_MAGIC = b'CHS1'
+
+_HEADER = struct.Struct('!4sIII')
+_END = struct.Struct('!II')
+_NAME_LENGTH = struct.Struct('!H')
+
+# The fixed parts of the records of a snapshot. Names are indices into its
+# name table.
+#   connection:      flags, address, framing, seconds idle, and the lengths
+#                    of its inbound and outbound bytes, which follow.
+#   client:          name, current channel, and the number of channels,
+#                    which follow. Only for connections with a client.
+#   channel:         name, and the numbers of clients and of history
+#                    messages, which follow.
+#   history message: sender, and the length of the message, which follows.
+_CONNECTION = struct.Struct('!BIIdII')
+_CLIENT = struct.Struct('!III')
+_CHANNEL = struct.Struct('!III')
+_HISTORY_MESSAGE = struct.Struct('!II')
+
+# Flags of a connection in a snapshot.
+_NAMED = 1
+_MAY_NEGOTIATE = 2
+
+
+class HandoffListener(object):
+    # Listens on a Unix socket at path for a new server process that wants
+    # to take over. It is a sequenced packet socket, so that every message
+    # arrives whole, along with the file descriptors sent with it.
+    def __init__(self, path, event_loop):
+        self._path = path
+        self._event_loop = event_loop
+        self._socket = None
+
+    @property
+    def path(self):
+        return self._path
+
+    def start(self):
+        # A path left behind by a server that is gone would keep us from
+        # binding. A live server's path is only ever removed by itself,
+        # when it hands off.
+        try:
+            os.unlink(self._path)
+        except FileNotFoundError:
+            pass
+
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self._socket.bind(self._path)
+        self._socket.listen(1)
+        self._socket.setblocking(False)
+
+        self._event_loop.register(self._socket, event_loops.EVENT_READ)
+
+    def handles(self, s):
+        return s is self._socket
+
+    def accept(self):
+        # Returns the connection of a new server, or None if it went away.
+        try:
+            handoff_socket, _ = self._socket.accept()
+        except (BlockingIOError, InterruptedError):
+            return None
+
+        handoff_socket.setblocking(True)
+        handoff_socket.settimeout(DEFAULT_HANDOFF_TIMEOUT)
+
+        return handoff_socket
+
+    def close(self):
+        if self._socket is None:
+            return
+
+        self._event_loop.unregister(self._socket)
+        self._socket.close()
+        self._socket = None
+        try:
+            os.unlink(self._path)
+        except FileNotFoundError:
+            pass
+
+
+def connect(path):
+    # Connects to the server listening at path, or returns None if there is
+    # none, so that a server started with a handoff path takes over if it
+    # can and starts from scratch if it can't.
+    handoff_socket = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    handoff_socket.settimeout(DEFAULT_HANDOFF_TIMEOUT)
+    try:
+        handoff_socket.connect(path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        handoff_socket.close()
+        return None
+
+    return handoff_socket
+
+
+def send_state(handoff_socket, sockets, snapshot):
+    # Sends the sockets, in batches, and then the snapshot. Returns whether
+    # the new server took them over.
+    for start in range(0, len(sockets), MAX_FDS_PER_MESSAGE):
+        socket.send_fds(handoff_socket, [HANDOFF_SOCKETS],
+                        [s.fileno() for s in
+                         sockets[start:start + MAX_FDS_PER_MESSAGE]])
+
+    for start in range(0, len(snapshot), SNAPSHOT_CHUNK_SIZE):
+        handoff_socket.sendall(HANDOFF_SNAPSHOT
+                               + snapshot[start:start + SNAPSHOT_CHUNK_SIZE])
+
+    handoff_socket.sendall(HANDOFF_END + _END.pack(len(sockets),
+                                                   len(snapshot)))
+
+    try:
+        return handoff_socket.recv(1) == HANDOFF_ACK
+    except socket.error:
+        return False
+
+
+def receive_state(handoff_socket):
+    # Returns the sockets and the snapshot sent by send_state(), in order.
+    fds = list()
+    chunks = list()
+    while True:
+        message, new_fds, flags, _ = socket.recv_fds(
+            handoff_socket, SNAPSHOT_CHUNK_SIZE + 1, MAX_FDS_PER_MESSAGE)
+        fds.extend(new_fds)
+        if flags & socket.MSG_CTRUNC:
+            _close_fds(fds)
+            raise HandoffError('Some of the sockets were cut off. The file '
+                               + 'limit is probably too low.')
+
+        kind = message[:1]
+        if kind == HANDOFF_SNAPSHOT:
+            chunks.append(message[1:])
+        elif kind == HANDOFF_END:
+            num_sockets, snapshot_length = _END.unpack(message[1:])
+            break
+        elif kind != HANDOFF_SOCKETS:
+            _close_fds(fds)
+            raise HandoffError('The old server went away in the middle of '
+                               + 'the handoff.')
+
+    snapshot = b''.join(chunks)
+    if len(fds) != num_sockets or len(snapshot) != snapshot_length:
+        _close_fds(fds)
+        raise HandoffError('Got {} sockets and {} bytes of snapshot instead '
+                           'of {} and {}.'.format(len(fds), len(snapshot),
+                                                  num_sockets,
+                                                  snapshot_length))
+
+    return [socket.socket(fileno=fd) for fd in fds], snapshot
+
+
+def acknowledge(handoff_socket):
+    handoff_socket.sendall(HANDOFF_ACK)
+
+
+def _close_fds(fds):
+    for fd in fds:
+        os.close(fd)
+
+
+# What a snapshot holds for each connection, in the order of their sockets.
+# inbound has the bytes of a frame that hadn't all arrived yet, and outbound
+# the bytes that hadn't been sent yet. A client's channels are in the order
+# that it joined them, and current_channel_name is the one its chat text
+# goes to. client_name and current_channel_name may be None.
+ConnectionState = collections.namedtuple(
+    'ConnectionState', ['address', 'framing_name', 'client_name',
+                        'may_negotiate', 'idle_seconds', 'inbound',
+                        'outbound', 'channel_names', 'current_channel_name'])
+
+# And for each channel, with its history as pairs of a sender and a message,
+# oldest first.
+ChannelState = collections.namedtuple(
+    'ChannelState', ['name', 'client_names', 'history'])
+
+
+def encode_snapshot(connections, channels):
+    # Packs ConnectionStates and ChannelStates into bytes. Every name, and
+    # every address, is written once in a table at the start, and referred
+    # to by its index from then on. A client's name comes up in every
+    # channel it is in and in every message of it in the histories, so this
+    # keeps the snapshot small however many of those there are. Each record
+    # starts with a fixed layout, so that it is packed and unpacked in one
+    # go, which matters with tens of thousands of them.
+    writer = _SnapshotWriter()
+    parts = writer.parts
+    index = writer.index
+    for connection in connections:
+        flags = 0
+        if connection.client_name is not None:
+            flags |= _NAMED
+        if connection.may_negotiate:
+            flags |= _MAY_NEGOTIATE
+
+        parts.append(_CONNECTION.pack(
+            flags, index(connection.address), index(connection.framing_name),
+            connection.idle_seconds, len(connection.inbound),
+            len(connection.outbound)))
+        parts.append(connection.inbound)
+        parts.append(connection.outbound)
+        if connection.client_name is None:
+            continue
+
+        # Index 0 stands for no channel, so the others are shifted by one.
+        current_channel_index = 0
+        if connection.current_channel_name is not None:
+            current_channel_index = \
+                index(connection.current_channel_name) + 1
+        parts.append(_CLIENT.pack(index(connection.client_name),
+                                  current_channel_index,
+                                  len(connection.channel_names)))
+        writer.write_indices(connection.channel_names)
+
+    for channel in channels:
+        parts.append(_CHANNEL.pack(index(channel.name),
+                                   len(channel.client_names),
+                                   len(channel.history)))
+        writer.write_indices(channel.client_names)
+        for sender, message in channel.history:
+            message = message.encode('utf-8')
+            parts.append(_HISTORY_MESSAGE.pack(index(sender), len(message)))
+            parts.append(message)
+
+    return writer.getvalue(len(connections), len(channels))
+
+
+def decode_snapshot(snapshot):
+    # Returns the ConnectionStates and the ChannelStates packed by
+    # encode_snapshot().
+    reader = _SnapshotReader(snapshot)
+    names = reader.names
+    connections = list()
+    for _ in range(reader.num_connections):
+        (flags, address_index, framing_index, idle_seconds, inbound_length,
+         outbound_length) = reader.unpack(_CONNECTION)
+        inbound = reader.read(inbound_length)
+        outbound = reader.read(outbound_length)
+
+        client_name = None
+        current_channel_name = None
+        channel_names = []
+        if flags & _NAMED:
+            client_index, current_channel_index, num_channels = \
+                reader.unpack(_CLIENT)
+            client_name = names[client_index]
+            if current_channel_index > 0:
+                current_channel_name = names[current_channel_index - 1]
+            channel_names = reader.read_names(num_channels)
+
+        connections.append(ConnectionState(
+            names[address_index], names[framing_index], client_name,
+            bool(flags & _MAY_NEGOTIATE), idle_seconds, inbound, outbound,
+            channel_names, current_channel_name))
+
+    channels = list()
+    for _ in range(reader.num_channels):
+        name_index, num_clients, history_length = reader.unpack(_CHANNEL)
+        client_names = reader.read_names(num_clients)
+        history = list()
+        for _ in range(history_length):
+            sender_index, message_length = reader.unpack(_HISTORY_MESSAGE)
+            history.append((names[sender_index],
+                            reader.read(message_length).decode('utf-8')))
+
+        channels.append(ChannelState(names[name_index], client_names,
+                                     history))
+
+    return connections, channels
+
+
+class _SnapshotWriter(object):
+    def __init__(self):
+        self.parts = list()
+        self._names = list()
+        self._name_indices = dict()
+
+    def index(self, name):
+        index = self._name_indices.get(name)
+        if index is None:
+            index = len(self._names)
+            self._names.append(name)
+            self._name_indices[name] = index
+
+        return index
+
+    def write_indices(self, names):
+        self.parts.append(struct.pack('!{}I'.format(len(names)),
+                                      *[self.index(name) for name in names]))
+
+    def getvalue(self, num_connections, num_channels):
+        parts = [_HEADER.pack(SNAPSHOT_MAGIC, len(self._names),
+                              num_connections, num_channels)]
+        for name in self._names:
+            name = name.encode('utf-8')
+            parts.append(_NAME_LENGTH.pack(len(name)))
+            parts.append(name)
+
+        return b''.join(parts + self.parts)
+
+
+class _SnapshotReader(object):
+    def __init__(self, snapshot):
+        magic, num_names, self.num_connections, self.num_channels = \
+            _HEADER.unpack_from(snapshot)
+        if magic != SNAPSHOT_MAGIC:
+            raise HandoffError('Not a chat server snapshot.')
+
+        self._snapshot = snapshot
+        self._offset = _HEADER.size
+        self.names = list()
+        for _ in range(num_names):
+            name_length, = self.unpack(_NAME_LENGTH)
+            self.names.append(self.read(name_length).decode('utf-8'))
+
+    def unpack(self, record):
+        values = record.unpack_from(self._snapshot, self._offset)
+        self._offset += record.size
+
+        return values
+
+    def read(self, length):
+        data = self._snapshot[self._offset:self._offset + length]
+        self._offset += length
+
+        return data
+
+    def read_names(self, count):
+        indices = struct.unpack_from('!{}I'.format(count), self._snapshot,
+                                     self._offset)
+        self._offset += 4 * count
+
+        return [self.names[index] for index in indices]
+
+
+class HandoffError(Exception):
+    def __init__(self, msg):
+        Exception.__init__(self, msg)
@@ -0,0 +1,228 @@
+import bisect
+import socket
+
+import event_loops
+import outbound_queue
+
+
+# Upper bounds, in seconds, of the buckets of latency histograms.
+DEFAULT_LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+                           0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Histogram(object):
+    # Counts observations in fixed buckets. Observing a value is a binary
+    # search and an increment, so it is cheap enough for the hot path.
+    def __init__(self, buckets=DEFAULT_LATENCY_BUCKETS):
+        self._bounds = list(buckets)
+        # The last count is for values above every bound.
+        self._counts = [0] * (len(self._bounds) + 1)
+        self._sum = 0
+        self._count = 0
+
+    @property
+    def count(self):
+        return self._count
+
+    @property
+    def sum(self):
+        return self._sum
+
+    def observe(self, value):
+        self._counts[bisect.bisect_left(self._bounds, value)] += 1
+        self._sum += value
+        self._count += 1
+
+    def cumulative_counts(self):
+        # Pairs of a bucket's upper bound and the number of observations at
+        # or below it, the way the exposition format has them.
+        cumulative = 0
+        for bound, count in zip(self._bounds + [float('inf')], self._counts):
+            cumulative += count
+            yield bound, cumulative
+
+
+class MetricsRegistry(object):
+    # The metrics of a server. Counters and gauges are functions that are
+    # only called when the metrics are rendered, so that the server can keep
+    # counting with plain integers. A function returns either a number, or a
+    # list of pairs of a dict of labels and a number.
+    def __init__(self):
+        self._metrics = list()
+
+    def counter(self, name, help_text, function):
+        self._metrics.append((name, 'counter', help_text, function))
+
+    def gauge(self, name, help_text, function):
+        self._metrics.append((name, 'gauge', help_text, function))
+
+    def histogram(self, name, help_text, buckets=DEFAULT_LATENCY_BUCKETS):
+        histogram = Histogram(buckets)
+        self._metrics.append((name, 'histogram', help_text, histogram))
+
+        return histogram
+
+    def render(self):
+        # Renders every metric in the Prometheus text exposition format.
+        lines = list()
+        for name, metric_type, help_text, source in self._metrics:
+            lines.append('# HELP {} {}'.format(name, help_text))
+            lines.append('# TYPE {} {}'.format(name, metric_type))
+
+            if metric_type == 'histogram':
+                for bound, count in source.cumulative_counts():
+                    lines.append('{}_bucket{{le="{}"}} {}'.format(
+                        name, _format_value(bound), count))
+                lines.append('{}_sum {}'.format(name,
+                                                _format_value(source.sum)))
+                lines.append('{}_count {}'.format(name, source.count))
+                continue
+
+            value = source()
+            if isinstance(value, list):
+                for labels, labeled_value in value:
+                    lines.append('{}{{{}}} {}'.format(
+                        name, _format_labels(labels),
+                        _format_value(labeled_value)))
+            else:
+                lines.append('{} {}'.format(name, _format_value(value)))
+
+        return '\n'.join(lines) + '\n'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+
+    return repr(value)
+
+
+def _format_labels(labels):
+    # Label values come from client and channel names, so they are escaped.
+    return ','.join('{}="{}"'.format(
+        key, str(value).replace('\\', '\\\\').replace('"', '\\"')
+                       .replace('\n', '\\n'))
+        for key, value in sorted(labels.items()))
+
+
+class _AdminConnection(object):
+    def __init__(self, admin_socket):
+        self.socket = admin_socket
+        self.request = bytearray()
+        self.outbound_queue = outbound_queue.OutboundQueue(
+            high_water_mark=float('inf'))
+        self.responded = False
+
+
+class AdminEndpoint(object):
+    # Serves a MetricsRegistry on a local socket, from the server's own event
+    # loop. It answers HTTP GET requests, so that the metrics can be scraped
+    # or fetched with curl, and any other line with just the metrics, for nc.
+    # Either way the connection is closed once the metrics have been sent.
+    def __init__(self, registry, event_loop, address='localhost', port=0):
+        self._registry = registry
+        self._event_loop = event_loop
+        self._address = address
+        self._port = int(port)
+        self._socket = None
+        self._connections = dict()
+
+    @property
+    def port(self):
+        return self._port
+
+    def start(self):
+        self._socket = socket.socket()
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind((self._address, self._port))
+        self._socket.listen(socket.SOMAXCONN)
+        self._socket.setblocking(False)
+
+        self._port = self._socket.getsockname()[1]
+
+        self._event_loop.register(self._socket, event_loops.EVENT_READ)
+
+    def handles(self, s):
+        return s is self._socket or s.fileno() in self._connections
+
+    def handle_event(self, s, events):
+        if s is self._socket:
+            self._accept()
+            return
+
+        connection = self._connections[s.fileno()]
+        if events & event_loops.EVENT_READ and not connection.responded:
+            self._receive(connection)
+        if events & event_loops.EVENT_WRITE:
+            self._flush(connection)
+
+    def close(self):
+        for connection in list(self._connections.values()):
+            self._disconnect(connection)
+
+        if self._socket is not None:
+            self._event_loop.unregister(self._socket)
+            self._socket.close()
+            self._socket = None
+
+    def _accept(self):
+        try:
+            admin_socket, _ = self._socket.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+
+        admin_socket.setblocking(False)
+        self._connections[admin_socket.fileno()] = _AdminConnection(
+            admin_socket)
+        self._event_loop.register(admin_socket, event_loops.EVENT_READ)
+
+    def _receive(self, connection):
+        try:
+            data = connection.socket.recv(4096)
+        except (BlockingIOError, InterruptedError):
+            return
+        except socket.error:
+            data = b''
+
+        if not data:
+            self._disconnect(connection)
+            return
+
+        connection.request += data
+
+        # HTTP requests end with a blank line, anything else with a newline.
+        is_http = connection.request.startswith(b'GET ')
+        if is_http and b'\r\n\r\n' not in connection.request:
+            return
+        if not is_http and b'\n' not in connection.request:
+            return
+
+        body = self._registry.render().encode('utf-8')
+        if is_http:
+            header = ('HTTP/1.0 200 OK\r\n'
+                      + 'Content-Type: {}\r\n'.format(CONTENT_TYPE)
+                      + 'Content-Length: {}\r\n\r\n'.format(len(body)))
+            connection.outbound_queue.push(header.encode('utf-8'))
+        connection.outbound_queue.push(body)
+        connection.responded = True
+
+        self._flush(connection)
+
+    def _flush(self, connection):
+        try:
+            flushed = connection.outbound_queue.flush(connection.socket)
+        except socket.error:
+            flushed = True
+
+        if flushed:
+            self._disconnect(connection)
+        else:
+            self._event_loop.modify(connection.socket,
+                                    event_loops.EVENT_WRITE)
+
+    def _disconnect(self, connection):
+        del self._connections[connection.socket.fileno()]
+        self._event_loop.unregister(connection.socket)
+        connection.socket.close()
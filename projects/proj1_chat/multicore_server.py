@@ -0,0 +1,471 @@
+import argparse
+import os
+import signal
+import socket
+import struct
+import sys
+
+import channel_history
+import event_loops
+import framing
+import outbound_queue
+import rate_limit
+import server_logging
+from server import (Connection, ClientNameExistsError, IRCHandler, Message,
+                    Server, exit_on_sigterm, logger)
+
+
+# Kinds of records that workers send each other over their relay links.
+RELAY_CLIENT_JOINED = b'J'
+RELAY_CLIENT_LEFT = b'Q'
+RELAY_CHANNEL_CREATED = b'C'
+RELAY_CHANNEL_MESSAGE = b'M'
+RELAY_CHANNEL_NOTICE = b'N'
+RELAY_DIRECT_MESSAGE = b'P'
+
+# Workers are expected to keep up with each other, so the queue of a relay
+# link is only capped to keep a stuck worker from eating all of the memory.
+RELAY_HIGH_WATER_MARK = 64 * 1024 * 1024
+
+# Relay links carry the traffic of many clients, so we read more at once than
+# from a single client.
+RELAY_RECV_BUFFER_SIZE = 64 * 1024
+
+# Field lengths take 4 bytes, like the frames of the relay links, so that no
+# field that a worker has to relay can be too long for a record.
+_FIELD_LENGTH = struct.Struct('!I')
+
+
+def pack_relay_record(kind, *fields):
+    record = [kind]
+    for field in fields:
+        field = field.encode('utf-8')
+        record.append(_FIELD_LENGTH.pack(len(field)))
+        record.append(field)
+
+    return b''.join(record)
+
+
+def unpack_relay_record(record):
+    kind = record[:1]
+    fields = list()
+    offset = 1
+    while offset < len(record):
+        field_length, = _FIELD_LENGTH.unpack_from(record, offset)
+        offset += _FIELD_LENGTH.size
+        fields.append(record[offset:offset + field_length].decode('utf-8'))
+        offset += field_length
+
+    return kind, fields
+
+
+class ReplicatedIRCHandler(IRCHandler):
+    # An IRCHandler that remembers the channels created by its own clients,
+    # so that the worker can tell the other workers about them. It also
+    # knows the names of the clients of the other workers, so that those can
+    # be sent private messages.
+    def __init__(self, *args, **kwargs):
+        IRCHandler.__init__(self, *args, **kwargs)
+        self._new_channels = list()
+        self.remote_client_names = set()
+
+    def client_exists(self, name):
+        return (IRCHandler.client_exists(self, name)
+                or name in self.remote_client_names)
+
+    def add_channel(self, name):
+        IRCHandler.add_channel(self, name)
+        self._new_channels.append(name)
+
+    def add_replicated_channel(self, name):
+        # A channel created by a client of another worker.
+        if name not in self.channels:
+            IRCHandler.add_channel(self, name)
+
+    def pop_new_channels(self):
+        new_channels = self._new_channels
+        self._new_channels = list()
+
+        return new_channels
+
+
+class WorkerServer(Server):
+    # One of the processes of a MulticoreServer. Every worker listens on the
+    # same port with SO_REUSEPORT, so the kernel spreads new clients across
+    # them. Each worker has a copy of every channel. Messages sent to a
+    # channel by local clients are relayed to every other worker, which
+    # delivers them to its own clients in that channel.
+    def __init__(self, port, links, parent_link=None, **kwargs):
+        Server.__init__(self, port, **kwargs)
+        self.irc_handler = ReplicatedIRCHandler(self.history_length,
+                                                self.history_directory,
+                                                self.intern_names,
+                                                self.client_rate_limit,
+                                                self.channel_rate_limit,
+                                                self.rate_limit_action,
+                                                self.clock)
+
+        # Names of the clients connected to the other workers, so that names
+        # stay unique across the whole server.
+        self.remote_client_names = self.irc_handler.remote_client_names
+
+        self.relay_connections = dict()
+        for link in links:
+            link.setblocking(False)
+            self.relay_connections[link.fileno()] = Connection(
+                link, 'relay',
+                outbound_queue.OutboundQueue(RELAY_HIGH_WATER_MARK),
+                framing.LengthPrefixedFrameBuffer()
+            )
+
+        # The parent process never sends anything on parent_link, so it only
+        # becomes readable once the parent is gone, however it went.
+        self.parent_link = parent_link
+
+    def create_server_socket(self):
+        server_socket = socket.socket()
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+        return server_socket
+
+    def start(self):
+        Server.start(self)
+
+        for connection in self.relay_connections.values():
+            self.event_loop.register(connection.socket,
+                                     event_loops.EVENT_READ)
+        if self.parent_link is not None:
+            self.event_loop.register(self.parent_link, event_loops.EVENT_READ)
+
+    def handle_event(self, s, events):
+        if s is self.parent_link:
+            raise ParentProcessGoneError()
+
+        connection = self.relay_connections.get(s.fileno())
+        if connection is None:
+            Server.handle_event(self, s, events)
+            return
+
+        if events & event_loops.EVENT_WRITE:
+            self.flush_connection(connection)
+        if events & event_loops.EVENT_READ:
+            self.receive_relay_data(connection)
+
+    def create_client(self, connection, name):
+        if name in self.remote_client_names:
+            raise ClientNameExistsError()
+
+        Server.create_client(self, connection, name)
+        self.relay(RELAY_CLIENT_JOINED, name)
+
+    def remove_client(self, name):
+        Server.remove_client(self, name)
+        self.relay(RELAY_CLIENT_LEFT, name)
+
+    def send_messages(self):
+        # Relay before sending, since sending clears the channels. Channel
+        # creations go first so that the other workers know a channel before
+        # they get its messages.
+        for channel_name in self.irc_handler.pop_new_channels():
+            self.relay(RELAY_CHANNEL_CREATED, channel_name)
+
+        for channel in self.irc_handler.pending_channels:
+            for message in channel.messages:
+                if message.is_notice:
+                    kind = RELAY_CHANNEL_NOTICE
+                else:
+                    kind = RELAY_CHANNEL_MESSAGE
+
+                self.relay(kind, channel.name, message.sender_client_name,
+                           message.message)
+
+        # Private messages to clients of other workers are relayed to all of
+        # them, and the one that has the recipient delivers it.
+        for client_name, message in self.irc_handler.direct_messages:
+            if client_name in self.remote_client_names:
+                self.relay(RELAY_DIRECT_MESSAGE, client_name,
+                           message.sender_client_name, message.message)
+
+        Server.send_messages(self)
+
+    def relay(self, kind, *fields):
+        for connection in self.relay_connections.values():
+            frame = connection.frame_buffer.frame(
+                pack_relay_record(kind, *fields)
+            )
+            connection.outbound_queue.push(frame)
+            self._queued_connections.add(connection)
+
+    def receive_relay_data(self, connection):
+        try:
+            data = connection.socket.recv(RELAY_RECV_BUFFER_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+
+        if not data:
+            # A worker only goes away when the whole server is shutting down.
+            raise RelayLinkClosedError()
+
+        for record in connection.frame_buffer.feed(data):
+            kind, fields = unpack_relay_record(record)
+
+            if kind == RELAY_CHANNEL_MESSAGE:
+                self.deliver_relayed_message(*fields)
+            elif kind == RELAY_CHANNEL_NOTICE:
+                self.deliver_relayed_message(*fields, is_notice=True)
+            elif kind == RELAY_DIRECT_MESSAGE:
+                self.deliver_relayed_direct_message(*fields)
+            elif kind == RELAY_CHANNEL_CREATED:
+                self.irc_handler.add_replicated_channel(fields[0])
+            elif kind == RELAY_CLIENT_JOINED:
+                self.remote_client_names.add(
+                    self.irc_handler.intern_name(fields[0]))
+            elif kind == RELAY_CLIENT_LEFT:
+                self.remote_client_names.discard(fields[0])
+
+    def deliver_relayed_message(self, channel_name, sender_client_name,
+                                message, is_notice=False):
+        channel = self.irc_handler.channels.get(channel_name)
+        if channel is None:
+            return
+
+        # The message doesn't go through the channel, or it would be relayed
+        # right back. It is still encoded only once for all recipients.
+        message = Message(self.irc_handler.intern_name(sender_client_name),
+                          message, is_notice)
+        for client in channel.clients.values():
+            if client.name != sender_client_name:
+                self.queue_message(client.name, message)
+
+        # The worker of the sender has already logged it.
+        if not is_notice:
+            channel.history.extend([message], log=False)
+
+    def deliver_relayed_direct_message(self, client_name, sender_client_name,
+                                       message):
+        # Every worker gets the message, but only the one with the recipient
+        # has a connection to queue it for.
+        if client_name in self.irc_handler.connected_clients:
+            self.queue_message(client_name, Message(
+                self.irc_handler.intern_name(sender_client_name), message))
+
+
+class MulticoreServer(object):
+    # Forks a number of WorkerServers that share the listening port. Every
+    # pair of workers is connected by a Unix domain socket used to relay
+    # channel traffic between them.
+    def __init__(self, port, num_workers,
+                 event_loop_name=event_loops.DEFAULT_EVENT_LOOP, **kwargs):
+        self.address = 'localhost'
+        self.port = int(port)
+        self.num_workers = num_workers
+        self.event_loop_name = event_loop_name
+        self.worker_kwargs = kwargs
+        self.worker_pids = list()
+        self._port_socket = None
+        self._parent_end = None
+
+    def run(self):
+        if self.port == 0:
+            self._reserve_port()
+
+        links = [list() for _ in range(self.num_workers)]
+        for i in range(self.num_workers):
+            for j in range(i + 1, self.num_workers):
+                end_i, end_j = socket.socketpair(socket.AF_UNIX,
+                                                 socket.SOCK_STREAM)
+                links[i].append(end_i)
+                links[j].append(end_j)
+
+        # Every worker has the same end of this, and only the parent has the
+        # other, so that the workers hear about it when the parent is gone,
+        # even if it was killed before it could stop them.
+        parent_end, worker_end = socket.socketpair(socket.AF_UNIX,
+                                                   socket.SOCK_STREAM)
+
+        logger.info('Server started in port %s with %s workers.', self.port,
+                    self.num_workers)
+
+        for i in range(self.num_workers):
+            pid = os.fork()
+            if pid == 0:
+                parent_end.close()
+                for j, worker_links in enumerate(links):
+                    if j != i:
+                        for link in worker_links:
+                            link.close()
+
+                self._run_worker(links[i], worker_end)
+            else:
+                self.worker_pids.append(pid)
+
+        worker_end.close()
+        self._parent_end = parent_end
+        for worker_links in links:
+            for link in worker_links:
+                link.close()
+
+        # If one worker dies, its clients are gone and the others can no
+        # longer relay to it, so we take the whole server down. Only our
+        # own workers count, and a wait cut short by a signal is tried again.
+        while self.worker_pids:
+            try:
+                pid, status = os.wait()
+            except InterruptedError:
+                continue
+
+            if pid in self.worker_pids:
+                self.worker_pids.remove(pid)
+                raise WorkerExitedError(pid,
+                                        os.waitstatus_to_exitcode(status))
+
+    def close(self):
+        for pid in self.worker_pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+
+        self.worker_pids = list()
+
+        if self._parent_end is not None:
+            self._parent_end.close()
+            self._parent_end = None
+
+        if self._port_socket is not None:
+            self._port_socket.close()
+            self._port_socket = None
+
+    def _reserve_port(self):
+        # All of the workers have to bind to the same port, so we can't let
+        # each of them pick one. We bind to port 0 here, without listening,
+        # and keep the socket open so that no one else takes the port.
+        self._port_socket = socket.socket()
+        self._port_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT,
+                                     1)
+        self._port_socket.bind((self.address, 0))
+        self.port = self._port_socket.getsockname()[1]
+
+    def _run_worker(self, links, parent_link):
+        status = 0
+        # Each worker needs an event loop of its own. An epoll instance
+        # created before forking would be shared by all of them.
+        worker = WorkerServer(
+            self.port, links, parent_link,
+            event_loop=event_loops.create_event_loop(self.event_loop_name),
+            **self.worker_kwargs
+        )
+        try:
+            worker.run()
+        except KeyboardInterrupt:
+            pass
+        except ParentProcessGoneError:
+            logger.info('Worker %s lost its parent process. Stopping...',
+                        os.getpid())
+        except Exception:
+            logger.exception('Server message (ERROR):')
+            status = 1
+        finally:
+            worker.close()
+            # os._exit() skips the usual cleanup, so the logs have to be
+            # written out by hand.
+            server_logging.shutdown_logging()
+            sys.stdout.flush()
+            os._exit(status)
+
+
+class RelayLinkClosedError(Exception):
+    def __init__(self):
+        Exception.__init__(self, 'Lost the connection to another worker.')
+
+
+class ParentProcessGoneError(Exception):
+    def __init__(self):
+        Exception.__init__(self, 'The parent process is gone.')
+
+
+class WorkerExitedError(Exception):
+    def __init__(self, pid, exit_code):
+        Exception.__init__(self, 'Worker {} exited with status {}.'.format(
+            pid, exit_code))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='CMSC 135 Chat Server '
+                                                 + '(multicore)')
+    parser.add_argument('port', type=int, help='Port to listen on.')
+    parser.add_argument(
+        '--workers', dest='workers', type=int, default=os.cpu_count(),
+        help='Number of worker processes. Defaults to the number of CPUs.')
+    parser.add_argument(
+        '--event-loop', dest='event_loop',
+        choices=sorted(event_loops.EVENT_LOOPS.keys()),
+        default=event_loops.DEFAULT_EVENT_LOOP,
+        help='Event loop backend used by each worker.')
+    parser.add_argument(
+        '--high-water-mark', dest='high_water_mark', type=int,
+        default=outbound_queue.DEFAULT_HIGH_WATER_MARK,
+        help='Number of bytes that may be queued for a client before the '
+             + 'slow consumer policy kicks in.')
+    parser.add_argument(
+        '--slow-consumer-policy', dest='slow_consumer_policy',
+        choices=outbound_queue.SLOW_CONSUMER_POLICIES,
+        default=outbound_queue.DEFAULT_SLOW_CONSUMER_POLICY,
+        help='What to do with clients that are over the high-water mark.')
+    parser.add_argument(
+        '--history-length', dest='history_length', type=int,
+        default=channel_history.DEFAULT_HISTORY_LENGTH,
+        help='Number of recent messages kept for each channel and replayed '
+             + 'to clients that join it.')
+    parser.add_argument(
+        '--history-dir', dest='history_dir',
+        help='Directory where every channel message is logged, one file per '
+             + 'channel.')
+    parser.add_argument(
+        '--intern-names', dest='intern_names', action='store_true',
+        help='Keep a single copy of each client and channel name in memory.')
+    parser.add_argument(
+        '--idle-timeout', dest='idle_timeout', type=float, default=0,
+        help='Seconds that a client may go without sending anything before '
+             + 'it is kicked off. Off by default.')
+    parser.add_argument(
+        '--heartbeat-interval', dest='heartbeat_interval', type=float,
+        default=0,
+        help='Seconds of quiet after which the kernel starts checking with '
+             + 'TCP keepalives that a client is still there. Off by default.')
+    rate_limit.add_rate_limit_arguments(parser)
+    server_logging.add_logging_arguments(parser)
+    args = parser.parse_args()
+
+    server_logging.configure_logging_from_arguments(args)
+    # The workers inherit this, and the parent stops them on its way out.
+    exit_on_sigterm()
+
+    client_rate_limit, channel_rate_limit = \
+        rate_limit.create_rate_limits_from_arguments(args)
+
+    server = MulticoreServer(
+        args.port, args.workers,
+        event_loop_name=args.event_loop,
+        high_water_mark=args.high_water_mark,
+        slow_consumer_policy=args.slow_consumer_policy,
+        history_length=args.history_length,
+        history_directory=args.history_dir,
+        intern_names=args.intern_names,
+        summary_interval=args.summary_interval,
+        idle_timeout=args.idle_timeout,
+        heartbeat_interval=args.heartbeat_interval,
+        client_rate_limit=client_rate_limit,
+        channel_rate_limit=channel_rate_limit,
+        rate_limit_action=args.rate_limit_action
+    )
+    try:
+        server.run()
+    except KeyboardInterrupt:
+        pass
+    except Exception:
+        logger.exception('Server message (ERROR):')
+    finally:
+        server.close()
+        server_logging.shutdown_logging()
@@ -0,0 +1,185 @@
+import collections
+import itertools
+import os
+import socket
+import ssl
+
+
+# What to do with a client whose queue is over its high-water mark:
+#   drop:       throw away the new message.
+#   disconnect: kick the client off the server.
+#   coalesce:   throw away the oldest queued messages to make room for the
+#               new one, so the client skips ahead to the latest traffic.
+SLOW_CONSUMER_POLICIES = ('drop', 'disconnect', 'coalesce')
+
+DEFAULT_SLOW_CONSUMER_POLICY = 'drop'
+
+# Number of bytes that may wait in a client's queue. This is 1000 messages
+# of 200 bytes each.
+DEFAULT_HIGH_WATER_MARK = 200 * 1000
+
+# The most buffers that one sendmsg() call accepts.
+try:
+    MAX_BUFFERS = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    MAX_BUFFERS = 16
+
+# Not every platform has sendmsg(). Those that don't get one send() per chunk.
+HAS_SENDMSG = hasattr(socket.socket, 'sendmsg')
+
+
+class OutboundQueue(object):
+    # Bytes waiting to be written to a client socket. The queue is flushed
+    # whenever the socket is writable, so a client that reads slowly only
+    # grows its own queue instead of blocking the server.
+    def __init__(self, high_water_mark=DEFAULT_HIGH_WATER_MARK,
+                 policy=DEFAULT_SLOW_CONSUMER_POLICY,
+                 max_batch_size=MAX_BUFFERS):
+        if policy not in SLOW_CONSUMER_POLICIES:
+            raise ValueError('Unknown slow consumer policy \'{}\'.'.format(
+                policy))
+
+        self._high_water_mark = high_water_mark
+        self._policy = policy
+        # The most queued messages handed to a single send call.
+        self._max_batch_size = max(1, min(max_batch_size, MAX_BUFFERS))
+        self._num_send_calls = 0
+        self._num_sent_bytes = 0
+        self._chunks = collections.deque()
+        self._size = 0
+        # Number of bytes of the first chunk that were already written by a
+        # partial send().
+        self._offset = 0
+        # Number of chunks at the front that must stay put. A TLS write that
+        # couldn't go through has to be tried again with the same bytes, so
+        # its chunks are pinned until it does.
+        self._num_pinned = 1
+        self._dropped = 0
+
+    @property
+    def size(self):
+        return self._size - self._offset
+
+    @property
+    def dropped(self):
+        return self._dropped
+
+    @property
+    def num_send_calls(self):
+        return self._num_send_calls
+
+    @property
+    def num_sent_bytes(self):
+        return self._num_sent_bytes
+
+    def is_empty(self):
+        return self.size == 0
+
+    def peek_pending(self):
+        # The bytes that are still to be written, in one piece.
+        return b''.join(self._chunks)[self._offset:]
+
+    def push(self, data):
+        if self.size + len(data) > self._high_water_mark:
+            if self._policy == 'disconnect':
+                raise SlowConsumerError()
+            elif self._policy == 'drop':
+                self._dropped += 1
+                return
+            else:
+                self._make_room(len(data))
+
+        self._chunks.append(data)
+        self._size += len(data)
+
+    def flush(self, client_socket):
+        # Writes as much as the socket takes without blocking. Returns True
+        # once everything has been written.
+        while self._chunks:
+            try:
+                num_sent = self._send(client_socket)
+            except (BlockingIOError, InterruptedError, ssl.SSLWantWriteError,
+                    ssl.SSLWantReadError):
+                return False
+
+            self._consume(num_sent)
+            self._num_sent_bytes += num_sent
+            if self._chunks and num_sent == 0:
+                return False
+
+        return True
+
+    def _send(self, client_socket):
+        # Hand as many queued chunks as we can to a single sendmsg() call.
+        # Chunks are shared between recipients, so gathering them saves us
+        # from joining them into a new buffer for every client.
+        with memoryview(self._chunks[0]) as first_chunk:
+            buffers = [first_chunk[self._offset:]]
+            buffers.extend(itertools.islice(self._chunks, 1,
+                                            self._max_batch_size))
+
+            self._num_send_calls += 1
+            if isinstance(client_socket, ssl.SSLSocket):
+                # TLS sockets have no sendmsg(). Joining the chunks still
+                # sends them in as few records as possible.
+                self._num_pinned = len(buffers)
+                return client_socket.send(b''.join(buffers))
+            elif HAS_SENDMSG:
+                return client_socket.sendmsg(buffers)
+            else:
+                return client_socket.send(buffers[0])
+
+    def _consume(self, num_sent):
+        num_sent += self._offset
+        while self._chunks and num_sent >= len(self._chunks[0]):
+            chunk = self._chunks.popleft()
+            num_sent -= len(chunk)
+            self._size -= len(chunk)
+
+        # Whatever is left was a partial write of the first chunk.
+        self._offset = num_sent
+        self._num_pinned = 1
+
+    def _make_room(self, num_bytes):
+        # The first chunk may be partially sent, and cutting it off would
+        # corrupt the stream, so it always stays, along with any other pinned
+        # chunks.
+        while (len(self._chunks) > self._num_pinned
+               and self.size + num_bytes > self._high_water_mark):
+            oldest = self._chunks[self._num_pinned]
+            del self._chunks[self._num_pinned]
+            self._size -= len(oldest)
+            self._dropped += 1
+
+
+class BatchingCounters(object):
+    # Keeps track of how many send calls batching saved. Without batching,
+    # every queued message would take a send call of its own.
+    def __init__(self):
+        self.num_ticks = 0
+        self.num_messages = 0
+        self.num_send_calls = 0
+        self.last_tick_messages = 0
+        self.last_tick_send_calls = 0
+
+    @property
+    def saved_send_calls(self):
+        return self.num_messages - self.num_send_calls
+
+    @property
+    def last_tick_saved_send_calls(self):
+        return self.last_tick_messages - self.last_tick_send_calls
+
+    def record_tick(self, num_messages, num_send_calls):
+        self.num_ticks += 1
+        self.num_messages += num_messages
+        self.num_send_calls += num_send_calls
+        self.last_tick_messages = num_messages
+        self.last_tick_send_calls = num_send_calls
+
+
+class SlowConsumerError(Exception):
+    def __init__(self):
+        Exception.__init__(self, 'Client is not reading its messages '
+                                 + 'fast enough.')
+
@@ -0,0 +1,113 @@
+import time
+
+
+# What to do with a client that sends faster than its rate limit allows:
+#   drop:       throw the excess messages away.
+#   warn:       throw them away, and tell the client once every time it goes
+#               over the limit.
+#   disconnect: kick the client off the server.
+RATE_LIMIT_ACTIONS = ('drop', 'warn', 'disconnect')
+
+DEFAULT_RATE_LIMIT_ACTION = 'warn'
+
+
+class RateLimit(object):
+    # A rate of messages per second, and the most messages that may be sent
+    # in a burst on top of it. Every client or channel that the limit
+    # applies to has a TokenBucket of its own, and they all share this.
+    __slots__ = ('_rate', '_burst')
+
+    def __init__(self, rate, burst=None):
+        if rate <= 0:
+            raise ValueError('A rate limit needs a positive rate.')
+
+        self._rate = float(rate)
+        # A second's worth of messages by default.
+        self._burst = float(max(1, rate if burst is None else burst))
+
+    @property
+    def rate(self):
+        return self._rate
+
+    @property
+    def burst(self):
+        return self._burst
+
+    def create_bucket(self, now=None):
+        if now is None:
+            now = time.monotonic()
+
+        return TokenBucket(self._burst, now)
+
+
+class TokenBucket(object):
+    # Holds up to burst tokens, which come back at rate tokens per second,
+    # and every message takes one. Tokens are only counted when a message
+    # comes in, from the time since the last one, so idle buckets cost
+    # nothing.
+    __slots__ = ('_tokens', '_updated', 'limited')
+
+    def __init__(self, tokens, now):
+        self._tokens = tokens
+        self._updated = now
+        # Whether the last message was over the limit, so that a client is
+        # only told once each time it goes over.
+        self.limited = False
+
+    def take(self, limit, now):
+        # Returns whether a message sent at time now is within limit.
+        tokens = self._tokens + (now - self._updated) * limit.rate
+        if tokens > limit.burst:
+            tokens = limit.burst
+        self._updated = now
+
+        if tokens < 1:
+            self._tokens = tokens
+            return False
+
+        self._tokens = tokens - 1
+        self.limited = False
+        return True
+
+
+def add_rate_limit_arguments(parser):
+    # The rate limit options shared by all of the servers.
+    parser.add_argument(
+        '--client-rate', dest='client_rate', type=float,
+        help='Messages per second that each client may send. Off if this is '
+             + 'not given.')
+    parser.add_argument(
+        '--client-burst', dest='client_burst', type=float,
+        help='Messages that a client may send at once on top of '
+             + '--client-rate. Defaults to a second\'s worth.')
+    parser.add_argument(
+        '--channel-rate', dest='channel_rate', type=float,
+        help='Messages per second that may be sent to each channel. Off if '
+             + 'this is not given.')
+    parser.add_argument(
+        '--channel-burst', dest='channel_burst', type=float,
+        help='Messages that may be sent to a channel at once on top of '
+             + '--channel-rate. Defaults to a second\'s worth.')
+    parser.add_argument(
+        '--rate-limit-action', dest='rate_limit_action',
+        choices=RATE_LIMIT_ACTIONS, default=DEFAULT_RATE_LIMIT_ACTION,
+        help='What to do with clients that go over --client-rate.')
+
+
+def create_rate_limits_from_arguments(args):
+    # Returns the client and the channel RateLimit, either of which may be
+    # None.
+    client_rate_limit = None
+    if args.client_rate is not None:
+        client_rate_limit = RateLimit(args.client_rate, args.client_burst)
+
+    channel_rate_limit = None
+    if args.channel_rate is not None:
+        channel_rate_limit = RateLimit(args.channel_rate, args.channel_burst)
+
+    return client_rate_limit, channel_rate_limit
+
+
+class ClientFloodingError(Exception):
+    def __init__(self):
+        Exception.__init__(self, 'Client is sending messages too fast.')
@@ -1,11 +1,38 @@
-import select
+import argparse
+import collections
+import logging
+import signal
 import socket
+import ssl
 import sys
-import traceback
-
+import time
+
+import capture
+import channel_history
+import event_loops
+import framing
+import handoff
+import metrics
+import outbound_queue
+import rate_limit
+import server_logging
+import timer_wheel
+import tls
 import utils
 
 
+logger = logging.getLogger(server_logging.LOGGER_NAME)
+message_logger = logging.getLogger(server_logging.MESSAGE_LOGGER_NAME)
+
+
+# How much we read from a client socket in one go. Any bytes past the
+# current message are kept in the connection's frame buffer.
+RECV_BUFFER_SIZE = 4096
+
+# Unanswered keepalive probes after which the kernel drops a connection.
+DEFAULT_KEEPALIVE_PROBES = 3
+
+
 def pad_message(message):
     # We pad the message by 200 since we only expect messages itself to be
     # 200 characters long.
@@ -15,340 +42,1414 @@ def pad_message(message):
     return message
 
 
+def encode_message(message):
+    # Sockets only deal with bytes in Python 3, so this is where we turn a
+    # message into what actually goes on the wire for a client that uses
+    # the default framing.
+    return framing.FIXED_LENGTH.encode(message)
+
+
+def exit_on_sigterm():
+    # systemd, docker stop, and kill stop a process with SIGTERM, which
+    # kills it on the spot unless it is handled. Raising SystemExit instead
+    # unwinds the stack like Ctrl-C does, so that the server gets to close
+    # whatever it has open on the way out.
+    signal.signal(signal.SIGTERM, _exit_on_signal)
+
+
+def _exit_on_signal(signum, frame):
+    sys.exit(128 + signum)
+
+
+def enable_keepalive(client_socket, interval,
+                     num_probes=DEFAULT_KEEPALIVE_PROBES):
+    # Has the kernel probe the peer once the connection has been quiet for
+    # interval seconds, and then every interval seconds, and drop it after
+    # num_probes probes go unanswered. A peer that is gone without having
+    # closed the connection then fails our next recv(). Only TCP sockets
+    # have keepalives, and the fine-grained options are Linux's.
+    if client_socket.family not in (socket.AF_INET, socket.AF_INET6):
+        return
+
+    interval = max(1, int(interval))
+    client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    if hasattr(socket, 'TCP_KEEPIDLE'):
+        client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE,
+                                 interval)
+        client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL,
+                                 interval)
+        client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT,
+                                 num_probes)
+
+
 class Server(object):
-    def __init__(self, port):
+    def __init__(self, port, event_loop=None,
+                 high_water_mark=outbound_queue.DEFAULT_HIGH_WATER_MARK,
+                 slow_consumer_policy=outbound_queue.DEFAULT_SLOW_CONSUMER_POLICY,
+                 flush_interval=0, max_batch_size=outbound_queue.MAX_BUFFERS,
+                 history_length=channel_history.DEFAULT_HISTORY_LENGTH,
+                 history_directory=None, intern_names=False,
+                 summary_interval=server_logging.DEFAULT_SUMMARY_INTERVAL,
+                 admin_port=None, tls_port=None, tls_context=None,
+                 idle_timeout=0, heartbeat_interval=0, client_rate_limit=None,
+                 channel_rate_limit=None,
+                 rate_limit_action=rate_limit.DEFAULT_RATE_LIMIT_ACTION,
+                 handoff_path=None, capture_path=None, clock=time.monotonic):
         self.address = 'localhost'
         self.port = int(port)
         self.server_socket = None
-        self.irc_handler = IRCHandler()
-        self.client_socket_id_map = dict()
-        self.socket_id_client_map = dict()
-
-    def create_client(self, client_socket):
-        name = self._recv_all(client_socket).strip()
-        if name in self.client_socket_id_map:
+        self.event_loop = event_loop
+        if self.event_loop is None:
+            self.event_loop = event_loops.create_event_loop()
+
+        self.high_water_mark = high_water_mark
+        self.slow_consumer_policy = slow_consumer_policy
+        # Outbound queues are flushed at most once every flush_interval
+        # seconds, so that messages from several ticks go out in one send
+        # call. An interval of 0 flushes them every tick.
+        self.flush_interval = flush_interval
+        self.max_batch_size = max_batch_size
+        self.batching_counters = outbound_queue.BatchingCounters()
+        self._next_flush_time = 0
+        self._tick_messages = 0
+        self._tick_send_calls = 0
+
+        # Every channel keeps its last history_length messages, and appends
+        # all of them to a log in history_directory if one is given.
+        self.history_length = history_length
+        self.history_directory = history_directory
+
+        self.intern_names = intern_names
+
+        # Clients, and channels, that send messages faster than their
+        # rate_limit.RateLimit get rate_limit_action. Either limit is off if
+        # it is None.
+        self.client_rate_limit = client_rate_limit
+        self.channel_rate_limit = channel_rate_limit
+        self.rate_limit_action = rate_limit_action
+
+        self.irc_handler = IRCHandler(history_length, history_directory,
+                                      intern_names, client_rate_limit,
+                                      channel_rate_limit, rate_limit_action,
+                                      clock)
+        self.connections = ConnectionRegistry()
+
+        # Running totals that are logged every summary_interval seconds.
+        self.summary_logger = server_logging.SummaryLogger(summary_interval)
+        self.num_accepted = 0
+        self.num_disconnected = 0
+        self.num_received_messages = 0
+        self.num_received_bytes = 0
+        self.num_sent_bytes = 0
+
+        # The metrics are served on admin_port, if one is given. Only the
+        # fan-out latency has to be measured on the hot path, so that is
+        # only done when someone can see it.
+        self.admin_port = admin_port
+        self.admin_endpoint = None
+        self.metrics = metrics.MetricsRegistry()
+        self.fan_out_latency = None
+        self._fan_out_start_times = list()
+        self._register_metrics()
+
+        # Clients may also connect with TLS on tls_port, if one is given,
+        # with the certificate of tls_context.
+        self.tls_port = tls_port
+        self.tls_context = tls_context
+        self.tls_listener = None
+
+        # Connections that send nothing for idle_timeout seconds are kicked
+        # off, and the kernel checks on connections that are quiet for
+        # heartbeat_interval seconds. Either is off if it is 0. Every
+        # connection's idle deadline is a timer in the timer wheel, so
+        # keeping track of them costs the same however many there are.
+        self.idle_timeout = idle_timeout
+        self.heartbeat_interval = heartbeat_interval
+        # Idle deadlines, flushes, summaries, rate limits, and TLS
+        # handshakes go by clock, which tests may swap for one that they move
+        # forward themselves.
+        self.clock = clock
+        self.timers = timer_wheel.TimerWheel(clock=clock)
+        self.num_reaped = 0
+        # When the current tick woke up. Received data is stamped with it.
+        self.now = self.clock()
+
+        # A new server process started with the same handoff_path takes
+        # over the listening sockets and the connections of this one, which
+        # stops once it has. Clients don't notice.
+        self.handoff_path = handoff_path
+        self.handoff_listener = None
+        self.handed_off = False
+        self._handoff_socket = None
+
+        # Every frame that arrives, and every connection that comes and goes,
+        # is recorded to a capture at capture_path, if one is given, so that
+        # the session can be replayed later. Recording only copies the frame
+        # into the capture's buffer, which is written out at least once a
+        # second.
+        self.capture_path = capture_path
+        self.capture = None
+
+        # Connections that got new data in their outbound queues this tick,
+        # and the ones that went over their high-water mark and need to be
+        # kicked off.
+        self._queued_connections = set()
+        self._slow_connections = set()
+
+    def create_client(self, connection, name):
+        if self.connections.has_name(name):
             raise ClientNameExistsError()
 
-        client_address = client_socket.getpeername()[0]
-        client = Client(name, client_address, None)
+        name = self.irc_handler.intern_name(name)
+        client = Client(name, connection.address)
 
         self.irc_handler.add_client(client)
         # Note that the client's name will act as its ID.
-        self.socket_id_client_map[id(client_socket)] = client
-        self.client_socket_id_map[name] = client_socket
+        connection.client = client
+        self.connections.bind_name(connection, name)
 
     def remove_client(self, name):
         self.irc_handler.remove_client(name)
 
-        socket_id = id(self.client_socket_id_map[name])
-        del self.socket_id_client_map[socket_id]
-        del self.client_socket_id_map[name]
+        self.connections.unbind_name(name)
 
-    def run(self):
-        print('Server started in port {}.'.format(self.port))
+    def start(self):
+        if self.capture_path is not None:
+            self.capture = capture.CaptureWriter(self.capture_path)
 
-        self.server_socket = socket.socket()
-        self.server_socket.bind((self.address, self.port))
-        self.server_socket.listen(5)
+        # Take over from the server at the handoff path, if there is one
+        # running.
+        handoff_socket = None
+        if self.handoff_path is not None:
+            handoff_socket = handoff.connect(self.handoff_path)
 
-        client_sockets = [self.server_socket]
-        while True:
-            # Wait for messages from clients forever. At least here, we have
-            # a forever.
-            readable, writable, errored = select.select(client_sockets, [], [])
-            for s in readable:
-                if s is self.server_socket:
-                    client_socket, address = self.server_socket.accept()
+        tls_socket = None
+        if handoff_socket is not None:
+            handoff_start = time.perf_counter()
+            tls_socket = self.take_over(handoff_socket)
+        else:
+            self.server_socket = self.create_server_socket()
+            self.server_socket.bind((self.address, self.port))
+            # A backlog of 5 is fine for a handful of users, but thousands
+            # of clients connecting at once will overflow it.
+            self.server_socket.listen(socket.SOMAXCONN)
+
+        # Port 0 lets the OS pick a port, so report the one we really got.
+        self.port = self.server_socket.getsockname()[1]
+
+        self.event_loop.register(self.server_socket, event_loops.EVENT_READ)
+
+        if self.admin_port is not None:
+            self.fan_out_latency = self.metrics.histogram(
+                'chat_fan_out_seconds',
+                'Time from processing a client message until the send calls '
+                + 'of the tick that handled it.')
+            self.admin_endpoint = metrics.AdminEndpoint(
+                self.metrics, self.event_loop, self.address, self.admin_port)
+            self.admin_endpoint.start()
+            self.admin_port = self.admin_endpoint.port
+
+        if self.tls_port is not None:
+            self.tls_listener = tls.TLSListener(self.tls_context,
+                                                self.event_loop,
+                                                self.add_connection,
+                                                self.address, self.tls_port,
+                                                clock=self.clock)
+            self.tls_listener.start(tls_socket)
+            self.tls_port = self.tls_listener.port
+        elif tls_socket is not None:
+            tls_socket.close()
+
+        if self.handoff_path is not None:
+            self.handoff_listener = handoff.HandoffListener(self.handoff_path,
+                                                            self.event_loop)
+            self.handoff_listener.start()
+
+        # The old server stops once it hears that everything is in place.
+        if handoff_socket is not None:
+            handoff.acknowledge(handoff_socket)
+            handoff_socket.close()
+
+            logger.info('Took over %s connections and %s channels in %.1f '
+                        'ms.', len(self.connections),
+                        len(self.irc_handler.channels),
+                        (time.perf_counter() - handoff_start) * 1000)
+
+    def create_server_socket(self):
+        return socket.socket()
 
+    def run(self):
+        self.start()
+
+        logger.info('Server started in port %s.', self.port)
+        if self.admin_endpoint is not None:
+            logger.info('Serving metrics in port %s.', self.admin_port)
+        if self.tls_listener is not None:
+            logger.info('Accepting TLS connections in port %s.',
+                        self.tls_port)
+
+        while not self.handed_off:
+            # Wait for messages from clients until another server takes
+            # over, which may well be forever.
+            self.step()
+
+    def step(self, timeout=None):
+        # Don't sleep past the next flush if there is something to flush.
+        if self._queued_connections and self.flush_interval > 0:
+            time_to_flush = max(0, self._next_flush_time - self.clock())
+            if timeout is None or time_to_flush < timeout:
+                timeout = time_to_flush
+
+        # Nor past the next summary, or an idle server would never log one.
+        if self.summary_logger.interval > 0:
+            if timeout is None or self.summary_logger.interval < timeout:
+                timeout = self.summary_logger.interval
+
+        # Nor past the deadline of the oldest TLS handshake.
+        if self.tls_listener is not None:
+            deadline = self.tls_listener.next_deadline()
+            if deadline is not None:
+                time_to_deadline = max(0, deadline - self.clock())
+                if timeout is None or time_to_deadline < timeout:
+                    timeout = time_to_deadline
+
+        # Nor past the time when the capture's buffer is due to be written
+        # out.
+        if self.capture is not None:
+            deadline = self.capture.next_flush_time()
+            if deadline is not None:
+                time_to_deadline = max(0, deadline - self.clock())
+                if timeout is None or time_to_deadline < timeout:
+                    timeout = time_to_deadline
+
+        # Nor past the next timer.
+        deadline = self.timers.next_deadline()
+        if deadline is not None:
+            time_to_deadline = max(0, deadline - self.clock())
+            if timeout is None or time_to_deadline < timeout:
+                timeout = time_to_deadline
+
+        ready = self.event_loop.poll(timeout)
+        self.now = self.clock()
+        for s, events in ready:
+            self.handle_event(s, events)
+
+        # Clients that are kicked off here get their leave notices sent
+        # along with everything else.
+        self.timers.advance(self.now)
+
+        self.send_messages()
+
+        if self.tls_listener is not None:
+            self.tls_listener.expire_handshakes(self.now)
+
+        now = self.clock()
+
+        if now >= self._next_flush_time:
+            self.flush_queued_connections()
+            self._next_flush_time = now + self.flush_interval
+
+            if self._fan_out_start_times:
+                self._observe_fan_out_latency()
+
+        self.batching_counters.record_tick(self._tick_messages,
+                                           self._tick_send_calls)
+        self._tick_messages = 0
+        self._tick_send_calls = 0
+
+        if self.capture is not None:
+            self.capture.flush_if_due(now)
+
+        if self.summary_logger.is_due(now):
+            self.log_summary(now)
+
+        # A new server asked to take over. Everything of this tick has been
+        # handled, so there is as little in flight as there can be.
+        if self._handoff_socket is not None:
+            handoff_socket = self._handoff_socket
+            self._handoff_socket = None
+            self.hand_off(handoff_socket)
+
+        # The number of sockets that were ready, so that callers can tell an
+        # idle tick from a busy one.
+        return len(ready)
+
+    def log_summary(self, now):
+        counters = [
+            ('accepted', self.num_accepted),
+            ('disconnected', self.num_disconnected),
+            ('received', self.num_received_messages),
+            ('queued', self.batching_counters.num_messages),
+            ('send calls', self.batching_counters.num_send_calls),
+        ]
+        gauges = [
+            ('connections', len(self.connections)),
+            ('channels', len(self.irc_handler.channels)),
+            ('slow', len(self._slow_connections)),
+        ]
+        self.summary_logger.log(now, counters, gauges)
+
+    def _observe_fan_out_latency(self):
+        # Recipients whose sockets couldn't take everything get the rest
+        # later, which isn't counted here.
+        now = time.perf_counter()
+        for start_time in self._fan_out_start_times:
+            self.fan_out_latency.observe(now - start_time)
+
+        self._fan_out_start_times[:] = []
+
+    def _register_metrics(self):
+        registry = self.metrics
+        registry.gauge('chat_connections', 'Open client connections.',
+                       lambda: len(self.connections))
+        registry.gauge('chat_clients', 'Clients that have sent their name.',
+                       lambda: len(self.irc_handler.connected_clients))
+        registry.gauge('chat_channels', 'Channels.',
+                       lambda: len(self.irc_handler.channels))
+        registry.gauge('chat_channel_clients', 'Clients in each channel.',
+                       lambda: [({'channel': channel.name},
+                                 len(channel.clients))
+                                for channel in
+                                self.irc_handler.channels.values()])
+        registry.gauge('chat_outbound_queue_bytes',
+                       'Bytes waiting to be sent to each client.',
+                       lambda: [({'client': connection.client.name},
+                                 connection.outbound_queue.size)
+                                for connection in self.connections
+                                if connection.client is not None])
+        registry.counter('chat_connections_accepted_total',
+                         'Client connections accepted.',
+                         lambda: self.num_accepted)
+        registry.counter('chat_connections_closed_total',
+                         'Client connections closed.',
+                         lambda: self.num_disconnected)
+        registry.counter('chat_messages_received_total',
+                         'Messages received from clients.',
+                         lambda: self.num_received_messages)
+        registry.counter('chat_messages_sent_total',
+                         'Messages queued for clients, once per recipient.',
+                         lambda: self.batching_counters.num_messages)
+        registry.counter('chat_send_calls_total',
+                         'Send calls made to client sockets.',
+                         lambda: self.batching_counters.num_send_calls)
+        registry.counter('chat_bytes_received_total',
+                         'Bytes received from clients.',
+                         lambda: self.num_received_bytes)
+        registry.counter('chat_bytes_sent_total', 'Bytes sent to clients.',
+                         lambda: self.num_sent_bytes)
+        registry.counter('chat_connections_reaped_total',
+                         'Connections closed for being idle too long.',
+                         lambda: self.num_reaped)
+        registry.counter('chat_messages_rate_limited_total',
+                         'Messages dropped for going over a rate limit.',
+                         lambda: self.irc_handler.num_rate_limited)
+        registry.counter('chat_tls_handshakes_total',
+                         'TLS handshakes completed.',
+                         lambda: self._tls_counter('num_handshakes'))
+        registry.counter('chat_tls_resumed_handshakes_total',
+                         'TLS handshakes that resumed an earlier session.',
+                         lambda: self._tls_counter('num_resumed'))
+        registry.counter('chat_tls_failed_handshakes_total',
+                         'TLS handshakes that failed or timed out.',
+                         lambda: self._tls_counter('num_failed'))
+
+    def _tls_counter(self, name):
+        if self.tls_listener is None:
+            return 0
+
+        return getattr(self.tls_listener, name)
+
+    def handle_event(self, s, events):
+        if s is self.server_socket:
+            self.accept_client()
+            return
+
+        if (self.admin_endpoint is not None
+                and self.admin_endpoint.handles(s)):
+            self.admin_endpoint.handle_event(s, events)
+            return
+
+        if self.tls_listener is not None and self.tls_listener.handles(s):
+            self.tls_listener.handle_event(s, events)
+            return
+
+        if (self.handoff_listener is not None
+                and self.handoff_listener.handles(s)):
+            self._handoff_socket = self.handoff_listener.accept()
+            return
+
+        # The connection may have been closed earlier in this tick.
+        connection = self.connections.get(s.fileno())
+        if connection is None:
+            return
+
+        if events & event_loops.EVENT_WRITE:
+            self.flush_connection(connection)
+        if events & event_loops.EVENT_READ:
+            self.receive_client_data(connection)
+
+    def accept_client(self):
+        client_socket, address = self.server_socket.accept()
+        self.add_connection(client_socket, address[0])
+
+    def add_connection(self, client_socket, address):
+        connection = self._register_connection(client_socket, address,
+                                               self.clock())
+        self.num_accepted += 1
+
+        if self.capture is not None:
+            self.capture.record_connect(connection.fileno, address, self.now)
+
+    def _register_connection(self, client_socket, address, last_active):
+        # Writes are queued and flushed when the socket is writable, so a
+        # slow client never blocks the server.
+        client_socket.setblocking(False)
+        # Every tick's messages already go out in as few sends as they can,
+        # so Nagle's algorithm would only hold the next tick's back until
+        # the client's delayed ACK comes, which is tens of milliseconds.
+        if client_socket.family in (socket.AF_INET, socket.AF_INET6):
+            client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        # The client is only created once its name arrives, which may take
+        # several ticks if the name is sent in pieces.
+        connection = Connection(client_socket, address,
+                                outbound_queue.OutboundQueue(
+                                    self.high_water_mark,
+                                    self.slow_consumer_policy,
+                                    self.max_batch_size
+                                ))
+        connection.last_active = last_active
+        self.connections.add(connection)
+        self.event_loop.register(client_socket, event_loops.EVENT_READ)
+
+        if self.heartbeat_interval > 0:
+            enable_keepalive(client_socket, self.heartbeat_interval)
+        if self.idle_timeout > 0:
+            self.schedule_idle_check(connection, connection.last_active)
+
+        return connection
+
+    def schedule_idle_check(self, connection, last_active):
+        connection.idle_timer = self.timers.schedule(
+            last_active + self.idle_timeout,
+            lambda: self.check_idle(connection))
+
+    def check_idle(self, connection):
+        # Connections aren't rescheduled every time they get data, which
+        # would cost a timer per message. They only get a new timer here, if
+        # they got anything since the last one was set.
+        if connection.last_active + self.idle_timeout > self.now:
+            self.schedule_idle_check(connection, connection.last_active)
+            return
+
+        name = connection.client.name if connection.client else None
+        logger.info('Connection from %s (%s) has been idle for %s seconds. '
+                    'Kicking it off...', connection.address, name,
+                    self.idle_timeout)
+        self.num_reaped += 1
+        self.disconnect(connection)
+
+    def receive_client_data(self, connection):
+        # We only get here when the socket is readable, so a single recv()
+        # never blocks. Whatever arrived is buffered until it makes up
+        # complete messages, so a client sending half a message can't stall
+        # everyone else.
+        try:
+            data = connection.socket.recv(RECV_BUFFER_SIZE)
+            # A TLS record can hold more than we read. The rest of it is off
+            # the socket already, so the event loop won't tell us about it.
+            while connection.is_tls and data and connection.socket.pending():
+                data += connection.socket.recv(RECV_BUFFER_SIZE)
+        except (BlockingIOError, InterruptedError, ssl.SSLWantReadError,
+                ssl.SSLWantWriteError):
+            # A TLS socket may have only had a record without any data for
+            # us, like a session ticket or a key update.
+            return
+        except socket.error:
+            data = b''
+
+        if not data:
+            self.disconnect(connection)
+            return
+
+        self.num_received_bytes += len(data)
+        connection.last_active = self.now
+
+        frames = collections.deque(connection.frame_buffer.feed(data))
+        while frames:
+            frame = frames.popleft()
+            if self.capture is not None:
+                self.capture.record_frame(connection.fileno, frame, self.now)
+            message = connection.framing.decode(frame)
+
+            if connection.client is None:
+                try:
+                    self.create_client(connection, message.strip())
+                except ClientNameExistsError:
+                    logger.info('Client connected with a name, \'%s\', that '
+                                'is already used by another client. Kicking '
+                                'this client off...', message.strip())
                     try:
-                        self.create_client(client_socket)
-                    except ClientNameExistsError:
-                        print('Client connected with a name that is '
-                              + 'already used by another client. Kicking this'
-                              + ' client off...')
-                        client_socket.send('Client name is already taken.'
-                                           + ' Use a different one.')
-                        client_socket.close()
+                        connection.socket.send(encode_message(
+                            'Client name is already taken. '
+                            + 'Use a different one.'
+                        ))
+                    except socket.error:
+                        pass
+                    self.disconnect(connection)
 
-                        continue
+                    return
 
-                    client_sockets.append(client_socket)
-                    client = self.socket_id_client_map[id(client_socket)]
+                logger.info('Connection received from %s with a name, '
+                            '\'%s\'.', connection.address, message.strip())
+
+                connection.may_negotiate = True
+                continue
+
+            may_negotiate = connection.may_negotiate
+            connection.may_negotiate = False
+
+            # Only the first message after the name may ask for a framing,
+            # so chat text is never split into blocks here.
+            message_blocks = None
+            if may_negotiate:
+                message_blocks = message.split(None, 1)
+            if (message_blocks
+                    and message_blocks[0] == framing.NEGOTIATION_COMMAND):
+                if self.negotiate_framing(connection, message_blocks[1:]):
+                    # Whatever came after the negotiation is in the new
+                    # framing, so it has to be cut up again.
+                    leftover = b''.join(frames)
+                    leftover += connection.switch_framing(
+                        framing.FRAMINGS[message_blocks[1].strip()]
+                    )
+                    frames = collections.deque(
+                        connection.frame_buffer.feed(leftover)
+                    )
+            elif message.strip():
+                self.num_received_messages += 1
+                if self.fan_out_latency is not None:
+                    self._fan_out_start_times.append(time.perf_counter())
+                try:
+                    self.irc_handler.process_client_message(
+                        message, connection.client.name)
+                except rate_limit.ClientFloodingError:
+                    logger.warning('Client %s is sending messages too fast. '
+                                   'Kicking it off...',
+                                   connection.client.name)
+                    self.disconnect(connection)
 
-                    print('Connection received from {}'.format(client.address)
-                          + ' with a name, \'{}\'.'.format(client.name))
-                else:
-                    client = self.socket_id_client_map[id(s)]
+                    return
 
-                    try:
-                        data = self._recv_all(s)
-                    except socket.error:
-                        continue
+    def negotiate_framing(self, connection, arguments):
+        # Answers a framing request in the current framing. Returns whether
+        # the connection should switch.
+        framing_name = arguments[0].strip() if arguments else ''
+        if framing_name in framing.FRAMINGS:
+            response = framing.NEGOTIATION_ACCEPTED.format(framing_name)
+        else:
+            response = framing.NEGOTIATION_UNKNOWN.format(framing_name)
+
+        logger.info('Client %s asked for %s framing.',
+                    connection.client.name, framing_name or 'no')
+
+        connection.outbound_queue.push(connection.framing.encode(response))
+        self._queued_connections.add(connection)
+
+        return framing_name in framing.FRAMINGS
+
+    def disconnect(self, connection):
+        # Unregistering from the event loop is O(1) for the selectors
+        # backend, and so is removing the connection from the registry.
+        self.event_loop.unregister(connection.socket)
+        self.connections.remove(connection)
+        self._queued_connections.discard(connection)
+        self.num_disconnected += 1
 
-                    if data:
-                        self.irc_handler.process_client_message(data,
-                                                                client.name)
-                    else:
-                        client_sockets.remove(s)  # Could be optimized. We use
-                                                  # the object itself instead 
-                                                  # of the client_name because
-                                                  # we only need to delete
-                                                  # the socket object itself of,
-                                                  # the client which we
-                                                  # obviously already know.
-                        self.remove_client(client.name)
+        if self.capture is not None:
+            self.capture.record_disconnect(connection.fileno, self.now)
 
-                        print('Connection from {} '.format(client.address)
-                              + '({}) disconnected.'.format(client.name))
+        if connection.idle_timer is not None:
+            self.timers.cancel(connection.idle_timer)
+            connection.idle_timer = None
 
-                        s.close()
+        client = connection.client
+        if client is not None:
+            self.remove_client(client.name)
 
-            self.send_messages()
+            logger.info('Connection from %s (%s) disconnected.',
+                        client.address, client.name)
 
-        self.close()
+        connection.socket.close()
 
     def send_messages(self):
+        # Logging every message is expensive, so we only check once whether
+        # it is turned on.
+        log_messages = message_logger.isEnabledFor(logging.DEBUG)
+
         # Send server messages first.
         for server_message in self.irc_handler.server_messages:
-            print('(SERVER) Sending message: {}'.format(
-                server_message.message.strip())
-            )
-            client_socket = self.client_socket_id_map[
-                server_message.sender_client_name
-            ]
-            client_socket.send(pad_message(server_message.message))
+            if log_messages:
+                message_logger.debug('(SERVER) Sending message: %s',
+                                     server_message.message.strip())
+            self.queue_message(server_message.sender_client_name,
+                               server_message)
 
         self.irc_handler.clear_server_messages()
 
-        # Now send the messages of each channel to their subscriber clients.
-        for channel in self.irc_handler.channels.values():
-            for client in channel.clients.values():
-                for message in channel.messages:
+        # Clients that just joined a channel get its recent history before
+        # any of its new messages.
+        for client_name, messages in self.irc_handler.replays:
+            for message in messages:
+                self.queue_message(client_name, message)
+
+        self.irc_handler.clear_replays()
+
+        # Private messages go to their one recipient, who is looked up by
+        # name rather than through any channel.
+        for client_name, message in self.irc_handler.direct_messages:
+            self.queue_message(client_name, message)
+
+        self.irc_handler.clear_direct_messages()
+
+        # Now send the messages of the channels that got any to their
+        # subscriber clients. Each message is encoded once and the same bytes
+        # are queued for every recipient.
+        for channel in self.irc_handler.pending_channels:
+            for message in channel.messages:
+                if log_messages:
+                    message_logger.debug('(CHANNELS) Sending message: %s',
+                                         message.message.strip())
+                for client in channel.clients.values():
                     if message.sender_client_name != client.name:
-                        print('(CHANNELS) Sending '
-                              + 'message: {}'.format(message.message.strip()))
-                        client_socket = self.client_socket_id_map[client.name]
-                        client_socket.send(pad_message(message.message))
+                        self.queue_message(client.name, message)
 
-            channel.clear_messages()
+        self.irc_handler.clear_pending_channels()
 
-    def close(self):
-        self.server_socket.close()
+        # Kicking clients off changes the channels, so we wait until we are
+        # done going through them.
+        for connection in self._slow_connections:
+            logger.warning('Client %s is not reading its messages fast '
+                           'enough. Kicking this client off...',
+                           connection.client.name)
+            self.disconnect(connection)
 
-    def _recv_all(self, client_socket):
-        data = ''
+        self._slow_connections.clear()
 
-        # Timeout once you get empty messages.
-        while len(data) < utils.MESSAGE_LENGTH:
-            readable, _, _ = select.select([client_socket], [], [])
-            data_chunk = ''
-            for s in readable:
-                if s is client_socket:
-                    data_chunk = client_socket.recv(utils.MESSAGE_LENGTH)
-                    data += data_chunk
+    def queue_message(self, client_name, message):
+        # The client may have disconnected earlier in this tick.
+        connection = self.connections.get_by_name(client_name)
+        if connection is None or connection in self._slow_connections:
+            return
 
-            if len(data_chunk) == 0:
-                break
-
-        data = data.strip()
+        try:
+            connection.outbound_queue.push(message.encode(connection.framing))
+        except outbound_queue.SlowConsumerError:
+            self._slow_connections.add(connection)
+            return
+
+        self._queued_connections.add(connection)
+        self._tick_messages += 1
+
+    def flush_queued_connections(self):
+        # Try to write everything queued this tick right away. Sockets that
+        # can't take all of it are watched for writability instead.
+        for connection in self._queued_connections:
+            if not connection.waiting_for_writable:
+                self.flush_connection(connection)
+
+        self._queued_connections.clear()
+
+    def flush_connection(self, connection):
+        num_send_calls = connection.outbound_queue.num_send_calls
+        num_sent_bytes = connection.outbound_queue.num_sent_bytes
+        try:
+            flushed = connection.outbound_queue.flush(connection.socket)
+        except socket.error:
+            # The client went away. Reading from the socket will tell us so
+            # and clean it up.
+            flushed = True
+
+        self._tick_send_calls += \
+            connection.outbound_queue.num_send_calls - num_send_calls
+        self.num_sent_bytes += \
+            connection.outbound_queue.num_sent_bytes - num_sent_bytes
+
+        if flushed != (not connection.waiting_for_writable):
+            connection.waiting_for_writable = not flushed
+
+            events = event_loops.EVENT_READ
+            if connection.waiting_for_writable:
+                events |= event_loops.EVENT_WRITE
+            self.event_loop.modify(connection.socket, events)
+
+    def hand_off(self, handoff_socket):
+        # Sends the listening sockets, the connections, and a snapshot of
+        # everything else to the new server. Nothing is served meanwhile,
+        # which is the pause that clients see. If the new server doesn't
+        # take over, this one carries on as if nothing happened.
+        handoff_start = time.perf_counter()
+
+        # TLS sessions can't leave this process, so TLS clients have to
+        # reconnect. They can resume their sessions with the new server
+        # only if it has the same ticket keys, which it doesn't.
+        for connection in [connection for connection in self.connections
+                           if connection.is_tls]:
+            self.disconnect(connection)
+        self.send_messages()
+
+        # Whatever the sockets take now doesn't have to be in the snapshot.
+        for connection in self.connections:
+            if not connection.outbound_queue.is_empty():
+                self.flush_connection(connection)
+        self._queued_connections.clear()
+
+        connections = list(self.connections)
+        listening_sockets = [self.server_socket]
+        if self.tls_listener is not None:
+            listening_sockets.append(self.tls_listener.listening_socket)
+        # Whatever goes wrong from here on, until the new server says that
+        # it took over, leaves this one serving. The admin port and the
+        # handoff path are only let go once there is a snapshot to send, and
+        # are taken back if it doesn't get through.
+        released = False
+        taken_over = False
+        try:
+            snapshot = self.snapshot(connections)
+
+            # The new server binds the admin port and the handoff path
+            # itself.
+            if self.admin_endpoint is not None:
+                self.admin_endpoint.close()
+            self.handoff_listener.close()
+            released = True
+
+            taken_over = handoff.send_state(
+                handoff_socket,
+                listening_sockets + [connection.socket
+                                     for connection in connections],
+                snapshot)
+        except Exception:
+            logger.exception('Handing off to the new server failed:')
+        handoff_socket.close()
+
+        if not taken_over:
+            logger.error('The new server did not take over. Carrying on.')
+            if released:
+                if self.admin_endpoint is not None:
+                    self.admin_endpoint.start()
+                self.handoff_listener.start()
+
+            return
+
+        self.handed_off = True
+        logger.info('Handed %s connections and %s channels off in %.1f ms, '
+                    'with a snapshot of %s bytes.', len(connections),
+                    len(self.irc_handler.channels),
+                    (time.perf_counter() - handoff_start) * 1000,
+                    len(snapshot))
+
+    def snapshot(self, connections):
+        # Everything that the new server needs to know about the
+        # connections, in the order given, and about the channels.
+        connection_states = list()
+        for connection in connections:
+            client = connection.client
+            client_name = None
+            channel_names = []
+            current_channel_name = None
+            if client is not None:
+                client_name = client.name
+                channel_names = list(client.channels)
+                if client.channel is not None:
+                    current_channel_name = client.channel.name
+
+            connection_states.append(handoff.ConnectionState(
+                connection.address, connection.framing.name, client_name,
+                connection.may_negotiate,
+                max(0.0, self.now - connection.last_active),
+                connection.frame_buffer.peek_pending(),
+                connection.outbound_queue.peek_pending(), channel_names,
+                current_channel_name))
+
+        channel_states = [
+            handoff.ChannelState(
+                channel.name, list(channel.clients),
+                [(message.sender_client_name, message.message)
+                 for message in channel.history])
+            for channel in self.irc_handler.channels.values()
+        ]
+
+        return handoff.encode_snapshot(connection_states, channel_states)
+
+    def take_over(self, handoff_socket):
+        # Takes the listening sockets and the connections of the old server,
+        # and restores its snapshot. Returns the TLS listening socket, if
+        # the old server had one.
+        sockets, snapshot = handoff.receive_state(handoff_socket)
+        connection_states, channel_states = handoff.decode_snapshot(snapshot)
+
+        num_listening = len(sockets) - len(connection_states)
+        listening_sockets = sockets[:num_listening]
+        self.server_socket = listening_sockets[0]
+        self.server_socket.setblocking(False)
+
+        now = self.clock()
+        for client_socket, state in zip(sockets[num_listening:],
+                                        connection_states):
+            connection = self._register_connection(
+                client_socket, state.address, now - state.idle_seconds)
+            if state.framing_name != connection.framing.name:
+                connection.switch_framing(
+                    framing.FRAMINGS[state.framing_name])
+            connection.frame_buffer.feed(state.inbound)
+            if state.outbound:
+                connection.outbound_queue.push(state.outbound)
+                self._queued_connections.add(connection)
+
+            if state.client_name is not None:
+                self.create_client(connection, state.client_name)
+                connection.may_negotiate = state.may_negotiate
+
+        for state in channel_states:
+            self.irc_handler.restore_channel(state.name, state.client_names,
+                                             state.history)
+
+        for state in connection_states:
+            if state.client_name is not None:
+                self.irc_handler.restore_client_channels(
+                    state.client_name, state.channel_names,
+                    state.current_channel_name)
+
+        if num_listening > 1:
+            return listening_sockets[1]
+
+        return None
 
-        return data
+    def close(self):
+        if self.capture is not None:
+            self.capture.close()
+        if self.admin_endpoint is not None:
+            self.admin_endpoint.close()
+        if self.tls_listener is not None:
+            self.tls_listener.close()
+        # Otherwise its socket would be left on disk, for a server that no
+        # longer listens on it.
+        if self.handoff_listener is not None:
+            self.handoff_listener.close()
+
+        if self.server_socket is not None:
+            self.event_loop.close()
+            self.server_socket.close()
+
+
+# A command that clients can send, like /join. handle is called with the
+# blocks of the message and the client that sent it.
+# A command whose last block is text, like the message of /msg, gets the
+# rest of the message in that block, spacing and all.
+Command = collections.namedtuple('Command', ['num_blocks', 'usage', 'handle',
+                                             'ends_with_text'],
+                                 defaults=[False])
 
 
 class IRCHandler(object):
-    def __init__(self):
+    def __init__(self, history_length=channel_history.DEFAULT_HISTORY_LENGTH,
+                 history_directory=None, intern_names=False,
+                 client_rate_limit=None, channel_rate_limit=None,
+                 rate_limit_action=rate_limit.DEFAULT_RATE_LIMIT_ACTION,
+                 clock=time.monotonic):
+        if rate_limit_action not in rate_limit.RATE_LIMIT_ACTIONS:
+            raise ValueError('Unknown rate limit action \'{}\'.'.format(
+                rate_limit_action))
+
         self.connected_clients = dict()
         self.channels = dict()
+        self.history_length = history_length
+        self.history_directory = history_directory
+        self.intern_names = intern_names
         self._server_messages = list()
+        # Pairs of a client name and the channel history it should get.
+        self._replays = list()
+        # Pairs of a recipient client name and a private message for it.
+        self._direct_messages = list()
+        # Channels with messages waiting to be sent, by name. Only these are
+        # gone through when sending, so idle channels cost nothing per tick.
+        self._pending_channels = dict()
+
+        # Each client, and each channel, gets a token bucket for its
+        # RateLimit, if there is one. A client over its limit gets
+        # rate_limit_action. A busy channel isn't the fault of any one
+        # client, so messages over a channel's limit are only ever dropped,
+        # with a warning unless the action is to drop.
+        self.client_rate_limit = client_rate_limit
+        self.channel_rate_limit = channel_rate_limit
+        self.rate_limit_action = rate_limit_action
+        self.num_rate_limited = 0
+        # Token buckets fill up by clock.
+        self.clock = clock
+
+        # Commands are looked up by their first block. Each one knows how
+        # many blocks it takes and what to tell a client that got it wrong.
+        self._commands = {
+            '/list': Command(1, '/list should only be used by itself.',
+                             self._list_channels),
+            '/create': Command(2, utils.SERVER_CREATE_REQUIRES_ARGUMENT,
+                               self._create_channel),
+            '/join': Command(2, utils.SERVER_JOIN_REQUIRES_ARGUMENT,
+                             self._join_channel),
+            '/leave': Command(2, utils.SERVER_LEAVE_REQUIRES_ARGUMENT,
+                              self._leave_channel),
+            '/msg': Command(3, utils.SERVER_MSG_REQUIRES_ARGUMENTS,
+                            self._send_direct_message, ends_with_text=True),
+        }
 
     @property
     def server_messages(self):
         return self._server_messages
 
+    @property
+    def replays(self):
+        return self._replays
+
+    @property
+    def direct_messages(self):
+        return self._direct_messages
+
+    @property
+    def pending_channels(self):
+        return self._pending_channels.values()
+
     def add_client(self, client):
         # Note that the client's name will act as its ID.
         self.connected_clients[client.name] = client
 
+        if self.client_rate_limit is not None:
+            client.rate_bucket = self.client_rate_limit.create_bucket(
+                self.clock())
+
+    def client_exists(self, name):
+        return name in self.connected_clients
+
+    def intern_name(self, name):
+        # Client and channel names are decoded from the frames of every
+        # client, so the same name may otherwise be held by many strings.
+        # Interning them keeps a single copy of each, shared by the
+        # clients, channels, and messages that refer to it.
+        if self.intern_names:
+            return sys.intern(name)
+
+        return name
+
     def add_channel(self, name):
-        self.channels[name] = Channel(name)
+        channel = self._new_channel(name)
+        channel.history.load(self._create_logged_message)
+
+        self.channels[channel.name] = channel
+
+    def restore_channel(self, name, client_names, history):
+        # Recreates a channel that was handed over by another server, with
+        # its clients in the order that they joined, and its history as
+        # pairs of a sender and a message. The history is already in the
+        # channel's log, if there is one.
+        channel = self._new_channel(name)
+        channel.history.extend([self._create_logged_message(sender, message)
+                                for sender, message in history], log=False)
+        for client_name in client_names:
+            channel.add_client(self.connected_clients[client_name])
+
+        self.channels[channel.name] = channel
+
+    def _new_channel(self, name):
+        name = self.intern_name(name)
+
+        log_path = None
+        if self.history_directory is not None:
+            log_path = channel_history.channel_log_path(
+                self.history_directory, name)
+
+        history = channel_history.ChannelHistory(self.history_length,
+                                                 log_path)
+        channel = Channel(name, history, self._pending_channels)
+        if self.channel_rate_limit is not None:
+            channel.rate_bucket = self.channel_rate_limit.create_bucket(
+                self.clock())
+
+        return channel
+
+    def restore_client_channels(self, name, channel_names,
+                                current_channel_name):
+        # The other half of restore_channel(): the client's side of its
+        # channels, in the order that it joined them.
+        client = self.connected_clients[name]
+        for channel_name in channel_names:
+            client.add_channel(self.channels[channel_name])
+
+        if current_channel_name is not None:
+            client.channel = self.channels[current_channel_name]
 
     def add_client_to_channel(self, client, channel_name):
-        old_channel = client.channel
-        new_channel = self.channels[channel_name]
-        client.channel = new_channel
+        # The client stays in the channels it is already in. The new channel
+        # becomes the one its chat text goes to.
+        channel = self.channels[channel_name]
+        channel.add_client(client)
+        client.add_channel(channel)
+        client.channel = channel
 
-        # We remove the client from its old channel because, well duh, we're
-        # adding the client to a new channel.
-        try:
-            old_channel.remove_client(client)
-        except AttributeError:
-            print('Client {} is not subscribed '.format(client.name)
-                  + 'to any channel, so we ain\'t removing '
-                  + 'its \'old channel\'.')
-        finally:
-            new_channel.add_client(client)
+    def remove_client_from_channel(self, client, channel_name):
+        channel = client.channels[channel_name]
+        channel.remove_client(client)
+        client.remove_channel(channel)
+
+        message = utils.SERVER_CLIENT_LEFT_CHANNEL.format(client.name)
+        channel.add_notice(client.name, message)
 
     def remove_client(self, name):
         client = self.connected_clients[name]
 
-        # Remove the client from its current channel to stop any messages
-        # being sent to this now disconnected channel and preventing any
-        # possible errors from arising.
-        try:
-            client.channel.remove_client(client)
-        except AttributeError:
-            print('Client {} is not subscribed '.format(client.name)
-                  + 'to any channel, so we ain\'t removing '
-                  + 'its \'old channel\'.')
-
-        message = utils.SERVER_CLIENT_LEFT_CHANNEL.format(name)
-
-        if client.channel is not None:
-            client.channel.add_message(client, message)
+        # Remove the client from its channels to stop any messages being
+        # sent to this now disconnected client. Only the channels the client
+        # is in are gone through, not every channel there is.
+        for channel_name in list(client.channels):
+            self.remove_client_from_channel(client, channel_name)
 
         del self.connected_clients[name]
 
     def remove_channel(self, name):
-        # Set the channel of the clients that are subscribed to the channel
-        # being removed to None since they won't have a channel.
-        channel = self.channels[name]
-        for client in channel.clients:
-            client.channel = None
-
-        del channel
+        # The clients in the channel being removed leave it, so those that
+        # were talking in it won't have a channel.
+        channel = self.channels.pop(name)
+        self._pending_channels.pop(name, None)
+        for client in channel.clients.values():
+            client.remove_channel(channel)
 
     def process_client_message(self, message, name):
         client = self.connected_clients[name]
+        message = message.strip()
 
-        try:
-            client_channel_name = client.channel.name
-        except AttributeError:
-            client_channel_name = None
+        if message_logger.isEnabledFor(logging.DEBUG):
+            try:
+                client_channel_name = client.channel.name
+            except AttributeError:
+                client_channel_name = None
+
+            message_logger.debug('Received message from %s (Address: %s, '
+                                 'Channel: %s): %s', client.name,
+                                 client.address, client_channel_name, message)
+
+        if message == '':
+            logger.debug('Client %s has sent an empty message. Ignoring it.',
+                         name)
+        elif (client.rate_bucket is not None
+              and not client.rate_bucket.take(self.client_rate_limit,
+                                              self.clock())):
+            self._limit_client(client)
+        elif message[0] == '/':
+            # So it is a command. Only commands are split into blocks.
+            self._process_command(message, client)
+        elif client.channel is None:
+            # The client sent a non-channel command message.
+            response = utils.SERVER_CLIENT_NOT_IN_CHANNEL
+
+            server_message = Message(client.name, response)
+            self._server_messages.append(server_message)
+        else:
+            # The functionality where the message sender tag is
+            # prepended to the message here in the IRC Handler
+            # because its responsibility is to process messages and
+            # place them in the message bucket of the appropriate
+            # channels. This functionality can be placed in the server
+            # part but it does not suit this task because the server's
+            # responsibilities are just to send and receive client data
+            # that will be processed by IRC Handler.
+            # TL;DR: This functionality is placed here in alignment
+            # with the single responsibility principle.
+            channel = client.channel
+            if (channel.rate_bucket is not None
+                    and not channel.rate_bucket.take(self.channel_rate_limit,
+                                                     self.clock())):
+                self._limit_channel(channel, client)
+                return
 
-        print('Received message '
-              + 'from {} (Address: {}, '.format(client.name, client.address)
-              + 'Channel: {}).'.format(client_channel_name))
+            # A message of the longest length that a client may send no
+            # longer fits once it has the name of its sender, so it is cut
+            # short to fit everything that it goes through from here on.
+            message = framing.truncate_message(
+                '[{}] {}'.format(client.name, message))
+            channel.add_message(client.name, message)
+
+    def _limit_client(self, client):
+        # The message is dropped in any case. Clients are only warned the
+        # first time they go over, or each message dropped would bring
+        # another one back.
+        self.num_rate_limited += 1
+        if self.rate_limit_action == 'disconnect':
+            raise rate_limit.ClientFloodingError()
+
+        if self.rate_limit_action == 'warn' and not client.rate_bucket.limited:
+            self._server_messages.append(
+                Message(client.name, utils.SERVER_CLIENT_RATE_LIMITED))
+        client.rate_bucket.limited = True
+
+    def _limit_channel(self, channel, client):
+        # The channel's bucket doesn't know who was warned, so only the
+        # sender of the first message dropped is, until the channel quiets
+        # down again.
+        self.num_rate_limited += 1
+        if self.rate_limit_action != 'drop' and not channel.rate_bucket.limited:
+            self._server_messages.append(Message(
+                client.name,
+                utils.SERVER_CHANNEL_RATE_LIMITED.format(channel.name)))
+        channel.rate_bucket.limited = True
+
+    def _create_logged_message(self, sender_client_name, message):
+        return Message(self.intern_name(sender_client_name), message)
 
-        message = message.strip()
+    def clear_server_messages(self):
+        self._server_messages[:] = []
+
+    def clear_replays(self):
+        self._replays[:] = []
+
+    def clear_direct_messages(self):
+        self._direct_messages[:] = []
+
+    def clear_pending_channels(self):
+        for channel in self._pending_channels.values():
+            channel.clear_messages()
+
+        self._pending_channels.clear()
+
+    def _process_command(self, message, client):
         message_blocks = message.split()
+        command = self._commands.get(message_blocks[0])
+        if command is None:
+            response = utils.SERVER_INVALID_CONTROL_MESSAGE.format(
+                ' '.join(message_blocks))
+        elif (len(message_blocks) < command.num_blocks
+              or (len(message_blocks) > command.num_blocks
+                  and not command.ends_with_text)):
+            response = command.usage.format(' '.join(message_blocks))
+        else:
+            if command.ends_with_text:
+                message_blocks = message.split(None, command.num_blocks - 1)
 
-        print('   Message: {}'.format(message))
+            command.handle(message_blocks, client)
+            return
 
-        try:
-            if message[0] == '/':
-                # So it is a command.
-                response = self._validate_command_message(message_blocks)
-                if response == '':
-                    self._process_command(message_blocks, client)
-                else:
-                    server_message = Message(client.name, response)
-                    self._server_messages.append(server_message)
-            else:
-                # The client sent a non-channel command message.
-                if client.channel is None:
-                    response = utils.SERVER_CLIENT_NOT_IN_CHANNEL
-
-                    server_message = Message(client.name, response)
-                    self._server_messages.append(server_message)
-                else:
-                    # The functionality where the message sender tag is
-                    # prepended to the message here in the IRC Handler
-                    # because its responsibility is to process messages and
-                    # place them in the message bucket of the appropriate
-                    # channels. This functionality can be placed in the server
-                    # part but it does not suit this task because the server's
-                    # responsibilities are just to send and receive client data
-                    # that will be processed by IRC Handler.
-                    # TL;DR: This functionality is placed here in alignment
-                    # with the single responsibility principle.
-                    message = '[{}] {}'.format(client.name, message)
-                    client.channel.add_message(client.name, message)
-        except IndexError:
-            print('Client {} has sent an empty message.'.format(name)
-                  + ' Ignoring it.')
+        server_message = Message(client.name, response)
+        self._server_messages.append(server_message)
 
-    def clear_server_messages(self):
-        self._server_messages[:] = []
+    def _list_channels(self, message_blocks, client):
+        if len(self.channels.keys()) > 0:
+            response = '\n'.join(map(str, self.channels.keys())).strip()
+        else:
+            response = 'No rooms exist yet.'
 
-    def _process_command(self, message_blocks, client):
-        if message_blocks[0] == '/list':
-            if len(self.channels.keys()) > 0:
-                response = '\n'.join(map(str, self.channels.keys())).strip()
-            else:
-                response = 'No rooms exist yet.'
+        server_message = Message(client.name, response)
+        self._server_messages.append(server_message)
 
-            server_message = Message(client.name, response)
+    def _create_channel(self, message_blocks, client):
+        channel_name = message_blocks[1]
+
+        if channel_name in self.channels:
+            client_channel_exists_message = \
+                utils.SERVER_CHANNEL_EXISTS.format(channel_name)
+            server_message = Message(client.name,
+                                     client_channel_exists_message)
             self._server_messages.append(server_message)
-        elif message_blocks[0] == '/create' or message_blocks[0] == '/join':
-            channel_name = message_blocks[1]
-
-            if message_blocks[0] == '/create':
-                if channel_name not in self.channels:
-                    self.add_channel(channel_name)
-                else:
-                    client_channel_exists_message = \
-                        utils.SERVER_CHANNEL_EXISTS.format(channel_name)
-                    server_message = Message(client.name,
-                                             client_channel_exists_message)
-                    self._server_messages.append(server_message)
 
-                    return
+            return
 
-            try:
-                self.add_client_to_channel(client, channel_name)
-            except KeyError:
-                client_no_channel_message = \
-                    utils.SERVER_NO_CHANNEL_EXISTS.format(channel_name)
-                server_message = Message(client.name, client_no_channel_message)
-                self._server_messages.append(server_message)
+        self.add_channel(channel_name)
+        self._join_channel(message_blocks, client)
 
-                return
+    def _join_channel(self, message_blocks, client):
+        channel_name = message_blocks[1]
 
-            # Add the client joined message for the
-            # client to the list of messages in the client's new channel.
-            client_joined_message = \
-                utils.SERVER_CLIENT_JOINED_CHANNEL.format(client.name)
-            channel = self.channels[channel_name]
-            channel.add_message(client.name, client_joined_message)
-
-    def _validate_command_message(self, message_blocks):
-        message = ' '.join(message_blocks)
-        command = message_blocks[0]
-
-        response = ''
-        if not self._is_command_valid(command):
-            response = utils.SERVER_INVALID_CONTROL_MESSAGE.format(message)
-            return response
-
-        if not self._is_channel_command_valid_length(message_blocks):
-            if command == '/list':
-                response = '/list should only be used by itself.'
-            elif command == '/create':
-                response = utils.SERVER_CREATE_REQUIRES_ARGUMENT.format(message)
-            elif command == '/join':
-                response = utils.SERVER_JOIN_REQUIRES_ARGUMENT.format(message)
-
-        return response if response != '' else ''
-
-    def _is_irc_command_valid_length(self, message_blocks):
-        return 1 <= len(message_blocks) <= 2
-
-    def _is_channel_command_valid_length(self, message_blocks):
-        if message_blocks[0] == '/list':
-            return len(message_blocks) == 1
-        else:
-            return len(message_blocks) == 2
+        if channel_name in client.channels:
+            # The client is already in the channel, so it just goes back to
+            # talking in it.
+            client.channel = client.channels[channel_name]
+            return
+
+        try:
+            self.add_client_to_channel(client, channel_name)
+        except KeyError:
+            client_no_channel_message = \
+                utils.SERVER_NO_CHANNEL_EXISTS.format(channel_name)
+            server_message = Message(client.name, client_no_channel_message)
+            self._server_messages.append(server_message)
+
+            return
+
+        # Add the client joined message for the
+        # client to the list of messages in the client's new channel.
+        client_joined_message = \
+            utils.SERVER_CLIENT_JOINED_CHANNEL.format(client.name)
+        channel = self.channels[channel_name]
+        channel.add_notice(client.name, client_joined_message)
+
+        # The history only has messages that were already sent, so the
+        # client won't get any of them twice.
+        if len(channel.history) > 0:
+            self._replays.append((client.name, channel.history.recent()))
+
+    def _leave_channel(self, message_blocks, client):
+        channel_name = message_blocks[1]
+
+        if channel_name not in client.channels:
+            response = utils.SERVER_CLIENT_NOT_IN_NAMED_CHANNEL.format(
+                channel_name)
+            self._server_messages.append(Message(client.name, response))
+
+            return
+
+        self.remove_client_from_channel(client, channel_name)
+
+    def _send_direct_message(self, message_blocks, client):
+        recipient_name = message_blocks[1]
+
+        if not self.client_exists(recipient_name):
+            response = utils.SERVER_NO_CLIENT_EXISTS.format(recipient_name)
+            self._server_messages.append(Message(client.name, response))
+
+            return
+
+        # Private messages skip the channels and go straight to the one
+        # client, which is found by name when they are sent.
+        message = framing.truncate_message(
+            '[{}] (private) {}'.format(client.name, message_blocks[2]))
+        self._direct_messages.append((recipient_name,
+                                      Message(client.name, message)))
 
-    def _is_command_valid(self, command):
-        valid_commands = ['/join', '/create', '/list']
-        return command in valid_commands
 
+class Connection(object):
+    # The server side of a client socket. It exists from the moment the socket
+    # is accepted, before we know who the client is.
+    def __init__(self, client_socket, address, outbound_queue,
+                 frame_buffer=None):
+        if frame_buffer is None:
+            frame_buffer = framing.FIXED_LENGTH.create_buffer()
+
+        self._socket = client_socket
+        # Closing a socket resets its fileno() to -1, so we hold on to the
+        # original one to be able to find the connection in the registry.
+        self._fileno = client_socket.fileno()
+        self._address = address
+        self.is_tls = isinstance(client_socket, ssl.SSLSocket)
+        self._framing = framing.FIXED_LENGTH
+        self._frame_buffer = frame_buffer
+        # A client may only ask for another framing right after its name.
+        self.may_negotiate = False
+        self._outbound_queue = outbound_queue
+        self._client = None
+        # Whether the event loop is watching the socket for writability
+        # because its outbound queue could not be flushed in one go.
+        self.waiting_for_writable = False
+        # When data last came in, and the timer that checks on it, if the
+        # server kicks idle connections off.
+        self.last_active = 0
+        self.idle_timer = None
+
+    @property
+    def socket(self):
+        return self._socket
+
+    @property
+    def fileno(self):
+        return self._fileno
+
+    @property
+    def address(self):
+        return self._address
+
+    @property
+    def framing(self):
+        return self._framing
+
+    @property
+    def frame_buffer(self):
+        return self._frame_buffer
+
+    def switch_framing(self, new_framing):
+        # Returns the bytes that were waiting in the old frame buffer, since
+        # they belong to the new framing.
+        pending = self._frame_buffer.take_pending()
+        self._framing = new_framing
+        self._frame_buffer = new_framing.create_buffer()
+
+        return pending
+
+    @property
+    def outbound_queue(self):
+        return self._outbound_queue
+
+    @property
+    def client(self):
+        return self._client
 
+    @client.setter
+    def client(self, new_client):
+        self._client = new_client
+
+
+class ConnectionRegistry(object):
+    # Every connection of the server, keyed by the file descriptor of its
+    # socket, plus an index of the named ones by client name. File
+    # descriptors are unique among open sockets, unlike id(), which may be
+    # reused by a new socket once an old one is garbage collected. Adding,
+    # finding, and removing connections are all O(1).
+    def __init__(self):
+        self._fileno_connection_map = dict()
+        self._name_connection_map = dict()
+
+    def __len__(self):
+        return len(self._fileno_connection_map)
+
+    def __iter__(self):
+        return iter(self._fileno_connection_map.values())
+
+    def add(self, connection):
+        self._fileno_connection_map[connection.fileno] = connection
+
+    def remove(self, connection):
+        # The client name, if any, is unbound separately by the server when
+        # it removes the client.
+        del self._fileno_connection_map[connection.fileno]
+
+    def get(self, fileno):
+        return self._fileno_connection_map.get(fileno)
+
+    def bind_name(self, connection, name):
+        self._name_connection_map[name] = connection
+
+    def unbind_name(self, name):
+        del self._name_connection_map[name]
+
+    def has_name(self, name):
+        return name in self._name_connection_map
+
+    def get_by_name(self, name):
+        return self._name_connection_map.get(name)
+
+
+# Clients, channels, and messages are created by the thousands, so they use
+# __slots__ to do away with a __dict__ for each instance.
 class Client(object):
-    def __init__(self, name, address, channel):
+    __slots__ = ('_name', '_address', '_channel', '_channels', 'rate_bucket')
+
+    def __init__(self, name, address):
         self._name = name
         self._address = address
-        self._channel = channel
+        # The channel that the client's chat text goes to, which is the one
+        # it joined last.
+        self._channel = None
+        # Every channel the client is in, by name. Together with the clients
+        # of each channel, this lets us find who is in a channel and which
+        # channels a client is in without going through all of them.
+        self._channels = dict()
+        # The TokenBucket of the client's rate limit, if there is one.
+        self.rate_bucket = None
 
     @property
     def name(self):
@@ -366,12 +1467,41 @@ class Client(object):
     def channel(self, new_channel):
         self._channel = new_channel
 
+    @property
+    def channels(self):
+        return self._channels
+
+    def add_channel(self, channel):
+        self._channels[channel.name] = channel
+
+    def remove_channel(self, channel):
+        del self._channels[channel.name]
+
+        # Channels are kept in the order they were joined, so a client that
+        # leaves the channel it talks in goes back to the last one it joined
+        # of the rest, if it is still in any.
+        if self._channel is channel:
+            self._channel = next(reversed(self._channels.values()), None)
+
 
 class Channel(object):
-    def __init__(self, name):
+    __slots__ = ('_name', '_clients', '_messages', '_history',
+                 '_pending_channels', 'rate_bucket')
+
+    def __init__(self, name, history=None, pending_channels=None):
+        if history is None:
+            history = channel_history.ChannelHistory()
+
         self._name = name
         self._clients = dict()
         self._messages = list()
+        self._history = history
+        # The channels of the IRC handler that have messages waiting to be
+        # sent, by name. The channel adds itself when it gets its first
+        # message since it was last cleared.
+        self._pending_channels = pending_channels
+        # The TokenBucket of the channel's rate limit, if there is one.
+        self.rate_bucket = None
 
     @property
     def name(self):
@@ -384,11 +1514,30 @@ class Channel(object):
     @property
     def messages(self):
         return self._messages
+
+    @property
+    def history(self):
+        return self._history
     
     def add_message(self, sender_client_name, message):
+        self._mark_pending()
         self._messages.append(Message(sender_client_name, message))
 
+    def add_notice(self, sender_client_name, message):
+        # Notices, like a client joining or leaving, are only of interest
+        # when they happen, so they are not kept in the history.
+        self._mark_pending()
+        self._messages.append(Message(sender_client_name, message,
+                                      is_notice=True))
+
+    def _mark_pending(self):
+        if not self._messages and self._pending_channels is not None:
+            self._pending_channels[self._name] = self
+
     def clear_messages(self):
+        # The messages have been sent by now, so they become history.
+        self._history.extend([message for message in self._messages
+                              if not message.is_notice])
         self._messages[:] = []
 
     def add_client(self, client):
@@ -399,9 +1548,18 @@ class Channel(object):
 
 
 class Message(object):
-    def __init__(self, sender_client_name, message):
+    __slots__ = ('_sender_client_name', '_message', '_is_notice',
+                 '_encoded_framing_name', '_encoded', '_other_encodings')
+
+    def __init__(self, sender_client_name, message, is_notice=False):
         self._sender_client_name = sender_client_name
         self._message = message
+        self._is_notice = is_notice
+        # Almost every message is only ever encoded with one framing, so
+        # that encoding is kept without a dict of its own.
+        self._encoded_framing_name = None
+        self._encoded = None
+        self._other_encodings = None
 
     @property
     def sender_client_name(self):
@@ -411,6 +1569,38 @@ class Message(object):
     def message(self):
         return self._message
 
+    @property
+    def is_notice(self):
+        return self._is_notice
+
+    @property
+    def encoded(self):
+        return self.encode(framing.FIXED_LENGTH)
+
+    def encode(self, message_framing):
+        # The bytes that go on the wire. A channel message goes to every
+        # client in the channel, so we only encode it once per framing.
+        framing_name = message_framing.name
+        if framing_name == self._encoded_framing_name:
+            return self._encoded
+
+        if self._encoded_framing_name is None:
+            self._encoded_framing_name = framing_name
+            self._encoded = message_framing.encode(self._message)
+
+            return self._encoded
+
+        if self._other_encodings is None:
+            self._other_encodings = dict()
+
+        try:
+            return self._other_encodings[framing_name]
+        except KeyError:
+            encoded = message_framing.encode(self._message)
+            self._other_encodings[framing_name] = encoded
+
+            return encoded
+
 
 class ClientNameExistsError(Exception):
     def __init__(self):
@@ -419,15 +1609,120 @@ class ClientNameExistsError(Exception):
 
 
 if __name__ == '__main__':
-    args = sys.argv
-    if len(args) != 2:
-        print 'Port not supplied.'
-        sys.exit(-1)
-
-    server = Server(args[1])
+    parser = argparse.ArgumentParser(description='CMSC 135 Chat Server')
+    parser.add_argument('port', type=int, help='Port to listen on.')
+    parser.add_argument(
+        '--event-loop', dest='event_loop',
+        choices=sorted(event_loops.EVENT_LOOPS.keys()),
+        default=event_loops.DEFAULT_EVENT_LOOP,
+        help='Event loop backend used to wait for socket activity.')
+    parser.add_argument(
+        '--high-water-mark', dest='high_water_mark', type=int,
+        default=outbound_queue.DEFAULT_HIGH_WATER_MARK,
+        help='Number of bytes that may be queued for a client before the '
+             + 'slow consumer policy kicks in.')
+    parser.add_argument(
+        '--slow-consumer-policy', dest='slow_consumer_policy',
+        choices=outbound_queue.SLOW_CONSUMER_POLICIES,
+        default=outbound_queue.DEFAULT_SLOW_CONSUMER_POLICY,
+        help='What to do with clients that are over the high-water mark.')
+    parser.add_argument(
+        '--flush-interval', dest='flush_interval', type=float, default=0,
+        help='Milliseconds to wait between flushes of the outbound queues. '
+             + 'Longer intervals batch more messages into each send call.')
+    parser.add_argument(
+        '--max-batch-size', dest='max_batch_size', type=int,
+        default=outbound_queue.MAX_BUFFERS,
+        help='Most messages sent to a client in a single send call.')
+    parser.add_argument(
+        '--history-length', dest='history_length', type=int,
+        default=channel_history.DEFAULT_HISTORY_LENGTH,
+        help='Number of recent messages kept for each channel and replayed '
+             + 'to clients that join it.')
+    parser.add_argument(
+        '--history-dir', dest='history_dir',
+        help='Directory where every channel message is logged, one file per '
+             + 'channel. Logged history is restored when a channel with the '
+             + 'same name is created again.')
+    parser.add_argument(
+        '--intern-names', dest='intern_names', action='store_true',
+        help='Keep a single copy of each client and channel name in memory.')
+    parser.add_argument(
+        '--admin-port', dest='admin_port', type=int,
+        help='Local port where the server\'s metrics are served. The '
+             + 'metrics are off if this is not given.')
+    parser.add_argument(
+        '--tls-port', dest='tls_port', type=int,
+        help='Port where clients may connect with TLS, besides the plain '
+             + 'port. Needs --tls-cert.')
+    parser.add_argument(
+        '--tls-cert', dest='tls_cert',
+        help='PEM file with the server\'s certificate chain, and its key if '
+             + '--tls-key is not given.')
+    parser.add_argument(
+        '--tls-key', dest='tls_key',
+        help='PEM file with the private key of --tls-cert.')
+    parser.add_argument(
+        '--idle-timeout', dest='idle_timeout', type=float, default=0,
+        help='Seconds that a client may go without sending anything before '
+             + 'it is kicked off. Clients that only listen should send '
+             + 'heartbeats. Off by default.')
+    parser.add_argument(
+        '--heartbeat-interval', dest='heartbeat_interval', type=float,
+        default=0,
+        help='Seconds of quiet after which the kernel starts checking with '
+             + 'TCP keepalives that a client is still there. Off by default.')
+    parser.add_argument(
+        '--handoff', dest='handoff_path',
+        help='Unix socket path where a new server process can take over '
+             + 'this one without dropping its clients. A server started with '
+             + 'the path of a running one takes over its ports and clients.')
+    parser.add_argument(
+        '--capture', dest='capture_path',
+        help='File where every message that arrives is recorded, with the '
+             + 'time and the client it came from, so that the session can be '
+             + 'replayed with benchmarks.replay.')
+    rate_limit.add_rate_limit_arguments(parser)
+    server_logging.add_logging_arguments(parser)
+    args = parser.parse_args()
+
+    if args.tls_port is not None and args.tls_cert is None:
+        parser.error('--tls-port needs --tls-cert.')
+
+    server_logging.configure_logging_from_arguments(args)
+    exit_on_sigterm()
+
+    tls_context = None
+    if args.tls_port is not None:
+        tls_context = tls.create_server_context(args.tls_cert, args.tls_key)
+
+    client_rate_limit, channel_rate_limit = \
+        rate_limit.create_rate_limits_from_arguments(args)
+
+    server = Server(args.port,
+                    event_loops.create_event_loop(args.event_loop),
+                    args.high_water_mark,
+                    args.slow_consumer_policy,
+                    args.flush_interval / 1000.0,
+                    args.max_batch_size,
+                    args.history_length,
+                    args.history_dir,
+                    args.intern_names,
+                    args.summary_interval,
+                    args.admin_port,
+                    args.tls_port,
+                    tls_context,
+                    args.idle_timeout,
+                    args.heartbeat_interval,
+                    client_rate_limit,
+                    channel_rate_limit,
+                    args.rate_limit_action,
+                    args.handoff_path,
+                    args.capture_path)
     try:
         server.run()
     except Exception:
-        print('Server message (ERROR):\n{}'.format(traceback.format_exc()))
+        logger.exception('Server message (ERROR):')
     finally:
         server.close()
+        server_logging.shutdown_logging()
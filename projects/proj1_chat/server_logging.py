@@ -0,0 +1,209 @@
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+
+
+# Everything the servers log goes through the 'chat' logger. Lines about
+# single messages go through 'chat.messages', which is off unless asked for,
+# since a busy server would otherwise spend its time writing them.
+LOGGER_NAME = 'chat'
+MESSAGE_LOGGER_NAME = 'chat.messages'
+
+LOG_LEVELS = ('debug', 'info', 'warning', 'error')
+DEFAULT_LOG_LEVEL = 'info'
+
+# Seconds between summary lines. 0 turns them off.
+DEFAULT_SUMMARY_INTERVAL = 10
+
+LOG_FORMAT = '%(asctime)s %(levelname)s %(message)s'
+
+_listener = None
+_listener_options = None
+_paused_for_fork = False
+
+
+class SampleFilter(logging.Filter):
+    # Lets one of every rate records through.
+    def __init__(self, rate):
+        logging.Filter.__init__(self)
+        self._rate = rate
+        self._count = 0
+
+    def filter(self, record):
+        self._count += 1
+
+        return (self._count - 1) % self._rate == 0
+
+
+class _BufferedStreamHandler(logging.StreamHandler):
+    # logging.StreamHandler flushes after every record, which costs a write()
+    # per line. This one leaves it to the listener, which flushes whenever it
+    # runs out of records.
+    def emit(self, record):
+        try:
+            self.stream.write(self.format(record) + self.terminator)
+        except Exception:
+            self.handleError(record)
+
+
+class _FlushingQueueListener(logging.handlers.QueueListener):
+    def dequeue(self, block):
+        try:
+            return self.queue.get_nowait()
+        except queue.Empty:
+            self.flush()
+
+            return self.queue.get(block)
+
+    def stop(self):
+        logging.handlers.QueueListener.stop(self)
+        self.flush()
+
+    def flush(self):
+        for handler in self.handlers:
+            handler.flush()
+
+
+def configure_logging(level=DEFAULT_LOG_LEVEL, log_messages=False,
+                      sample_rate=1, stream=None):
+    # Records are put in a queue by the servers and written out by a
+    # background thread, so a slow terminal or disk never holds up the event
+    # loop. Per-message lines are only logged if log_messages is set, and
+    # then only one of every sample_rate of them.
+    global _listener, _listener_options
+
+    shutdown_logging()
+
+    if stream is None:
+        stream = sys.stdout
+
+    handler = _BufferedStreamHandler(stream)
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+
+    log_queue = queue.SimpleQueue()
+    _listener = _FlushingQueueListener(log_queue, handler)
+    _listener.start()
+    _listener_options = (level, log_messages, sample_rate, stream)
+
+    logger = logging.getLogger(LOGGER_NAME)
+    for old_handler in list(logger.handlers):
+        logger.removeHandler(old_handler)
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    logger.setLevel(level.upper())
+    logger.propagate = False
+
+    message_logger = logging.getLogger(MESSAGE_LOGGER_NAME)
+    for old_filter in list(message_logger.filters):
+        message_logger.removeFilter(old_filter)
+    if log_messages:
+        message_logger.setLevel(logging.DEBUG)
+        if sample_rate > 1:
+            message_logger.addFilter(SampleFilter(sample_rate))
+    else:
+        message_logger.setLevel(logging.WARNING)
+
+
+def add_logging_arguments(parser):
+    # The logging options shared by all of the servers.
+    parser.add_argument(
+        '--log-level', dest='log_level', choices=LOG_LEVELS,
+        default=DEFAULT_LOG_LEVEL,
+        help='Least severe level of the lines that are logged.')
+    parser.add_argument(
+        '--log-messages', dest='log_messages', action='store_true',
+        help='Log a line for every message received and sent. This slows '
+             + 'a busy server down.')
+    parser.add_argument(
+        '--log-sample-rate', dest='log_sample_rate', type=int, default=1,
+        help='With --log-messages, only log one of every this many message '
+             + 'lines.')
+    parser.add_argument(
+        '--summary-interval', dest='summary_interval', type=float,
+        default=DEFAULT_SUMMARY_INTERVAL,
+        help='Seconds between lines with the server\'s counters. 0 turns '
+             + 'them off.')
+
+
+def configure_logging_from_arguments(args):
+    configure_logging(args.log_level, args.log_messages,
+                      args.log_sample_rate)
+
+
+def shutdown_logging():
+    # Writes out whatever is still in the queue.
+    global _listener
+
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def _stop_before_fork():
+    # The listener thread doesn't survive a fork, and it could be holding
+    # the lock of the stream at the time, so it is stopped before forking
+    # and both processes start one of their own afterwards.
+    global _paused_for_fork
+
+    if _listener is not None:
+        shutdown_logging()
+        _paused_for_fork = True
+
+
+def _restart_after_fork():
+    global _paused_for_fork
+
+    if _paused_for_fork:
+        _paused_for_fork = False
+        configure_logging(*_listener_options)
+
+
+atexit.register(shutdown_logging)
+os.register_at_fork(before=_stop_before_fork,
+                    after_in_parent=_restart_after_fork,
+                    after_in_child=_restart_after_fork)
+
+
+class SummaryLogger(object):
+    # Logs the server's counters every interval seconds, in place of a line
+    # for every message. counters are running totals, of which the change
+    # since the last summary is logged. gauges are logged as they are.
+    def __init__(self, interval=DEFAULT_SUMMARY_INTERVAL):
+        self._interval = interval
+        self._last_time = None
+        self._last_counters = dict()
+        self._logger = logging.getLogger(LOGGER_NAME)
+
+    @property
+    def interval(self):
+        return self._interval
+
+    def is_due(self, now):
+        if self._interval <= 0:
+            return False
+
+        if self._last_time is None:
+            # Nothing to compare with yet, so the first summary covers
+            # everything since now.
+            self._last_time = now
+            return False
+
+        return now - self._last_time >= self._interval
+
+    def log(self, now, counters, gauges):
+        elapsed = now - self._last_time
+
+        fields = list()
+        for name, total in counters:
+            change = total - self._last_counters.get(name, 0)
+            fields.append('{} {} ({:.0f}/s)'.format(name, change,
+                                                     change / elapsed))
+            self._last_counters[name] = total
+
+        for name, value in gauges:
+            fields.append('{} {}'.format(name, value))
+
+        self._logger.info('Last %.1fs: %s', elapsed, ', '.join(fields))
+        self._last_time = now
@@ -1,83 +1,664 @@
 """ A simple test that verifies that messages between two clients are received. """
 
-import select
+from __future__ import print_function
+
+import argparse
+import concurrent.futures
+import random
+import os
+import shutil
 import sys
+import tempfile
 import time
-from subprocess import Popen, PIPE
 
-SLEEP_SECONDS = 0.1 
+import capture
+import framing
+import handoff
+import multicore_server
+import outbound_queue
+import rate_limit
+import timer_wheel
+import tls
+import utils
+from chat_harness import ChatHarness, ManualClock
+
+# The message that client_split_messages.py sends.
+SPLIT_MESSAGE = ("I think that I shall never see a structure more wasteful " +
+  "than a tree. Most links remain idle and unused while others are " +
+  "overloaded and abused.")
 
 class SimpleTest():
-    def run(self, port):
-        self.setup(port)
+    """Runs the server and its clients in this process, with a ChatHarness.
+
+    Nothing sleeps: every check waits until the clients have received what
+    they should, which takes as long as the server needs and no longer.
+    """
+    def run(self, port=0, seed=135, certificates=None):
+        self.setup(port, seed, certificates)
         try:
           self.test_two_clients()
+          self.test_split_messages()
+          self.test_split_at_every_offset()
+          self.test_many_messages_in_one_send()
+          if certificates is not None:
+            self.test_tls()
         finally:
           self.tear_down()
+        self.test_idle_reaper()
+        self.test_rate_limit()
+        self.test_slow_consumer()
+        self.test_leave_current_channel()
+        self.test_history()
+        self.test_private_messages()
+        self.test_capture()
+        self.test_longest_message()
+        self.test_workers()
+        self.test_handoff()
+        self.test_timer_wheel()
 
-    def setup(self, port, host="localhost"):
-        """Sets up a server and four clients."""
-        self.server = Popen(["python", "server.py", str(port)])
-        # Give the server time to come up.
-        time.sleep(SLEEP_SECONDS)
+    def setup(self, port=0, seed=135, certificates=None):
+        """Sets up a server and two clients. The server takes TLS clients too
+        if it gets certificates."""
+        self.random = random.Random(seed)
+        self.harness = ChatHarness(port, tls_certificates=certificates)
+        self.harness.start()
 
-        self.alice_client = Popen(["python", "client.py", "Alice", host, str(port)], stdin=PIPE, stdout=PIPE)
-        self.kay_client = Popen(["python", "client.py", "Kay", host, str(port)], stdin=PIPE, stdout=PIPE)
-        time.sleep(SLEEP_SECONDS)
+        self.harness.connect("Alice")
+        self.harness.connect("Kay")
 
     def tear_down(self):
         """ Stops the clients and server. """
-        self.alice_client.kill()
-        self.kay_client.kill()
-        self.server.kill()
-
-    def get_message_from_buffer(self, buf):
-        """Strips all formatting, including [Me] and whitespace."""
-        s =  "".join(buf).replace('[Me]', '').strip()
-        return s
-
-    def check_for_output(self, client, expected_output, check_formatting=False):
-        """ Verifies that the given client's stdout matches the given output."""
-        output_buffer = []
-        end_time = time.time() + 1
-        # Read one character at a time from stdout until either time timeout expires, or
-        # the output is correct.
-        while (self.get_message_from_buffer(output_buffer) != expected_output
-                and time.time() < end_time):
-            select_timeout = end_time - time.time()
-            ready_to_read, ready_to_write, in_error = select.select(
-                [client.stdout], [], [], select_timeout)
-            for readable_socket in ready_to_read:
-                char = readable_socket.read(1)
-                output_buffer.append(char)
-
-        message = self.get_message_from_buffer(output_buffer)
-        if message != expected_output:
-            raise Exception("Client output:\n{}; expected:\n{}".format(
-                repr(message), repr(expected_output)))
+        self.harness.close()
+
+    def split_randomly(self, data):
+        """Picks random offsets to cut data at, like client_split_messages.py."""
+        cuts = []
+        sent = 0
+        while sent < len(data):
+          sent = self.random.randrange(sent, len(data) + 1)
+          cuts.append(sent)
+        return cuts
 
     def test_two_clients(self):
-        self.alice_client.stdin.write("/create tas\n")
-        # Sleep to make sure that the message from Alice, to create the tas channel,
-        # arrives at the server before Kay's message to join the channel.
-        time.sleep(SLEEP_SECONDS)
-        self.kay_client.stdin.write("/join tas\n")
+        # The harness waits until the server has handled Alice's message
+        # before Kay asks to join the channel.
+        self.harness.send("Alice", "/create tas")
+        self.harness.run_until_idle()
+        self.harness.send("Kay", "/join tas")
         # Alice should get a message that Kay joined.
-        self.check_for_output(self.alice_client, "Kay has joined")
+        self.harness.expect("Alice", "Kay has joined")
 
         # When Kay sends a message, Alice should receive it.
-        self.kay_client.stdin.write("Hi!\n")
-        self.check_for_output(self.alice_client, "[Kay] Hi!")
+        self.harness.send("Kay", "Hi!")
+        self.harness.expect("Alice", "[Kay] Hi!")
 
         # When Alice sends a message, Kay should receive it.
-        self.alice_client.stdin.write("Hello!\n")
-        self.check_for_output(self.kay_client, "[Alice] Hello!")
+        self.harness.send("Alice", "Hello!")
+        self.harness.expect("Kay", "[Alice] Hello!")
+
+    def test_split_messages(self):
+        """The scenario of client_split_messages.py, without the sleeps."""
+        self.harness.send("Alice", "/create split_messages")
+        self.harness.run_until_idle()
+
+        # The name arrives in two pieces, like in client_split_messages.py.
+        self.harness.connect("SplitMessagesChatClient", send_name=False)
+        name = framing.FIXED_LENGTH.encode("SplitMessagesChatClient")
+        self.harness.send_in_pieces("SplitMessagesChatClient", name, [5])
+        self.harness.wait_for_client("SplitMessagesChatClient")
+
+        join = framing.FIXED_LENGTH.encode("/join split_messages")
+        self.harness.send_in_pieces("SplitMessagesChatClient", join,
+                                    self.split_randomly(join))
+        self.harness.expect("Alice", "SplitMessagesChatClient has joined")
+
+        message = framing.FIXED_LENGTH.encode(SPLIT_MESSAGE)
+        for i in range(10):
+          self.harness.send_in_pieces("SplitMessagesChatClient", message,
+                                      self.split_randomly(message))
+        # The name tag pushes the end of the message past the 200 bytes that
+        # fit in a frame.
+        expected = framing.FIXED_LENGTH.decode(framing.FIXED_LENGTH.encode(
+            "[SplitMessagesChatClient] " + SPLIT_MESSAGE))
+        self.harness.expect("Alice", *([expected] * 10))
+
+    def test_split_at_every_offset(self):
+        """A message cut in two at every possible offset, and one byte at a time."""
+        message = framing.FIXED_LENGTH.encode("cut here")
+        for offset in range(1, len(message)):
+          self.harness.send_in_pieces("SplitMessagesChatClient", message,
+                                      [offset])
+        self.harness.send_in_pieces("SplitMessagesChatClient", message,
+                                    range(1, len(message)))
+        self.harness.expect(
+            "Alice", *(["[SplitMessagesChatClient] cut here"] * len(message)))
+
+    def test_many_messages_in_one_send(self):
+        """Several messages, and the start of another, in a single send()."""
+        messages = [framing.FIXED_LENGTH.encode("burst {}".format(i))
+                    for i in range(5)]
+        data = b"".join(messages)
+        self.harness.send_in_pieces("SplitMessagesChatClient", data,
+                                    [len(data) - 50])
+        self.harness.expect(
+            "Alice",
+            *["[SplitMessagesChatClient] burst {}".format(i) for i in range(5)])
+        self.harness.expect_nothing("Kay")
+
+    def test_tls(self):
+        """A TLS client chats with the plain ones, then comes back and resumes its session."""
+        self.harness.connect("Tess", use_tls=True)
+        self.harness.send("Tess", "/join tas")
+        # Tess gets the history of the channel first.
+        self.harness.expect("Tess", "[Kay] Hi!", "[Alice] Hello!")
+        self.harness.expect("Alice", "Tess has joined")
+        self.harness.expect("Kay", "Tess has joined")
+
+        self.harness.send("Tess", "Hi from TLS!")
+        self.harness.expect("Alice", "[Tess] Hi from TLS!")
+        self.harness.expect("Kay", "[Tess] Hi from TLS!")
+        self.harness.send("Alice", "/msg Tess Welcome!")
+        self.harness.expect("Tess", "[Alice] (private) Welcome!")
+
+        # A client keeps its session once it has closed.
+        tess = self.harness.clients["Tess"]
+        self.harness.disconnect("Tess")
+        self.harness.expect("Alice", "Tess has left")
+        self.harness.expect("Kay", "Tess has left")
+
+        tess = self.harness.connect("Tess", use_tls=True,
+                                    tls_session=tess.tls_session)
+        if not tess.session_reused:
+          raise AssertionError("Tess did not resume her TLS session.")
+        self.harness.send("Kay", "/msg Tess Welcome back!")
+        self.harness.expect("Tess", "[Kay] (private) Welcome back!")
+        self.harness.expect_nothing("Alice")
+
+    def test_idle_reaper(self):
+        """A client that goes quiet is kicked off, and one that sends heartbeats stays."""
+        # The clock only moves when the scenario says so, so nothing waits out
+        # the timeout.
+        with ChatHarness(idle_timeout=1.0, clock=ManualClock()) as harness:
+          harness.connect("Quiet")
+          harness.connect("Chatty", heartbeat_interval=0.1)
+          harness.send("Chatty", "/create lobby")
+          harness.run_until_idle()
+          harness.send("Quiet", "/join lobby")
+          harness.expect("Chatty", "Quiet has joined")
+
+          # Chatty only sends heartbeats, which nobody sees.
+          harness.advance_clock(0.9)
+          harness.expect_nothing("Chatty")
+          harness.advance_clock(0.3)
+          harness.expect("Chatty", "Quiet has left")
+          harness.expect_nothing("Chatty")
+          harness.run_until(lambda: harness.server.num_reaped == 1,
+                            "Quiet to be reaped")
+          if "Chatty" not in harness.server.irc_handler.connected_clients:
+            raise AssertionError("Chatty was kicked off despite its heartbeats.")
+          if harness.server.num_reaped != 1:
+            raise AssertionError("Expected one client to be reaped, not {}.".format(
+                harness.server.num_reaped))
+
+    def test_rate_limit(self):
+        """A flood past a client's burst is dropped with one warning, or kicks the client off."""
+        # Tokens come back every ten seconds, and the clock only moves when
+        # the scenario says so.
+        limit = rate_limit.RateLimit(0.1, burst=5)
+        with ChatHarness(client_rate_limit=limit, clock=ManualClock()) as harness:
+          harness.connect("Listener")
+          harness.connect("Flood")
+          harness.send("Listener", "/create lobby")
+          harness.run_until_idle()
+          harness.send("Flood", "/join lobby")
+          harness.expect("Listener", "Flood has joined")
+
+          # The join took one of Flood's five tokens.
+          data = b"".join(framing.FIXED_LENGTH.encode("flood {}".format(i))
+                          for i in range(10))
+          harness.send_in_pieces("Flood", data, [])
+          harness.expect("Listener",
+                         *["[Flood] flood {}".format(i) for i in range(4)])
+          harness.expect("Flood", utils.SERVER_CLIENT_RATE_LIMITED)
+          harness.expect_nothing("Listener")
+          harness.expect_nothing("Flood")
+          if harness.server.irc_handler.num_rate_limited != 6:
+            raise AssertionError("Expected 6 messages to be rate limited, not {}.".format(
+                harness.server.irc_handler.num_rate_limited))
+
+          # Ten seconds later, Flood has a token again, and only one.
+          harness.advance_clock(10)
+          harness.send("Flood", "refilled")
+          harness.send("Flood", "too soon")
+          harness.expect("Listener", "[Flood] refilled")
+          harness.expect("Flood", utils.SERVER_CLIENT_RATE_LIMITED)
+          harness.expect_nothing("Listener")
+
+        with ChatHarness(client_rate_limit=limit,
+                         rate_limit_action="disconnect") as harness:
+          harness.connect("Listener")
+          harness.connect("Flood")
+          harness.send("Listener", "/create lobby")
+          harness.run_until_idle()
+          harness.send("Flood", "/join lobby")
+          harness.expect("Listener", "Flood has joined")
+
+          for i in range(5):
+            harness.send("Flood", "flood {}".format(i))
+          harness.expect("Listener",
+                         *["[Flood] flood {}".format(i) for i in range(4)])
+          harness.expect("Listener", "Flood has left")
+          harness.expect_nothing("Listener")
+
+    def test_slow_consumer(self):
+        """A client that stops reading has its messages dropped, is kicked off,
+        or skips ahead to the latest ones, once its queue is past the
+        high-water mark."""
+        high_water_mark = 5 * utils.MESSAGE_LENGTH
+        for policy in outbound_queue.SLOW_CONSUMER_POLICIES:
+          with ChatHarness(high_water_mark=high_water_mark,
+                           slow_consumer_policy=policy) as harness:
+            harness.connect("Talker")
+            harness.connect("Slow")
+            harness.send("Talker", "/create lobby")
+            harness.run_until_idle()
+            harness.send("Slow", "/join lobby")
+            harness.expect("Talker", "Slow has joined")
+
+            # Once the socket is full, what is sent to Slow waits in the
+            # server's queue, and ten more messages take it past the mark.
+            harness.stop_reading("Slow")
+            queue = harness.server.connections.get_by_name("Slow").outbound_queue
+            sent = []
+            while queue.is_empty() or len(sent) < 10:
+              if queue.is_empty() and len(sent) > 1000:
+                raise AssertionError("The socket of Slow never filled up.")
+              sent.append("[Talker] message {}".format(len(sent)))
+              harness.send("Talker", sent[-1][len("[Talker] "):])
+              harness.run_until_idle()
+            for i in range(10):
+              sent.append("[Talker] more {}".format(i))
+              harness.send("Talker", sent[-1][len("[Talker] "):])
+            harness.run_until_idle()
+
+            if policy == "disconnect":
+              harness.expect("Talker", "Slow has left")
+              harness.resume_reading("Slow")
+              harness.run_until(lambda: harness.clients["Slow"].closed,
+                                "Slow to be disconnected")
+              # Slow gets what was sent before its queue was full, and
+              # nothing after.
+              received = harness.clients["Slow"].received
+              if not received or received != sent[:len(received)]:
+                raise AssertionError("Slow received {!r}.".format(received))
+              continue
+
+            if queue.size > high_water_mark or queue.dropped == 0:
+              raise AssertionError("The queue of Slow has {} bytes and dropped "
+                                   "{} messages.".format(queue.size, queue.dropped))
+            # Slow has to catch up before anything else is sent, or that would
+            # be past the mark too.
+            harness.resume_reading("Slow")
+            harness.run_until(queue.is_empty, "Slow to catch up")
+            harness.send("Talker", "caught up")
+            if policy == "drop":
+              # The oldest messages got through, and the newest were dropped.
+              kept = sent[:len(sent) - queue.dropped]
+            else:
+              # The oldest queued message stays, since it may be partly
+              # written, and the newest fill up the rest of the queue.
+              num_kept = len(sent) - queue.dropped - 4
+              kept = sent[:num_kept] + sent[-4:]
+            harness.expect("Slow", *(kept + ["[Talker] caught up"]))
+            harness.expect_nothing("Slow")
+            harness.expect_nothing("Talker")
+
+    def test_leave_current_channel(self):
+        """Leaving the channel a client talks in sends its chat text to the
+        channel it joined last of the ones it is still in."""
+        with ChatHarness() as harness:
+          harness.connect("Alice")
+          harness.connect("Kay")
+          for channel in ["tas", "lounge"]:
+            harness.send("Alice", "/create {}".format(channel))
+            harness.run_until_idle()
+            harness.send("Kay", "/join {}".format(channel))
+            harness.expect("Alice", "Kay has joined")
+          harness.send("Kay", "/create hall")
+          harness.run_until_idle()
+
+          harness.send("Kay", "/leave hall")
+          harness.send("Kay", "Still here")
+          harness.expect("Alice", "[Kay] Still here")
+          # Alice talks in lounge, the last channel she joined, and leaving
+          # it takes her back to tas.
+          harness.send("Alice", "/leave lounge")
+          harness.expect("Kay", "Alice has left")
+          harness.send("Alice", "Back in tas")
+          harness.expect("Kay", "[Alice] Back in tas")
+          harness.expect_nothing("Alice")
+
+    def test_history(self):
+        """A client that joins a channel gets its last messages first, and one
+        that joins a quiet channel gets nothing."""
+        with ChatHarness(history_length=3) as harness:
+          harness.connect("Alice")
+          harness.connect("Kay")
+          harness.send("Alice", "/create tas")
+          harness.run_until_idle()
+          harness.send("Kay", "/join tas")
+          harness.expect("Alice", "Kay has joined")
+          for i in range(5):
+            sender, recipient = [("Alice", "Kay"), ("Kay", "Alice")][i % 2]
+            harness.send(sender, "message {}".format(i))
+            harness.expect(recipient, "[{}] message {}".format(sender, i))
+
+          # Only the last three are kept, and the join notices aren't.
+          harness.connect("Tess")
+          harness.send("Tess", "/join tas")
+          harness.expect("Tess", "[Alice] message 2", "[Kay] message 3",
+                         "[Alice] message 4")
+          harness.expect("Alice", "Tess has joined")
+          harness.expect("Kay", "Tess has joined")
+          harness.send("Tess", "Hi!")
+          harness.expect("Alice", "[Tess] Hi!")
+          harness.expect("Kay", "[Tess] Hi!")
+
+          # A client that comes back gets what it missed, and what it sent.
+          harness.send("Kay", "/leave tas")
+          harness.expect("Alice", "Kay has left")
+          harness.expect("Tess", "Kay has left")
+          harness.send("Kay", "/join tas")
+          harness.expect("Kay", "[Kay] message 3", "[Alice] message 4",
+                         "[Tess] Hi!")
+          harness.expect("Alice", "Kay has joined")
+          harness.expect("Tess", "Kay has joined")
+
+          harness.send("Alice", "/create quiet")
+          harness.run_until_idle()
+          harness.send("Tess", "/join quiet")
+          harness.expect("Alice", "Tess has joined")
+          harness.expect_nothing("Tess")
+          harness.expect_nothing("Kay")
+
+    def test_private_messages(self):
+        """/msg reaches its one recipient whatever channels they are in, and
+        stays out of the channels and their history."""
+        with ChatHarness() as harness:
+          harness.connect("Alice")
+          harness.connect("Kay")
+          harness.connect("Tess")
+          harness.send("Alice", "/create tas")
+          harness.run_until_idle()
+          harness.send("Tess", "/join tas")
+          harness.expect("Alice", "Tess has joined")
+          harness.send("Tess", "Hi all!")
+          harness.expect("Alice", "[Tess] Hi all!")
+
+          # Kay isn't in any channel.
+          harness.send("Alice", "/msg Kay Hi,  Kay!")
+          harness.expect("Kay", "[Alice] (private) Hi,  Kay!")
+          harness.send("Kay", "/msg Alice Hello!")
+          harness.expect("Alice", "[Kay] (private) Hello!")
+          harness.send("Tess", "/msg Tess Note to self")
+          harness.expect("Tess", "[Tess] (private) Note to self")
+
+          harness.send("Alice", "/msg Bob Hi!")
+          harness.expect("Alice", utils.SERVER_NO_CLIENT_EXISTS.format("Bob"))
+          harness.send("Alice", "/msg Kay")
+          harness.expect("Alice", utils.SERVER_MSG_REQUIRES_ARGUMENTS)
+          harness.expect_nothing("Kay")
+          harness.expect_nothing("Tess")
+
+          harness.send("Kay", "/join tas")
+          harness.expect("Alice", "Kay has joined")
+          harness.expect("Tess", "Kay has joined")
+          harness.expect("Kay", "[Tess] Hi all!")
+          harness.expect_nothing("Kay")
+
+    def test_capture(self):
+        """Everything the clients send is captured, frame by frame, with the
+        comings and goings of their connections."""
+        directory = tempfile.mkdtemp(prefix="chat-capture-")
+        path = os.path.join(directory, "capture")
+        try:
+          with ChatHarness(capture_path=path) as harness:
+            harness.connect("Alice")
+            harness.connect("Kay", framing_name=framing.LENGTH_PREFIXED.name)
+            harness.send("Alice", "/create tas")
+            harness.run_until_idle()
+            harness.send("Kay", "/join tas")
+            harness.expect("Alice", "Kay has joined")
+            harness.send("Kay", "Hi!")
+            harness.expect("Alice", "[Kay] Hi!")
+            harness.disconnect("Kay")
+
+          records = list(capture.read_capture(path))
+        finally:
+          shutil.rmtree(directory)
+
+        # Connections are known by the file descriptors of their sockets,
+        # which could be anything, so they are numbered as they turn up.
+        ids = {}
+        seen = []
+        for record in records:
+          ids.setdefault(record.connection_id, len(ids))
+          seen.append((record.kind, ids[record.connection_id], record.data))
+        expected = [
+            (capture.CAPTURE_CONNECT, 0, b"localhost"),
+            (capture.CAPTURE_FRAME, 0, b"Alice"),
+            (capture.CAPTURE_CONNECT, 1, b"localhost"),
+            (capture.CAPTURE_FRAME, 1, b"Kay"),
+            (capture.CAPTURE_FRAME, 1, b"/framing length-prefixed"),
+            (capture.CAPTURE_FRAME, 0, b"/create tas"),
+            (capture.CAPTURE_FRAME, 1, b"/join tas"),
+            (capture.CAPTURE_FRAME, 1, b"Hi!"),
+            (capture.CAPTURE_DISCONNECT, 1, b""),
+        ]
+        if seen != expected:
+          raise AssertionError("Expected the capture to have {}, not {}.".format(
+              expected, seen))
+        times = [record.time for record in records]
+        if times != sorted(times):
+          raise AssertionError("Capture times go backwards: {}.".format(times))
+
+    def test_longest_message(self):
+        """A message as long as the length-prefixed framing allows is cut short
+        to fit once it has its sender's name, here and in the history."""
+        length_prefixed = framing.LENGTH_PREFIXED.name
+        with ChatHarness() as harness:
+          harness.connect("Alice", framing_name=length_prefixed)
+          harness.connect("Kay", framing_name=length_prefixed)
+          harness.send("Alice", "/create tas")
+          harness.run_until_idle()
+          harness.send("Kay", "/join tas")
+          harness.expect("Alice", "Kay has joined")
+
+          message = "x" * framing.MAX_MESSAGE_LENGTH
+          expected = ("[Kay] " + message)[:framing.MAX_MESSAGE_LENGTH]
+          harness.send("Kay", message)
+          harness.expect("Alice", expected)
+          harness.send("Kay", "/msg Alice " + message[:-len("/msg Alice ")])
+          harness.expect("Alice", ("[Kay] (private) " + message)[
+              :framing.MAX_MESSAGE_LENGTH])
+
+          harness.connect("Tess", framing_name=length_prefixed)
+          harness.send("Tess", "/join tas")
+          harness.expect("Tess", expected)
+
+          # A handoff carries the history in fields of the same size.
+          harness.server.snapshot(list(harness.server.connections))
+
+    def test_workers(self):
+        """Clients of different workers chat with each other through the links
+        between the workers."""
+        length_prefixed = framing.LENGTH_PREFIXED.name
+        with ChatHarness(workers=2) as harness:
+          harness.connect("Alice", framing_name=length_prefixed, worker=0)
+          harness.connect("Kay", framing_name=length_prefixed, worker=1)
+          harness.send("Alice", "/create tas")
+          harness.run_until_idle()
+          harness.send("Kay", "/join tas")
+          harness.expect("Alice", "Kay has joined")
+
+          harness.send("Kay", "Hi!")
+          harness.expect("Alice", "[Kay] Hi!")
+          harness.send("Alice", "Hello!")
+          harness.expect("Kay", "[Alice] Hello!")
+          harness.send("Alice", "/msg Kay Psst")
+          harness.expect("Kay", "[Alice] (private) Psst")
+
+          # The longest message is relayed whole.
+          message = "x" * framing.MAX_MESSAGE_LENGTH
+          harness.send("Kay", message)
+          harness.expect("Alice", ("[Kay] " + message)[
+              :framing.MAX_MESSAGE_LENGTH])
+          harness.expect_nothing("Kay")
+          # Names stay unique across the workers.
+          if "Kay" not in harness.workers[0].remote_client_names:
+            raise AssertionError("The first worker does not know about Kay.")
+
+          harness.disconnect("Kay")
+          harness.expect("Alice", "Kay has left")
+
+        record = multicore_server.pack_relay_record(
+            multicore_server.RELAY_CHANNEL_MESSAGE, "tas", "Kay", "y" * 70000)
+        kind, fields = multicore_server.unpack_relay_record(record)
+        if (kind, fields) != (multicore_server.RELAY_CHANNEL_MESSAGE,
+                              ["tas", "Kay", "y" * 70000]):
+          raise AssertionError("A long relayed field did not come back whole.")
+
+    def test_handoff(self):
+        """A new server takes over in the middle of a conversation without
+        losing anything on its way, and the old one carries on if it can't
+        hand off."""
+        directory = tempfile.mkdtemp(prefix="chat-handoff-")
+        path = os.path.join(directory, "handoff")
+        try:
+          with ChatHarness(handoff_path=path) as harness:
+            harness.connect("Alice")
+            harness.connect("Kay")
+            harness.send("Alice", "/create tas")
+            harness.run_until_idle()
+            harness.send("Kay", "/join tas")
+            harness.expect("Alice", "Kay has joined")
+
+            # The old server gets Kay's messages, and half of another one,
+            # on the tick that it hands off on. The rest of it goes to the
+            # new server.
+            messages = ["before {}".format(i) for i in range(3)]
+            data = b"".join(framing.FIXED_LENGTH.encode(message)
+                            for message in messages)
+            cut_message = framing.FIXED_LENGTH.encode("across the handoff")
+            kay = harness.clients["Kay"]
+            kay.socket.sendall(data + cut_message[:50])
+            old_server = harness.server
+            harness.hand_off()
+            if harness.server is old_server:
+              raise AssertionError("The new server did not become the harness's.")
+            kay.socket.sendall(cut_message[50:])
+            expected = (["[Kay] {}".format(message) for message in messages]
+                        + ["[Kay] across the handoff"])
+            harness.expect("Alice", *expected)
+            harness.send("Alice", "After")
+            harness.expect("Kay", "[Alice] After")
+
+            # The history came along too.
+            harness.connect("Tess")
+            harness.send("Tess", "/join tas")
+            harness.expect("Tess", *(expected + ["[Alice] After"]))
+            harness.expect("Alice", "Tess has joined")
+            harness.expect("Kay", "Tess has joined")
+
+            # Without a snapshot, there is nothing to hand off.
+            def fail_to_snapshot(connections):
+              raise RuntimeError("No snapshot this time.")
+            harness.server.snapshot = fail_to_snapshot
+            try:
+              harness.hand_off()
+            except handoff.HandoffError:
+              pass
+            else:
+              raise AssertionError("The handoff went through without a snapshot.")
+            harness.send("Kay", "Still here")
+            harness.expect("Alice", "[Kay] Still here")
+            harness.expect("Tess", "[Kay] Still here")
+            if not os.path.exists(path):
+              raise AssertionError("The server let go of its handoff path.")
+        finally:
+          shutil.rmtree(directory)
+
+        # History messages of any length fit in a snapshot.
+        channels = [handoff.ChannelState("tas", [], [("Kay", "y" * 70000)])]
+        _, decoded = handoff.decode_snapshot(handoff.encode_snapshot([], channels))
+        if decoded != channels:
+          raise AssertionError("A long history message did not come back whole.")
+
+    def test_timer_wheel(self):
+        """A timer past the span of the outermost wheel waits for its deadline,
+        and a wheel without one outside the innermost is refused."""
+        # The outer wheel of this one turns every 16 seconds.
+        wheel = timer_wheel.TimerWheel(resolution=1, num_slots=4, num_levels=2,
+                                       now=0)
+        fired = []
+        wheel.schedule(100, lambda: fired.append(100))
+        wheel.schedule(3, lambda: fired.append(3))
+        for now in range(100):
+          wheel.advance(now)
+        if fired != [3]:
+          raise AssertionError("Timers fired early: {!r}.".format(fired))
+        wheel.advance(100)
+        if fired != [3, 100]:
+          raise AssertionError("Timers fired: {!r}.".format(fired))
+
+        try:
+          timer_wheel.TimerWheel(num_levels=1)
+        except ValueError:
+          pass
+        else:
+          raise AssertionError("A timer wheel took a single level.")
+
+def create_certificates():
+    """Makes a test CA and a server certificate for the TLS scenario, which is
+    skipped if openssl isn't around to make them."""
+    if shutil.which("openssl") is None:
+        print("openssl not found. Skipping the TLS scenario.")
+        return None
+    return tls.create_test_certificates()
+
+def run_in_parallel(num_runs, certificates=None):
+    """Runs the whole test num_runs times at once, each with a harness of its own."""
+    with concurrent.futures.ThreadPoolExecutor(num_runs) as executor:
+        runs = [executor.submit(SimpleTest().run, 0, seed, certificates)
+                for seed in range(num_runs)]
+        return [run.exception() for run in runs]
 
 if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        print "Usage: python simple_test.py <port>"
-        sys.exit(1)
+    parser = argparse.ArgumentParser(description="Test the chat server.")
+    parser.add_argument("port", type=int, nargs="?", default=0,
+                        help="Port for the server. Defaults to any free port.")
+    parser.add_argument("--parallel", dest="parallel", type=int, default=1,
+                        help="Number of copies of the test to run at once.")
+    args = parser.parse_args()
 
-    port = int(sys.argv[1])
-    SimpleTest().run(port)
+    certificates = create_certificates()
+    start = time.perf_counter()
+    if args.parallel > 1:
+        errors = [error for error in run_in_parallel(args.parallel,
+                                                     certificates)
+                  if error is not None]
+    else:
+        errors = []
+        try:
+          SimpleTest().run(args.port, certificates=certificates)
+        except Exception as error:
+          errors.append(error)
 
+    if certificates is not None:
+        shutil.rmtree(certificates.directory)
+    elapsed = time.perf_counter() - start
+    for error in errors:
+        print("FAIL: {}".format(error))
+    print("{} of {} runs passed in {:.3f}s.".format(
+        max(args.parallel, 1) - len(errors), max(args.parallel, 1), elapsed))
+    sys.exit(1 if errors else 0)
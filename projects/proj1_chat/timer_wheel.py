@@ -0,0 +1,196 @@
+import math
+import time
+
+
+# Seconds that a slot of the innermost wheel stands for. Timers fire at most
+# this late.
+DEFAULT_RESOLUTION = 0.1
+
+# Slots in each wheel. Each wheel's slot stands for a full turn of the wheel
+# inside it.
+DEFAULT_NUM_SLOTS = 256
+
+# Number of wheels. With the defaults above, the outermost wheel turns once
+# every 256 ** 4 * 0.1 seconds, which is over 13 years. Timers that are even
+# further out sit in its last slot until it comes around. That takes a wheel
+# outside the innermost one, whose slots fire instead of going in again, so
+# there have to be at least two.
+DEFAULT_NUM_LEVELS = 4
+MIN_NUM_LEVELS = 2
+
+# A wheel of a single slot never turns, so nothing would ever move inward.
+MIN_NUM_SLOTS = 2
+
+
+class Timer(object):
+    __slots__ = ('_tick', '_callback', '_slot')
+
+    def __init__(self, tick, callback):
+        self._tick = tick
+        self._callback = callback
+        # The set of timers that this one is in, or None once it has fired
+        # or has been cancelled.
+        self._slot = None
+
+    @property
+    def active(self):
+        return self._slot is not None
+
+
+class TimerWheel(object):
+    # A hierarchical timing wheel. Time is cut into ticks of resolution
+    # seconds. The innermost wheel has a slot for each of the next num_slots
+    # ticks, the next one a slot for each of the next num_slots turns of the
+    # innermost wheel, and so on. A timer goes into the slot of the
+    # innermost wheel that reaches its deadline, and whenever a wheel
+    # completes a turn, the timers in the next slot of the wheel outside it
+    # are spread over its slots.
+    #
+    # Scheduling and cancelling a timer are O(1), and so is advancing the
+    # wheel by a tick, apart from the timers that fire or move inward. How
+    # many timers are waiting doesn't matter.
+    #
+    # Deadlines are in the time of clock, which tests may swap for one that
+    # they move forward themselves.
+    def __init__(self, resolution=DEFAULT_RESOLUTION,
+                 num_slots=DEFAULT_NUM_SLOTS, num_levels=DEFAULT_NUM_LEVELS,
+                 now=None, clock=time.monotonic):
+        if num_levels < MIN_NUM_LEVELS:
+            raise ValueError('A timer wheel needs at least {} levels, not '
+                             '{}.'.format(MIN_NUM_LEVELS, num_levels))
+        if num_slots < MIN_NUM_SLOTS:
+            raise ValueError('A timer wheel needs at least {} slots, not '
+                             '{}.'.format(MIN_NUM_SLOTS, num_slots))
+
+        self._clock = clock
+        if now is None:
+            now = clock()
+
+        self._resolution = resolution
+        self._num_slots = num_slots
+        self._levels = [[set() for _ in range(num_slots)]
+                        for _ in range(num_levels)]
+        # Number of ticks that one slot of each wheel stands for.
+        self._slot_ticks = [num_slots ** level for level in range(num_levels)]
+        # The last tick that has been handled.
+        self._tick = self._to_tick(now)
+        self._num_timers = 0
+
+    def __len__(self):
+        return self._num_timers
+
+    @property
+    def resolution(self):
+        return self._resolution
+
+    def schedule(self, deadline, callback):
+        # Calls callback() once the wheel is advanced past deadline, which is
+        # in the time of the wheel's clock. Returns the timer, which may
+        # be cancelled.
+        timer = Timer(max(int(math.ceil(deadline / self._resolution)),
+                          self._tick + 1),
+                      callback)
+        self._insert(timer)
+        self._num_timers += 1
+
+        return timer
+
+    def cancel(self, timer):
+        if timer._slot is None:
+            return
+
+        timer._slot.discard(timer)
+        timer._slot = None
+        self._num_timers -= 1
+
+    def next_deadline(self):
+        # A time at or before the next deadline, so that an event loop knows
+        # how long it may sleep, or None if there are no timers. It is the
+        # deadline of the next timer if the innermost wheel has one, or else
+        # the end of the wheel's turn, when timers move into it.
+        if not self._num_timers:
+            return None
+
+        num_slots = self._num_slots
+        innermost = self._levels[0]
+        for tick in range(self._tick + 1, self._tick + num_slots + 1):
+            if innermost[tick % num_slots]:
+                return tick * self._resolution
+
+            if tick % num_slots == 0:
+                break
+
+        return (self._tick - self._tick % num_slots + num_slots) \
+            * self._resolution
+
+    def advance(self, now=None):
+        # Fires every timer whose deadline is at or before now. Returns the
+        # number of timers that fired.
+        if now is None:
+            now = self._clock()
+
+        target = self._to_tick(now)
+        if not self._num_timers:
+            self._tick = max(self._tick, target)
+            return 0
+
+        num_fired = 0
+        while self._tick < target and self._num_timers:
+            self._tick += 1
+            self._cascade()
+
+            slot = self._levels[0][self._tick % self._num_slots]
+            while slot:
+                timer = slot.pop()
+                timer._slot = None
+                self._num_timers -= 1
+                num_fired += 1
+                timer._callback()
+
+        self._tick = max(self._tick, target)
+
+        return num_fired
+
+    def _to_tick(self, now):
+        return int(now / self._resolution)
+
+    def _insert(self, timer):
+        ticks_left = timer._tick - self._tick
+        num_slots = self._num_slots
+        for level, slot_ticks in enumerate(self._slot_ticks):
+            if ticks_left < slot_ticks * num_slots:
+                break
+        else:
+            # Too far out even for the outermost wheel. It waits in the
+            # slot that the wheel reaches last, and goes in again from there.
+            level = len(self._levels) - 1
+            slot_ticks = self._slot_ticks[level]
+            timer_tick = self._tick + slot_ticks * (num_slots - 1)
+            timer._slot = self._levels[level][
+                (timer_tick // slot_ticks) % num_slots]
+            timer._slot.add(timer)
+            return
+
+        timer._slot = self._levels[level][
+            (timer._tick // slot_ticks) % num_slots]
+        timer._slot.add(timer)
+
+    def _cascade(self):
+        # Whenever a wheel has completed a turn, the timers in the next slot
+        # of the wheel outside it are put back in where they now belong.
+        # The outer wheels go first, so that their timers can move in all
+        # the way.
+        num_slots = self._num_slots
+        levels_to_cascade = 0
+        for slot_ticks in self._slot_ticks[1:]:
+            if self._tick % slot_ticks:
+                break
+            levels_to_cascade += 1
+
+        for level in range(levels_to_cascade, 0, -1):
+            slot_ticks = self._slot_ticks[level]
+            slot = self._levels[level][(self._tick // slot_ticks) % num_slots]
+            timers = list(slot)
+            slot.clear()
+            for timer in timers:
+                self._insert(timer)
@@ -0,0 +1,265 @@
+import collections
+import logging
+import os
+import socket
+import ssl
+import subprocess
+import tempfile
+import time
+
+import event_loops
+import server_logging
+
+
+logger = logging.getLogger(server_logging.LOGGER_NAME)
+
+
+# Seconds that a client has to finish its handshake before the connection is
+# dropped. A client that opens a connection and never says anything would
+# otherwise keep its socket forever.
+DEFAULT_HANDSHAKE_TIMEOUT = 10.0
+
+# Number of session tickets that the server sends after a TLS 1.3 handshake.
+# A client uses one per connection that it resumes.
+DEFAULT_NUM_TICKETS = 2
+
+
+def create_server_context(certfile, keyfile=None,
+                          num_tickets=DEFAULT_NUM_TICKETS):
+    # Session tickets are on by default. The ticket keys belong to the
+    # context, so every listener of a server resumes the sessions of any of
+    # them.
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.load_cert_chain(certfile, keyfile)
+    context.num_tickets = num_tickets
+
+    return context
+
+
+def create_client_context(cafile=None):
+    # Trusts the system's CAs, or only the one in cafile if one is given,
+    # like the test CA below.
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    if cafile is not None:
+        context.load_verify_locations(cafile)
+    else:
+        context.load_default_certs()
+
+    return context
+
+
+# Paths of the files of a test CA and of a server certificate signed by it.
+TestCertificates = collections.namedtuple(
+    'TestCertificates', ['directory', 'ca_file', 'cert_file', 'key_file'])
+
+
+def create_test_certificates(directory=None, hostname='localhost',
+                             openssl='openssl'):
+    # Makes a throwaway self-signed CA and a certificate for hostname that it
+    # signs, with the openssl command line tool, since the ssl module can't
+    # make certificates. They are only meant for tests and benchmarks, and
+    # are valid for a day.
+    if directory is None:
+        directory = tempfile.mkdtemp(prefix='chat-tls-')
+
+    certificates = TestCertificates(
+        directory,
+        os.path.join(directory, 'ca.pem'),
+        os.path.join(directory, 'server.pem'),
+        os.path.join(directory, 'server.key'),
+    )
+    ca_key_file = os.path.join(directory, 'ca.key')
+    request_file = os.path.join(directory, 'server.csr')
+    extensions_file = os.path.join(directory, 'server.ext')
+
+    # Elliptic curve keys make for much cheaper handshakes than RSA ones.
+    key_options = ['-newkey', 'ec', '-pkeyopt',
+                   'ec_paramgen_curve:prime256v1', '-nodes']
+
+    with open(extensions_file, 'w') as extensions:
+        extensions.write('basicConstraints = critical, CA:FALSE\n'
+                         + 'keyUsage = critical, digitalSignature\n'
+                         + 'extendedKeyUsage = serverAuth\n'
+                         + 'subjectKeyIdentifier = hash\n'
+                         + 'authorityKeyIdentifier = keyid, issuer\n'
+                         + 'subjectAltName = DNS:{}, IP:127.0.0.1\n'.format(
+                             hostname))
+
+    commands = [
+        [openssl, 'req', '-x509'] + key_options + [
+            '-keyout', ca_key_file, '-out', certificates.ca_file,
+            '-days', '1', '-subj', '/CN=CMSC 135 Chat Test CA',
+            '-addext', 'basicConstraints = critical, CA:TRUE',
+            '-addext', 'keyUsage = critical, keyCertSign, cRLSign'],
+        [openssl, 'req'] + key_options + [
+            '-keyout', certificates.key_file, '-out', request_file,
+            '-subj', '/CN={}'.format(hostname)],
+        [openssl, 'x509', '-req', '-in', request_file,
+         '-CA', certificates.ca_file, '-CAkey', ca_key_file,
+         '-CAcreateserial', '-days', '1', '-extfile', extensions_file,
+         '-out', certificates.cert_file],
+    ]
+    for command in commands:
+        subprocess.run(command, check=True, stdout=subprocess.DEVNULL,
+                       stderr=subprocess.PIPE)
+
+    return certificates
+
+
+class _Handshake(object):
+    def __init__(self, tls_socket, address, deadline):
+        self.socket = tls_socket
+        self.address = address
+        self.deadline = deadline
+        self.events = event_loops.EVENT_READ
+
+
+class TLSListener(object):
+    # Accepts TLS connections on a port of their own and runs their
+    # handshakes on the server's event loop. A handshake takes a few round
+    # trips, and each step of it is only taken once the socket is ready for
+    # it, so a slow client never holds up anyone else. Connections that are
+    # done with their handshake are handed to on_connection(tls_socket,
+    # address), and from then on they are like any other connection.
+    def __init__(self, context, event_loop, on_connection,
+                 address='localhost', port=0,
+                 handshake_timeout=DEFAULT_HANDSHAKE_TIMEOUT,
+                 clock=time.monotonic):
+        self._context = context
+        self._event_loop = event_loop
+        self._on_connection = on_connection
+        self._address = address
+        self._port = int(port)
+        self._handshake_timeout = handshake_timeout
+        # Handshake deadlines go by clock, which is the server's.
+        self._clock = clock
+        self._socket = None
+        # Handshakes by file descriptor. Every handshake gets the same
+        # timeout, so they are in the order of their deadlines too.
+        self._handshakes = collections.OrderedDict()
+
+        self.num_handshakes = 0
+        self.num_resumed = 0
+        self.num_failed = 0
+
+    @property
+    def port(self):
+        return self._port
+
+    @property
+    def num_pending(self):
+        return len(self._handshakes)
+
+    @property
+    def listening_socket(self):
+        return self._socket
+
+    def start(self, listening_socket=None):
+        # A socket that is already listening, like one handed over by
+        # another server, may be given instead of binding a new one.
+        if listening_socket is None:
+            listening_socket = socket.socket()
+            listening_socket.bind((self._address, self._port))
+            listening_socket.listen(socket.SOMAXCONN)
+
+        self._socket = listening_socket
+        self._socket.setblocking(False)
+
+        self._port = self._socket.getsockname()[1]
+
+        self._event_loop.register(self._socket, event_loops.EVENT_READ)
+
+    def handles(self, s):
+        return s is self._socket or s.fileno() in self._handshakes
+
+    def handle_event(self, s, events):
+        if s is self._socket:
+            self._accept()
+        else:
+            self._continue(self._handshakes[s.fileno()])
+
+    def next_deadline(self):
+        # When the oldest handshake times out, or None if there are none.
+        for handshake in self._handshakes.values():
+            return handshake.deadline
+
+        return None
+
+    def expire_handshakes(self, now):
+        while self._handshakes:
+            handshake = next(iter(self._handshakes.values()))
+            if handshake.deadline > now:
+                break
+
+            logger.info('TLS handshake with %s timed out.', handshake.address)
+            self.num_failed += 1
+            self._drop(handshake)
+            handshake.socket.close()
+
+    def close(self):
+        for handshake in list(self._handshakes.values()):
+            self._drop(handshake)
+            handshake.socket.close()
+
+        if self._socket is not None:
+            self._event_loop.unregister(self._socket)
+            self._socket.close()
+            self._socket = None
+
+    def _accept(self):
+        try:
+            client_socket, address = self._socket.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+
+        # The session tickets and the first messages after a TLS 1.3
+        # handshake go out in separate writes. With Nagle's algorithm, the
+        # second one waits for the client's delayed ACK of the first.
+        client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.add_socket(client_socket, address[0])
+
+    def add_socket(self, client_socket, address):
+        # Starts the handshake of a socket that is already connected to a
+        # client, like one that was accepted.
+        client_socket.setblocking(False)
+        tls_socket = self._context.wrap_socket(client_socket,
+                                               server_side=True,
+                                               do_handshake_on_connect=False)
+
+        handshake = _Handshake(tls_socket, address,
+                               self._clock() + self._handshake_timeout)
+        self._handshakes[tls_socket.fileno()] = handshake
+        self._event_loop.register(tls_socket, handshake.events)
+
+    def _continue(self, handshake):
+        try:
+            handshake.socket.do_handshake()
+        except ssl.SSLWantReadError:
+            events = event_loops.EVENT_READ
+        except ssl.SSLWantWriteError:
+            events = event_loops.EVENT_WRITE
+        except (ssl.SSLError, socket.error) as error:
+            logger.info('TLS handshake with %s failed: %s',
+                        handshake.address, error)
+            self.num_failed += 1
+            self._drop(handshake)
+            handshake.socket.close()
+            return
+        else:
+            self.num_handshakes += 1
+            if handshake.socket.session_reused:
+                self.num_resumed += 1
+
+            self._drop(handshake)
+            self._on_connection(handshake.socket, handshake.address)
+            return
+
+        if events != handshake.events:
+            handshake.events = events
+            self._event_loop.modify(handshake.socket, events)
+
+    def _drop(self, handshake):
+        del self._handshakes[handshake.socket.fileno()]
+        self._event_loop.unregister(handshake.socket)
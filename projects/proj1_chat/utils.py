@@ -23,7 +23,7 @@ CLIENT_WIPE_ME = "\r    "
 # The client sent a control message (a message starting with "/") that doesn't exist
 # (e.g., /foobar).
 SERVER_INVALID_CONTROL_MESSAGE = \
-  "{} is not a valid control message. Valid messages are /create, /list, and /join."
+  "{} is not a valid control message. Valid messages are /create, /list, /join, /leave, and /msg."
 
 # Message returned when a client attempts to join a channel that doesn't exist.
 SERVER_NO_CHANNEL_EXISTS = "No channel named {0} exists. Try '/create {0}'?"
@@ -31,12 +31,33 @@ SERVER_NO_CHANNEL_EXISTS = "No channel named {0} exists. Try '/create {0}'?"
 # Message sent to a client that uses the "/join" command without a channel name.
 SERVER_JOIN_REQUIRES_ARGUMENT = "/join command must be followed by the name of a channel to join."
 
+# Message sent to a client that uses the "/leave" command without a channel name.
+SERVER_LEAVE_REQUIRES_ARGUMENT = "/leave command must be followed by the name of a channel to leave."
+
+# Message sent to a client that tries to leave a channel that it isn't in.
+SERVER_CLIENT_NOT_IN_NAMED_CHANNEL = "Not currently in a channel named {0}."
+
+# Message sent to a client that uses the "/msg" command without a client name and a message.
+SERVER_MSG_REQUIRES_ARGUMENTS = \
+  "/msg command must be followed by the name of a client and a message to send them."
+
+# Message returned when a client sends a private message to a client that isn't connected.
+SERVER_NO_CLIENT_EXISTS = "No client named {0} is connected."
+
 # Message sent to all clients in a channel when a new client joins.
 SERVER_CLIENT_JOINED_CHANNEL = "{0} has joined"
 
 # Message sent to all clients in a channel when a client leaves.
 SERVER_CLIENT_LEFT_CHANNEL = "{0} has left"
 
+# Message sent to a client that goes over its rate limit.
+SERVER_CLIENT_RATE_LIMITED = \
+  "You are sending messages too fast. They will be dropped until you slow down."
+
+# Message sent to a client whose message goes over its channel's rate limit.
+SERVER_CHANNEL_RATE_LIMITED = \
+  "Room {0} is too busy. Messages to it will be dropped until it quiets down."
+
 # Message sent to a client that tries to create a channel that doesn't exist.
 SERVER_CHANNEL_EXISTS = "Room {0} already exists, so cannot be created."
 